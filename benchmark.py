@@ -0,0 +1,1000 @@
+import taichi as ti
+from vector import *
+import ray
+import argparse
+import itertools
+import numpy as np
+import random
+from time import time
+from main import make_world, make_camera
+from render import Renderer
+from wavefront import QueueRenderer
+from distributed import Coordinator
+from sampler import SAMPLERS
+
+RENDERERS = {
+    'megakernel': Renderer,
+    'wavefront': QueueRenderer,
+}
+
+# the bvh layouts and traversals that can be compared
+MODES = {
+    'threaded': dict(),
+    'compact': dict(compact=True),
+    'ordered': dict(compact=True, traversal='ordered'),
+}
+
+
+def make_trace_kernel(world, cam, width, height, max_depth):
+    ''' A kernel that traces one path per pixel and returns the number of
+        closest hit queries made '''
+    @ti.kernel
+    def trace() -> ti.i32:
+        num_rays = 0
+        for x, y in ti.ndrange(width, height):
+            u = (x + ti.random()) / (width - 1)
+            v = (y + ti.random()) / (height - 1)
+            ray_org, ray_dir, time = cam.get_ray(u, v)
+            depth = 0
+            while depth < max_depth:
+                depth += 1
+                hit, p, n, front_facing, index = world.hit_all(
+                    ray_org, ray_dir, time)
+                if not hit:
+                    break
+                reflected, ray_org, ray_dir, attenuation = world.scatter(
+                    ray_dir, p, n, front_facing, index, random_uniform3())
+            num_rays += depth
+        return num_rays
+
+    return trace
+
+
+def bench_traversal(args):
+    ''' Closest hit rays per second of each bvh mode on the main.py scene '''
+    aspect_ratio = 3.0 / 2.0
+    height = int(args.width / aspect_ratio)
+    cam = make_camera(aspect_ratio)
+
+    for mode in args.modes:
+        random.seed(args.seed)
+        world = make_world()
+        world.commit(**MODES[mode])
+        trace = make_trace_kernel(world, cam, args.width, height,
+                                  args.max_depth)
+
+        t = time()
+        trace()
+        compile_time = time() - t
+
+        t = time()
+        num_rays = 0
+        for _ in range(args.passes):
+            num_rays += trace()
+        render_time = time() - t
+        print('{:10s} nodes {:6d} compile {:6.2f}s {:8.3f} Mrays/s'.format(
+            mode, world.bvh.stats['num_nodes'], compile_time,
+            num_rays / render_time / 1e6))
+
+
+def make_query_kernels(world, cam, width, height):
+    ''' Kernels that fill rays with ambient occlusion style rays from the
+        first hit of each pixel, then shoot them as closest hit or as
+        occlusion queries.  Each query kernel returns the number of hits. '''
+    rays = ray.Rays(width, height)
+
+    @ti.kernel
+    def make_rays():
+        for x, y in ti.ndrange(width, height):
+            u = (x + ti.random()) / (width - 1)
+            v = (y + ti.random()) / (height - 1)
+            ray_org, ray_dir, time = cam.get_ray(u, v)
+            hit, p, n, front_facing, index = world.hit_all(
+                ray_org, ray_dir, time)
+            if hit:
+                ray_org = p
+                ray_dir = n + random_in_hemisphere(n)
+            rays.set(x, y, ray_org, ray_dir, 0, Vector(1.0, 1.0, 1.0))
+            rays.set_time(x, y, time)
+
+    @ti.kernel
+    def closest() -> ti.i32:
+        num_hits = 0
+        for x, y in ti.ndrange(width, height):
+            ray_org, ray_dir = rays.get_od(x, y)
+            hit, p, n, front_facing, index = world.hit_all(
+                ray_org, ray_dir, rays.get_time(x, y))
+            if hit:
+                num_hits += 1
+        return num_hits
+
+    @ti.kernel
+    def occluded() -> ti.i32:
+        num_hits = 0
+        for x, y in ti.ndrange(width, height):
+            ray_org, ray_dir = rays.get_od(x, y)
+            if world.occluded(ray_org, ray_dir, 9999999999.9,
+                              rays.get_time(x, y)):
+                num_hits += 1
+        return num_hits
+
+    return make_rays, closest, occluded
+
+
+def bench_occlusion(args):
+    ''' Rays per second of occlusion against closest hit queries '''
+    aspect_ratio = 3.0 / 2.0
+    height = int(args.width / aspect_ratio)
+    cam = make_camera(aspect_ratio)
+
+    for mode in args.modes:
+        random.seed(args.seed)
+        world = make_world()
+        world.commit(**MODES[mode])
+        make_rays, closest, occluded = make_query_kernels(
+            world, cam, args.width, height)
+        make_rays()
+
+        for name, query in (('closest', closest), ('occluded', occluded)):
+            num_hits = query()
+            t = time()
+            for _ in range(args.passes):
+                query()
+            query_time = time() - t
+            print('{:10s} {:8s} hits {:7d} {:8.3f} Mrays/s'.format(
+                mode, name, num_hits,
+                args.passes * args.width * height / query_time / 1e6))
+
+
+def bench_render(args):
+    ''' Time of full renders of the main.py scene with each renderer.
+        The first render includes compiling the kernels. '''
+    aspect_ratio = 3.0 / 2.0
+    height = int(args.width / aspect_ratio)
+    cam = make_camera(aspect_ratio)
+    random.seed(args.seed)
+    world = make_world()
+    world.commit(**MODES[args.modes[0]])
+
+    for name in args.renderers:
+        renderer = RENDERERS[name](world, cam, args.width, height, args.spp,
+                                   args.max_depth,
+                                   pass_batch=args.pass_batch)
+        t = time()
+        renderer.render()
+        first_time = time() - t
+
+        t = time()
+        renderer.render()
+        render_time = time() - t
+        print('{:10s} first {:7.2f}s render {:7.2f}s launches {:5d} '
+              'overhead {:6.3f}s'.format(name, first_time, render_time,
+                                         renderer.stats['launches'],
+                                         renderer.stats['overhead_time']))
+
+
+def bench_adaptive(args):
+    ''' Time and error against a reference of uniform and adaptive sampling
+        with the same sample budget '''
+    aspect_ratio = 3.0 / 2.0
+    height = int(args.width / aspect_ratio)
+    cam = make_camera(aspect_ratio)
+    random.seed(args.seed)
+    world = make_world()
+    world.commit(**MODES[args.modes[0]])
+    renderer_class = RENDERERS[args.renderers[0]]
+
+    reference = renderer_class(world, cam, args.width, height,
+                               args.reference_spp, args.max_depth,
+                               pass_batch=args.pass_batch)
+    reference.render()
+    reference = reference.pixels.to_numpy()
+
+    settings = [('uniform', dict())]
+    for threshold in args.thresholds:
+        settings.append(('adaptive {}'.format(threshold),
+                         dict(adaptive_threshold=threshold)))
+        settings.append(('adaptive {} redistribute'.format(threshold),
+                         dict(adaptive_threshold=threshold,
+                              max_samples=4 * args.spp)))
+
+    for name, kwargs in settings:
+        renderer = renderer_class(world, cam, args.width, height, args.spp,
+                                  args.max_depth, pass_batch=args.pass_batch,
+                                  **kwargs)
+        renderer.render()
+        rmse = np.sqrt(np.mean((renderer.pixels.to_numpy() - reference)**2))
+        samples = renderer.sample_count.to_numpy()
+        print('{:28s} render {:7.2f}s mean spp {:7.1f} rmse {:.5f}'.format(
+            name, renderer.stats['render_time'], samples.mean(), rmse))
+
+
+def bench_sampler(args):
+    ''' Error against a reference of each sampler at a few sample counts,
+        and if rendering twice gives the same image '''
+    aspect_ratio = 3.0 / 2.0
+    height = int(args.width / aspect_ratio)
+    cam = make_camera(aspect_ratio)
+    random.seed(args.seed)
+    world = make_world()
+    world.commit(**MODES[args.modes[0]])
+    renderer_class = RENDERERS[args.renderers[0]]
+
+    reference = renderer_class(world, cam, args.width, height,
+                               args.reference_spp, args.max_depth,
+                               pass_batch=args.pass_batch,
+                               seed=args.seed + 1)
+    reference.render()
+    reference = reference.pixels.to_numpy()
+
+    for kind in SAMPLERS:
+        for spp in (args.spp // 4, args.spp // 2, args.spp):
+            renderer = renderer_class(world, cam, args.width, height, spp,
+                                      args.max_depth,
+                                      pass_batch=args.pass_batch,
+                                      sampler=kind, seed=args.seed)
+            renderer.render()
+            image = renderer.pixels.to_numpy()
+            renderer.render()
+            same = np.array_equal(image, renderer.pixels.to_numpy())
+            rmse = np.sqrt(np.mean((image - reference)**2))
+            print('{:12s} spp {:5d} rmse {:.5f} reproducible {}'.format(
+                kind, spp, rmse, same))
+
+
+def bench_roulette(args):
+    ''' Render time, rays per sample, mean path length and error against a
+        reference without roulette for each roulette depth, 0 is none.
+        bias is the relative difference of the mean linear radiance to the
+        reference.  The rays are counted by a second, instrumented render
+        with the same samples. '''
+    aspect_ratio = 3.0 / 2.0
+    height = int(args.width / aspect_ratio)
+    cam = make_camera(aspect_ratio)
+    random.seed(args.seed)
+    world = make_world()
+    world.commit(**MODES[args.modes[0]])
+    renderer_class = RENDERERS[args.renderers[0]]
+
+    reference = renderer_class(world, cam, args.width, height,
+                               args.reference_spp, args.max_depth,
+                               pass_batch=args.pass_batch,
+                               seed=args.seed + 1)
+    reference.render()
+    reference = reference.pixels.to_numpy()
+    reference_mean = np.mean(reference**2)
+
+    for depth in args.roulette_depths:
+        renderer = renderer_class(world, cam, args.width, height, args.spp,
+                                  args.max_depth, pass_batch=args.pass_batch,
+                                  roulette_depth=depth, seed=args.seed)
+        renderer.compile()
+        renderer.render()
+        render_time = renderer.stats['render_time']
+        image = renderer.pixels.to_numpy()
+        rmse = np.sqrt(np.mean((image - reference)**2))
+        bias = np.mean(image**2) / reference_mean - 1.0
+
+        counted = renderer_class(world, cam, args.width, height, args.spp,
+                                 args.max_depth, pass_batch=args.pass_batch,
+                                 roulette_depth=depth, seed=args.seed,
+                                 instrument=True)
+        counted.render()
+        stats = counted.stats
+        print('roulette depth {:3d} render {:7.2f}s rays/sample {:6.3f} '
+              'mean path {:6.3f} rmse {:.5f} bias {:+.4f}'.format(
+                  depth, render_time,
+                  stats['rays'] / max(sum(stats['path_lengths']), 1),
+                  stats['mean_path_length'], rmse, bias))
+        world.set_counters(None)
+
+
+def bench_denoise(args):
+    ''' Error against a high sample reference of renders at each of
+        args.spps before and after denoise.Denoiser, with the render and
+        denoise times '''
+    from denoise import Denoiser
+    aspect_ratio = 3.0 / 2.0
+    height = int(args.width / aspect_ratio)
+    cam = make_camera(aspect_ratio)
+    random.seed(args.seed)
+    world = make_world()
+    world.commit(**MODES[args.modes[0]])
+    renderer_class = RENDERERS[args.renderers[0]]
+
+    reference = renderer_class(world, cam, args.width, height,
+                               args.reference_spp, args.max_depth,
+                               pass_batch=args.pass_batch,
+                               seed=args.seed + 1)
+    reference.render()
+    reference = reference.pixels.to_numpy()
+
+    for spp in args.spps:
+        renderer = renderer_class(world, cam, args.width, height, spp,
+                                  args.max_depth, pass_batch=args.pass_batch,
+                                  seed=args.seed, auxiliary=True)
+        renderer.compile()
+        renderer.render()
+        noisy = np.sqrt(np.mean((renderer.pixels.to_numpy() - reference)**2))
+        denoiser = Denoiser(renderer)
+        denoiser.compile()
+        denoiser.denoise()
+        rmse = np.sqrt(np.mean((denoiser.image() - reference)**2))
+        print('spp {:5d} render {:7.2f}s rmse {:.5f} denoised {:.5f} '
+              'denoise {:6.3f}s'.format(spp, renderer.stats['render_time'],
+                                        noisy, rmse,
+                                        denoiser.stats['denoise_time']))
+
+
+def bench_lights(args):
+    ''' Error against a reference of renders of the main.py scene with
+        args.lights lamps under a dark sky at each of args.spps, finding
+        the lamps only by bouncing into them and with light sampling.
+        The reference only bounces too, so it can not share a bias of the
+        shadow rays.  The error is of the image as written, clipped to 1,
+        the mean of the linear colors shows any bias between the two. '''
+    aspect_ratio = 3.0 / 2.0
+    height = int(args.width / aspect_ratio)
+    cam = make_camera(aspect_ratio)
+    random.seed(args.seed)
+    world = make_world(lights=args.lights)
+    world.commit(**MODES[args.modes[0]])
+    renderer_class = RENDERERS[args.renderers[0]]
+
+    def render(spp, light_sampling, seed):
+        renderer = renderer_class(world, cam, args.width, height, spp,
+                                  args.max_depth, pass_batch=args.pass_batch,
+                                  seed=seed, sky=args.sky,
+                                  light_sampling=light_sampling)
+        renderer.compile()
+        renderer.render()
+        return renderer.pixels.to_numpy(), renderer.stats['render_time']
+
+    reference, _ = render(args.reference_spp, False, args.seed + 1)
+    print('reference mean {:.5f}'.format(np.mean(reference**2)))
+    reference = np.minimum(reference, 1.0)
+    for spp in args.spps:
+        for light_sampling in (False, True):
+            image, render_time = render(spp, light_sampling, args.seed)
+            rmse = np.sqrt(np.mean((np.minimum(image, 1.0) - reference)**2))
+            print('spp {:5d} light sampling {:d} render {:7.2f}s rmse {:.5f} '
+                  'mean {:.5f}'.format(spp, light_sampling, render_time,
+                                       rmse, np.mean(image**2)))
+
+
+def bench_materials(args):
+    ''' Shading coherence on the main.py scene.  The wavefront renderer is
+        stepped a pass at a time and the rays it shades are split into
+        warps of args.warp lanes, once in pixel order, as a megakernel
+        shades them, and once binned by material type, as the shade queues
+        are.  A warp runs the scatter of each type it holds with all its
+        lanes, so the lane efficiency is the rays over the lanes run.  Also
+        the parameter bytes each shade reads with the per type tables
+        against a table of all the columns, and the render times. '''
+    from material import COLUMNS, MATERIAL_CLASSES, NUM_MATERIALS
+    aspect_ratio = 3.0 / 2.0
+    height = int(args.width / aspect_ratio)
+    random.seed(args.seed)
+    world = make_world()
+    world.commit(**MODES[args.modes[0]])
+    renderer = QueueRenderer(world, make_camera(aspect_ratio), args.width,
+                             height, args.spp, args.max_depth, pass_batch=1)
+
+    shaded = np.zeros(NUM_MATERIALS, dtype=np.int64)
+    pixel_lanes = binned_lanes = 0
+    types = np.full((args.width, height), -1)
+    renderer.wavefront_initial()
+    while not renderer.is_done():
+        renderer.generate()
+        order = renderer.extend.pixel.to_numpy()[:renderer.extend.count[
+            None]]
+        renderer.intersect()
+        types[:] = -1
+        for m in range(NUM_MATERIALS):
+            queue = renderer.shade[m]
+            count = queue.count[None]
+            pixels = queue.pixel.to_numpy()[:count]
+            types[pixels[:, 0], pixels[:, 1]] = m
+            shaded[m] += count
+            binned_lanes += -(-count // args.warp) * args.warp
+        hit_types = types[order[:, 0], order[:, 1]]
+        hit_types = hit_types[hit_types >= 0]
+        for i in range(0, len(hit_types), args.warp):
+            pixel_lanes += len(np.unique(
+                hit_types[i:i + args.warp])) * args.warp
+        for m in range(NUM_MATERIALS):
+            renderer.shade_material(m, renderer.shade[m])
+
+    rays = shaded.sum()
+    print('shaded rays', rays, 'by type', shaded.tolist())
+    print('lane efficiency pixel order {:.3f} binned {:.3f}'.format(
+        rays / max(pixel_lanes, 1), rays / max(binned_lanes, 1)))
+    # the type and slot, or the type and all the columns
+    typed = np.array([8 + 4 * sum(COLUMNS[name][0] for name in c.params)
+                      for c in MATERIAL_CLASSES])
+    flat = 4 + 4 * sum(size for size, _ in COLUMNS.values())
+    print('parameter bytes per shade {:.1f} all columns {}'.format(
+        (shaded * typed).sum() / max(rays, 1), flat))
+
+    for name in args.renderers:
+        renderer = RENDERERS[name](world, make_camera(aspect_ratio),
+                                   args.width, height, args.spp,
+                                   args.max_depth, pass_batch=args.pass_batch)
+        renderer.compile()
+        renderer.render()
+        print('{:10s} render {:6.2f}s'.format(name,
+                                               renderer.stats['render_time']))
+
+
+def bench_motion(args):
+    ''' Render time of the main.py scene with static and with moving
+        spheres, the moving ones are blurred in the same number of samples '''
+    aspect_ratio = 3.0 / 2.0
+    height = int(args.width / aspect_ratio)
+    cam = make_camera(aspect_ratio)
+    renderer_class = RENDERERS[args.renderers[0]]
+
+    for motion_blur in (False, True):
+        random.seed(args.seed)
+        world = make_world(motion_blur)
+        world.commit(**MODES[args.modes[0]])
+        renderer = renderer_class(world, cam, args.width, height, args.spp,
+                                  args.max_depth, pass_batch=args.pass_batch)
+        renderer.render()
+        renderer.render()
+        print('{:8s} render {:7.2f}s bvh sah {:.3f}'.format(
+            'moving' if motion_blur else 'static',
+            renderer.stats['render_time'], world.bvh.stats['sah_cost']))
+
+
+def bench_views(args):
+    ''' Time of rendering args.views turntable views of the main.py scene as
+        separate renders, each building the bvh and compiling its kernels,
+        and as one render of a camera with all the views '''
+    from main import turntable, BOOK_CAMERA
+    aspect_ratio = 3.0 / 2.0
+    height = int(args.width / aspect_ratio)
+    renderer_class = RENDERERS[args.renderers[0]]
+    views = turntable(BOOK_CAMERA, args.views)
+
+    def render(cameras):
+        t = time()
+        random.seed(args.seed)
+        world = make_world()
+        world.commit(**MODES[args.modes[0]])
+        bvh_time = time() - t
+        renderer = renderer_class(world, make_camera(aspect_ratio, cameras),
+                                  args.width, height * len(cameras),
+                                  args.spp, args.max_depth,
+                                  pass_batch=args.pass_batch,
+                                  frame_height=height)
+        compile_time = renderer.compile()
+        renderer.render()
+        return np.array(
+            [bvh_time, compile_time, renderer.stats['render_time']])
+
+    separate = sum(render([view]) for view in views)
+    batched = render(views)
+    for name, times in (('separate', separate), ('batched', batched)):
+        print('{:8s} {} views bvh {:6.2f}s compile {:6.2f}s render {:6.2f}s '
+              'total {:6.2f}s'.format(name, args.views, *times, times.sum()))
+
+
+def bench_commit(args):
+    ''' Time of each step of committing random spheres added with
+        add_many '''
+    from hittable import World
+    from material import Lambert, Metal, Dielectric
+    rng = np.random.default_rng(args.seed)
+    for count in args.counts:
+        for mode in args.modes:
+            world = World()
+            material_ids = [
+                world.add_material(m)
+                for m in (Lambert([0.5, 0.5, 0.5]),
+                          Metal([0.7, 0.6, 0.5], 0.1), Dielectric(1.5))
+            ]
+            extent = count**(1 / 3)
+            world.add_many(rng.uniform(-extent, extent, (count, 3)),
+                           np.full(count, 0.2),
+                           rng.choice(material_ids, count))
+            world.commit(**MODES[mode])
+            print('{:8d} spheres {:10s} commit {:6.2f}s gather {:5.2f}s '
+                  'bvh {:6.2f}s upload {:5.2f}s'.format(
+                      count, mode, world.stats['commit_time'],
+                      world.stats['gather_time'], world.stats['bvh_time'],
+                      world.stats['upload_time']))
+
+
+def bench_animate(args):
+    ''' Time per frame of updating random spheres with a refit, against
+        rebuilding the bvh every frame, for a turntable rotating the whole
+        scene and for particles moving independently '''
+    from hittable import World
+    from material import Lambert
+    rng = np.random.default_rng(args.seed)
+    count = args.counts[0]
+    extent = count**(1 / 3)
+    start = rng.uniform(-extent, extent, (count, 3)).astype(np.float32)
+    velocity = rng.normal(0.0, 0.05, (count, 3)).astype(np.float32)
+    angle = 2.0 * np.pi / args.frames
+
+    def turntable(center, frame):
+        c, s = np.cos(angle * frame), np.sin(angle * frame)
+        x, z = start[:, 0], start[:, 2]
+        return np.stack((c * x + s * z, start[:, 1], c * z - s * x), axis=1)
+
+    def particles(center, frame):
+        return center + velocity
+
+    for name, move in (('turntable', turntable), ('particles', particles)):
+        for mode in args.modes:
+            world = World()
+            material = world.add_material(Lambert([0.5, 0.5, 0.5]))
+            world.add_many(start, np.full(count, 0.2),
+                           np.full(count, material))
+            world.commit(dynamic=True, **MODES[mode])
+            center = start
+            update_time = 0.0
+            for frame in range(1, args.frames + 1):
+                center = move(center, frame)
+                world.update(center)
+                update_time += world.stats['update_time']
+
+            t = time()
+            world.rebuild()
+            rebuild_time = time() - t
+            print('{:10s} {:10s} update {:7.4f}s/frame rebuild {:7.4f}s '
+                  'rebuilds {:3d}/{} sah {:.2f}'.format(
+                      name, mode, update_time / args.frames, rebuild_time,
+                      world.stats.get('rebuilds', 0) - 1, args.frames,
+                      world.stats['refit_sah_cost']))
+
+
+def field_bytes(obj, seen=None):
+    ''' Device memory of the taichi fields held by obj, its attributes and
+        their attributes.  Every field type in this repo is 32 bit. '''
+    seen = set() if seen is None else seen
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    if isinstance(obj, ti.Field):
+        return 4 * int(np.prod(obj.shape)) * getattr(obj, 'n', 1) * getattr(
+            obj, 'm', 1)
+    if isinstance(obj, (list, tuple)):
+        return sum(field_bytes(item, seen) for item in obj)
+    if hasattr(obj, '__dict__') and not isinstance(obj, type):
+        return sum(field_bytes(item, seen) for item in vars(obj).values())
+    return 0
+
+
+def bench_instances(args):
+    ''' Commit time, device memory and Mrays/s of a grid of randomly
+        rotated copies of a cluster of spheres, as instances and as one
+        flat world of all the spheres.  args.counts are the numbers of
+        copies, the flat world is skipped past 10^6 spheres. '''
+    from hittable import World
+    from instance import InstancedWorld
+    from material import Lambert, Metal, Dielectric
+    from camera import Camera
+    rng = np.random.default_rng(args.seed)
+    cluster = 64
+    centers = rng.uniform(-1.0, 1.0, (cluster, 3))
+    radii = rng.uniform(0.05, 0.2, cluster)
+    materials = (Lambert([0.5, 0.5, 0.5]), Metal([0.7, 0.6, 0.5], 0.1),
+                 Dielectric(1.5))
+    choice = rng.integers(0, len(materials), cluster)
+    aspect_ratio = 3.0 / 2.0
+    height = int(args.width / aspect_ratio)
+
+    def add_cluster(world, centers, radii):
+        ids = np.array([world.add_material(m) for m in materials])
+        world.add_many(centers, radii, np.tile(ids[choice],
+                                               len(radii) // cluster))
+
+    for count in args.counts:
+        side = int(np.ceil(np.sqrt(count)))
+        angle = rng.uniform(0.0, 2.0 * np.pi, count)
+        c, s = np.cos(angle), np.sin(angle)
+        transforms = np.zeros((count, 3, 4))
+        transforms[:, 0, 0] = transforms[:, 2, 2] = c
+        transforms[:, 0, 2] = s
+        transforms[:, 2, 0] = -s
+        transforms[:, 1, 1] = 1.0
+        transforms[:, 0, 3] = 3.0 * (np.arange(count) % side - side / 2)
+        transforms[:, 2, 3] = 3.0 * (np.arange(count) // side - side / 2)
+        extent = 1.5 * side
+        cam = Camera(Point(0.0, extent, 2.0 * extent), Point(0.0, 0.0, 0.0),
+                     Vector(0.0, 1.0, 0.0), 40.0, aspect_ratio, 0.0, extent)
+
+        t = time()
+        prototype = World()
+        add_cluster(prototype, centers, radii)
+        prototype.commit(**MODES[args.modes[0]])
+        instanced = InstancedWorld()
+        instanced.add_instances(instanced.add_prototype(prototype),
+                                transforms)
+        instanced.commit()
+        worlds = [('instanced', instanced, time() - t)]
+
+        if count * cluster <= 10**6:
+            t = time()
+            flat = World()
+            add_cluster(flat, (np.einsum('nij,mj->nmi', transforms[:, :, :3],
+                                         centers) +
+                               transforms[:, None, :, 3]).reshape(-1, 3),
+                        np.tile(radii, count))
+            flat.commit(**MODES[args.modes[0]])
+            worlds.append(('flat', flat, time() - t))
+
+        for name, world, commit_time in worlds:
+            trace = make_trace_kernel(world, cam, args.width, height,
+                                      args.max_depth)
+            trace()
+            t = time()
+            num_rays = 0
+            for _ in range(args.passes):
+                num_rays += trace()
+            print('{:8d} copies {:9s} commit {:6.2f}s memory {:8.2f}MB '
+                  '{:8.3f} Mrays/s'.format(
+                      count, name, commit_time, field_bytes(world) / 2**20,
+                      num_rays / (time() - t) / 1e6))
+
+
+def make_torus(num_triangles):
+    ''' The vertices and faces of a torus of about num_triangles '''
+    nu = max(int(np.sqrt(num_triangles)), 3)
+    nv = max(num_triangles // (2 * nu), 3)
+    u, v = np.meshgrid(np.arange(nu) * 2.0 * np.pi / nu,
+                       np.arange(nv) * 2.0 * np.pi / nv, indexing='ij')
+    ring = 1.0 + 0.4 * np.cos(v)
+    vertices = np.stack((ring * np.cos(u), 0.4 * np.sin(v), ring * np.sin(u)),
+                        axis=-1).reshape(-1, 3)
+    i, j = np.meshgrid(np.arange(nu), np.arange(nv), indexing='ij')
+    a = i * nv + j
+    b = (i + 1) % nu * nv + j
+    c = (i + 1) % nu * nv + (j + 1) % nv
+    d = i * nv + (j + 1) % nv
+    faces = np.concatenate((np.stack((a, b, c), axis=-1).reshape(-1, 3),
+                            np.stack((a, c, d), axis=-1).reshape(-1, 3)))
+    return vertices, faces
+
+
+def bench_mesh(args):
+    ''' Load time of obj and ply files of a torus with args.counts
+        triangles, and commit time and Mrays/s of each bvh mode '''
+    import os
+    import tempfile
+    from hittable import World
+    from material import Lambert
+    from camera import Camera
+    from mesh import load_mesh, write_obj, write_ply
+    aspect_ratio = 3.0 / 2.0
+    height = int(args.width / aspect_ratio)
+    cam = Camera(Point(0.0, 2.0, 3.0), Point(0.0, 0.0, 0.0),
+                 Vector(0.0, 1.0, 0.0), 40.0, aspect_ratio, 0.0, 3.0)
+
+    with tempfile.TemporaryDirectory() as directory:
+        for count in args.counts:
+            vertices, faces = make_torus(count)
+            loads = []
+            for name, write in (('torus.obj', write_obj),
+                                ('torus.ply', write_ply)):
+                path = os.path.join(directory, name)
+                write(path, vertices, faces)
+                t = time()
+                vertices, faces = load_mesh(path)
+                loads.append(time() - t)
+
+            for mode in args.modes:
+                world = World()
+                world.add_mesh(vertices, faces,
+                               world.add_material(Lambert([0.5, 0.5, 0.5])))
+                world.add_many([[0.0, -1000.4, 0.0]], [1000.0],
+                               [world.add_material(Lambert([0.4, 0.2, 0.2]))])
+                world.commit(**MODES[mode])
+                trace = make_trace_kernel(world, cam, args.width, height,
+                                          args.max_depth)
+                trace()
+                t = time()
+                num_rays = 0
+                for _ in range(args.passes):
+                    num_rays += trace()
+                print('{:8d} triangles obj {:5.2f}s ply {:5.2f}s {:8s} '
+                      'commit {:6.2f}s {:8.3f} Mrays/s'.format(
+                          len(faces), loads[0], loads[1], mode,
+                          world.stats['commit_time'],
+                          num_rays / (time() - t) / 1e6))
+
+
+def suite_worker(args, threads, conn):
+    ''' Run the suite sweep in a taichi runtime with threads cpu threads
+        and send the results back over conn '''
+    options = {}
+    if threads:
+        options = dict(cpu_max_num_threads=threads)
+    ti.init(arch=getattr(ti, args.arch), **options)
+    aspect_ratio = 3.0 / 2.0
+    cam = make_camera(aspect_ratio)
+    results = []
+    for count in args.counts:
+        grid = max(int(np.ceil(np.sqrt(max(count - 4, 1)) / 2)), 1)
+        for mode in args.modes:
+            random.seed(args.seed)
+            t = time()
+            world = make_world(grid=grid)
+            scene_time = time() - t
+            world.commit(**MODES[mode])
+            for renderer_name in args.renderers:
+                renderer_class = RENDERERS[renderer_name]
+                for width, spp, max_depth in itertools.product(
+                        args.widths, args.spps, args.depths):
+                    height = int(width / aspect_ratio)
+                    renderer = renderer_class(world, cam, width, height, spp,
+                                              max_depth,
+                                              pass_batch=args.pass_batch,
+                                              seed=args.seed)
+                    compile_time = renderer.compile()
+                    renderer.render()
+                    render_time = renderer.stats['render_time']
+
+                    # the sampler is seeded, so a second render with the
+                    # counters compiled in traces the same rays
+                    counted = renderer_class(world, cam, width, height, spp,
+                                             max_depth,
+                                             pass_batch=args.pass_batch,
+                                             seed=args.seed, instrument=True)
+                    counted.render()
+                    world.set_counters(None)
+
+                    result = {
+                        'arch': args.arch,
+                        'threads': threads,
+                        'spheres': world.n,
+                        'mode': mode,
+                        'renderer': renderer_name,
+                        'width': width,
+                        'height': height,
+                        'spp': spp,
+                        'max_depth': max_depth,
+                        'scene_time': scene_time,
+                        'bvh_time': world.bvh.stats['build_time'],
+                        'commit_time': world.stats['commit_time'],
+                        'compile_time': compile_time,
+                        'render_time': render_time,
+                        'rays': counted.stats['rays'],
+                        'mrays_per_second':
+                        counted.stats['rays'] / render_time / 1e6,
+                        'nodes_per_ray': counted.stats['nodes_per_ray'],
+                        'tests_per_ray': counted.stats['tests_per_ray'],
+                    }
+                    print('{threads} threads {spheres:8d} spheres {mode:8s} '
+                          '{renderer:10s} {width:5d}x{height:<5d} spp '
+                          '{spp:4d} depth {max_depth:3d} bvh {bvh_time:6.2f}s '
+                          'compile {compile_time:5.2f}s render '
+                          '{render_time:7.2f}s {mrays_per_second:7.3f} '
+                          'Mrays/s'.format(**result))
+                    results.append(result)
+    conn.send(results)
+    conn.close()
+
+
+def machine_info():
+    ''' What the results of the suite depend on besides its settings '''
+    import os
+    import platform
+    import subprocess
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'],
+                                capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))
+                                ).stdout.strip()
+    except OSError:
+        commit = None
+    return {
+        'platform': platform.platform(),
+        'processor': platform.processor(),
+        'cpu_count': os.cpu_count(),
+        'python': platform.python_version(),
+        'taichi': '.'.join(str(v) for v in ti.__version__),
+        'commit': commit,
+    }
+
+
+def bench_suite(args):
+    ''' Sweep the sphere count of the main.py scene generator, bvh mode,
+        renderer, resolution, samples per pixel, max depth and cpu thread
+        count, timing the bvh build, kernel compile and render of each and
+        counting its rays.  Each thread count runs in its own process with
+        its own taichi runtime.  The results go to args.output as json. '''
+    import multiprocessing
+    from instrument import write_stats
+    context = multiprocessing.get_context('spawn')
+    thread_counts = args.thread_counts if args.arch == 'cpu' else [None]
+    results = []
+    for threads in thread_counts:
+        receiver, sender = context.Pipe(duplex=False)
+        process = context.Process(target=suite_worker,
+                                  args=(args, threads, sender))
+        process.start()
+        sender.close()
+        try:
+            results.extend(receiver.recv())
+        except EOFError:
+            raise RuntimeError('the suite failed with {} threads'.format(
+                threads))
+        process.join()
+
+    settings = {
+        name: getattr(args, name)
+        for name in ('counts', 'modes', 'renderers', 'widths', 'spps',
+                     'depths', 'thread_counts', 'pass_batch', 'seed', 'arch')
+    }
+    write_stats(args.output, {
+        'machine': machine_info(),
+        'settings': settings,
+        'results': results
+    })
+    print('wrote', args.output)
+
+
+def bench_warm_start(args):
+    ''' Kernel compile and startup times of main.py runs sharing a new
+        offline cache: a cold start, the same settings again, then other
+        samples, depths and sizes that should all load the cached
+        kernels.  Each run is its own process, in a scratch directory so
+        out.png is left alone. '''
+    import json
+    import os
+    import subprocess
+    import sys
+    import tempfile
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          'main.py')
+    runs = [
+        ('cold', []),
+        ('warm', []),
+        ('spp x2', ['--spp', str(args.spp * 2)]),
+        ('depth / 2', ['--max-depth', str(max(args.max_depth // 2, 1))]),
+        ('width - 10%', ['--width', str(args.width * 9 // 10)]),
+    ]
+    with tempfile.TemporaryDirectory() as scratch:
+        for name, extra in runs:
+            stats_path = os.path.join(scratch, 'stats.json')
+            command = [
+                sys.executable, script, '--arch', args.arch, '--width',
+                str(args.width), '--spp', str(args.spp), '--max-depth',
+                str(args.max_depth), '--renderer', args.renderers[0],
+                '--seed', str(args.seed), '--kernel-cache',
+                os.path.join(scratch, 'cache'), '--warm-start',
+                '--stats-json', stats_path
+            ] + extra
+            subprocess.run(command, cwd=scratch, check=True,
+                           capture_output=True)
+            with open(stats_path) as f:
+                timings = json.load(f)['timings']
+            print('{:12s} compile {:6.2f}s startup {:6.2f}s '
+                  'render {:6.2f}s'.format(name, timings['compile_time'],
+                                           timings['startup_time'],
+                                           timings['render_time']))
+
+
+def bench_distributed(args):
+    ''' Render time of the distributed renderer with 1 up to args.workers
+        local worker processes, includes starting the workers '''
+    aspect_ratio = 3.0 / 2.0
+    height = int(args.width / aspect_ratio)
+    times = {}
+    for num_workers in range(1, args.workers + 1):
+        coordinator = Coordinator(args.width, height, args.spp,
+                                  args.max_depth, tile_size=args.tile_size,
+                                  sample_slices=args.slices,
+                                  renderer=args.renderers[0],
+                                  scene_seed=args.seed, threads=args.threads,
+                                  pass_batch=args.pass_batch)
+        coordinator.render(num_workers, seed=args.seed)
+        times[num_workers] = coordinator.stats['render_time']
+        print('{:3d} workers render {:7.2f}s speedup {:5.2f} jobs {}'.format(
+            num_workers, times[num_workers], times[1] / times[num_workers],
+            coordinator.stats['jobs_per_worker']))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='ray tracer benchmarks')
+    parser.add_argument(
+        'bench', choices=[
+            'traversal', 'occlusion', 'render', 'adaptive', 'sampler',
+            'motion', 'commit', 'animate', 'instances', 'mesh',
+            'distributed', 'suite', 'warm_start', 'roulette', 'views',
+            'denoise', 'materials', 'lights'
+        ])
+    parser.add_argument('--arch', default='gpu', choices=['cpu', 'gpu'])
+    parser.add_argument('--width', type=int, default=600)
+    parser.add_argument('--passes', type=int, default=16)
+    parser.add_argument('--max-depth', type=int, default=16)
+    parser.add_argument('--spp', type=int, default=64)
+    parser.add_argument('--pass-batch', type=int, default=16)
+    parser.add_argument('--reference-spp', type=int, default=1024)
+    parser.add_argument('--thresholds', type=float, nargs='+',
+                        default=[0.05, 0.02])
+    parser.add_argument('--counts', type=int, nargs='+',
+                        default=[10**4, 10**5, 10**6],
+                        help='sphere counts of the commit and suite '
+                        'benches, the first is used by the animate bench, '
+                        'copies of the instances bench, triangles of the '
+                        'mesh bench')
+    parser.add_argument('--frames', type=int, default=60)
+    parser.add_argument('--views', type=int, default=4,
+                        help='turntable views of the views bench')
+    parser.add_argument('--lights', type=int, default=12,
+                        help='lamps of the lights bench')
+    parser.add_argument('--sky', type=float, default=0.0,
+                        help='background brightness of the lights bench')
+    parser.add_argument('--warp', type=int, default=32,
+                        help='lanes per warp of the materials bench')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--threads', type=int, default=None,
+                        help='cpu threads per distributed worker')
+    parser.add_argument('--tile-size', type=int, default=0)
+    parser.add_argument('--slices', type=int, default=8)
+    parser.add_argument('--widths', type=int, nargs='+', default=[300],
+                        help='image widths of the suite')
+    parser.add_argument('--spps', type=int, nargs='+', default=[16],
+                        help='samples per pixel of the suite and the '
+                        'denoise bench')
+    parser.add_argument('--depths', type=int, nargs='+', default=[16],
+                        help='max depths of the suite')
+    parser.add_argument('--thread-counts', type=int, nargs='+', default=[1],
+                        help='cpu thread counts of the suite')
+    parser.add_argument('--output', default='benchmark.json',
+                        help='results of the suite')
+    parser.add_argument('--roulette-depths', type=int, nargs='+',
+                        default=[0, 1, 3, 5],
+                        help='roulette depths of the roulette bench')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--modes', nargs='+', default=list(MODES),
+                        choices=list(MODES))
+    parser.add_argument('--renderers', nargs='+', default=list(RENDERERS),
+                        choices=list(RENDERERS))
+    args = parser.parse_args()
+
+    if args.bench == 'distributed':
+        # the workers have their own taichi runtimes
+        bench_distributed(args)
+    elif args.bench == 'suite':
+        bench_suite(args)
+    elif args.bench == 'warm_start':
+        # every run starts its own process
+        bench_warm_start(args)
+    else:
+        ti.init(arch=getattr(ti, args.arch))
+    if args.bench == 'traversal':
+        bench_traversal(args)
+    elif args.bench == 'occlusion':
+        bench_occlusion(args)
+    elif args.bench == 'render':
+        bench_render(args)
+    elif args.bench == 'adaptive':
+        bench_adaptive(args)
+    elif args.bench == 'sampler':
+        bench_sampler(args)
+    elif args.bench == 'motion':
+        bench_motion(args)
+    elif args.bench == 'denoise':
+        bench_denoise(args)
+    elif args.bench == 'materials':
+        bench_materials(args)
+    elif args.bench == 'lights':
+        bench_lights(args)
+    elif args.bench == 'roulette':
+        bench_roulette(args)
+    elif args.bench == 'views':
+        bench_views(args)
+    elif args.bench == 'commit':
+        bench_commit(args)
+    elif args.bench == 'animate':
+        bench_animate(args)
+    elif args.bench == 'instances':
+        bench_instances(args)
+    elif args.bench == 'mesh':
+        bench_mesh(args)
@@ -1,118 +1,317 @@
 import taichi as ti
-import copy
-import random
-
-
-def surrounding_box(box1, box2):
-    ''' Calculates the surround bbox of two bboxes '''
-    box1_min, box1_max = box1
-    box2_min, box2_max = box2
-
-    small = [
-        min(box1_min[0], box2_min[0]),
-        min(box1_min[1], box2_min[1]),
-        min(box1_min[2], box2_min[2])
-    ]
-    big = [
-        max(box1_max[0], box2_max[0]),
-        max(box1_max[1], box2_max[1]),
-        max(box1_max[2], box2_max[2])
-    ]
-    return small, big
-
-
-def sort_obj_list(obj_list):
-    ''' Sort the list of objects along the longest directional span '''
-    def get_x(e):
-        return e.center[0]
-
-    def get_y(e):
-        return e.center[1]
-
-    def get_z(e):
-        return e.center[2]
-
-    centers = [obj.center for obj in obj_list]
-    min_center = [
-        min([center[0] for center in centers]),
-        min([center[1] for center in centers]),
-        min([center[2] for center in centers])
-    ]
-    max_center = [
-        max([center[0] for center in centers]),
-        max([center[1] for center in centers]),
-        max([center[2] for center in centers])
-    ]
-    span_x, span_y, span_z = (max_center[0] - min_center[0],
-                              max_center[1] - min_center[1],
-                              max_center[2] - min_center[2])
-    if span_x >= span_y and span_x >= span_z:
-        obj_list.sort(key=get_x)
-    elif span_y >= span_z:
-        obj_list.sort(key=get_y)
-    else:
-        obj_list.sort(key=get_z)
-    return obj_list
-
-
-class BVHNode:
-    ''' A bvh node for constructing the bvh tree.  Note this is done on CPU '''
-
-    left = None
-    right = None
-    obj = None
-    box_min = box_max = []
-    id = 0
-    parent = None
-    total = 0
-
-    def __init__(self, object_list, parent):
-        self.parent = parent
-        obj_list = copy.copy(object_list)
-
-        span = len(object_list)
-        if span == 1:
-            # one obj, set to sphere bbox
-            self.obj = obj_list[0]
-            self.box_min, self.box_max = obj_list[0].bounding_box
-            self.total = 1
-        else:
-            # set left and right child and this bbox is the sum of two
-            sorted_list = sort_obj_list(obj_list)
-            mid = int(span / 2)
-            self.left = BVHNode(obj_list[:mid], self)
-            self.right = BVHNode(obj_list[mid:], self)
-            self.box_min, self.box_max = surrounding_box(
-                self.left.bounding_box, self.right.bounding_box)
-            self.total = self.left.total + self.right.total + 1
+import numpy as np
+from time import time
+from vector import Vector
+
+# relative costs used by the surface area heuristic
+TRAVERSAL_COST = 1.0
+INTERSECT_COST = 1.0
+
+
+def box_area(box_min, box_max):
+    ''' Surface area of an array of boxes, empty boxes have no area '''
+    d = np.maximum(box_max - box_min, 0.0)
+    return 2.0 * (d[..., 0] * d[..., 1] + d[..., 1] * d[..., 2] +
+                  d[..., 2] * d[..., 0])
+
+
+class FlatTree:
+    ''' The flattened result of a bvh build.  Nodes are numbered depth first
+        so the left child of an internal node is always node + 1 and the
+        "skip" of a node is the next node to walk once its subtree is done.
+        Leaves reference the range [first, first + count) of prim_order. '''
+    def __init__(self, num_nodes, num_prims):
+        self.num_nodes = num_nodes
+        self.num_prims = num_prims
+        self.node_min = np.zeros((num_nodes, 3), dtype=np.float32)
+        self.node_max = np.zeros((num_nodes, 3), dtype=np.float32)
+        self.left = np.full(num_nodes, -1, dtype=np.int32)
+        self.right = np.full(num_nodes, -1, dtype=np.int32)
+        self.parent = np.full(num_nodes, -1, dtype=np.int32)
+        self.skip = np.full(num_nodes, -1, dtype=np.int32)
+        self.axis = np.zeros(num_nodes, dtype=np.int32)
+        self.first = np.zeros(num_nodes, dtype=np.int32)
+        self.count = np.zeros(num_nodes, dtype=np.int32)
+        self.depth = np.zeros(num_nodes, dtype=np.int32)
+        self.prim_order = np.arange(num_prims, dtype=np.int32)
+        self.stats = {}
+
+    # the arrays that make up a tree, in the order they are saved
+    ARRAYS = ('node_min', 'node_max', 'left', 'right', 'parent', 'skip',
+              'axis', 'first', 'count', 'depth', 'prim_order')
+
+    def arrays(self):
+        return {name: getattr(self, name) for name in self.ARRAYS}
+
+    @classmethod
+    def from_arrays(cls, arrays, stats):
+        ''' A tree from the arrays of a saved tree, which can be memmaps '''
+        tree = cls.__new__(cls)
+        for name in cls.ARRAYS:
+            setattr(tree, name, arrays[name])
+        tree.num_nodes = len(tree.left)
+        tree.num_prims = len(tree.prim_order)
+        tree.stats = dict(stats)
+        return tree
 
     @property
-    def bounding_box(self):
-        return self.box_min, self.box_max
-
-    @property
-    def next(self):
-        ''' Returns the next node to walk '''
-        node = self
-
-        while True:
-            if node.parent is not None and node.parent.right is not node:
-                return node.parent.right
-            elif node.parent is None:
-                return None
-            else:
-                node = node.parent
-        return None
+    def is_leaf(self):
+        return self.count > 0
+
+    def obj_ids(self):
+        ''' The object id of every node, -1 for internal nodes.
+            Only valid for trees with a single object per leaf. '''
+        obj_id = np.full(self.num_nodes, -1, dtype=np.int32)
+        leaves = self.is_leaf
+        obj_id[leaves] = self.prim_order[self.first[leaves]]
+        return obj_id
+
+    def sah_cost(self):
+        ''' Expected cost of a random ray hitting the root box '''
+        area = box_area(self.node_min, self.node_max)
+        leaves = self.is_leaf
+        cost = TRAVERSAL_COST * area[~leaves].sum() + \
+            INTERSECT_COST * (area[leaves] * self.count[leaves]).sum()
+        return float(cost / max(area[0], 1e-12))
+
+
+def segment_ranges(starts, counts):
+    ''' Returns the segment index and position of every element of the
+        concatenated ranges [start, start + count) '''
+    offsets = np.cumsum(counts) - counts
+    seg = np.repeat(np.arange(len(counts)), counts)
+    pos = starts[seg] + np.arange(counts.sum()) - offsets[seg]
+    return seg, pos, offsets
+
+
+def find_splits(box_min, box_max, order, starts, counts, num_bins):
+    ''' Find the binned sah split of each range [start, start + count) of
+        the objects.  The boxes are kept in the order of the tree and each
+        range is partitioned in place so the split is a cut of the range.
+        Returns the range bounds, split axis, number of left objects and
+        the cost of the split. '''
+    s = len(starts)
+    seg, pos, offsets = segment_ranges(starts, counts)
+    lo = box_min[pos]
+    hi = box_max[pos]
+    ids = order[pos]
+
+    # bin the centroids along the longest centroid span
+    c = (lo + hi) * 0.5
+    c_min = np.minimum.reduceat(c, offsets)
+    span = np.maximum.reduceat(c, offsets) - c_min
+    split_axis = np.argmax(span, axis=1)
+    rows = np.arange(s)
+    extent = span[rows, split_axis]
+    scale = num_bins / np.where(extent > 0.0, extent, np.inf)
+    c_axis = np.choose(split_axis[seg], c.T)
+    bins = ((c_axis - c_min[rows, split_axis][seg]) * scale[seg]).astype(
+        np.int64)
+    bins = np.clip(bins, 0, num_bins - 1)
+
+    key = seg * num_bins + bins
+    bin_count = np.bincount(key, minlength=s * num_bins).reshape(
+        s, num_bins)
+    flat = (key[:, None] * 3 + np.arange(3)).ravel()
+    bin_min = np.full(s * num_bins * 3, np.inf, dtype=np.float32)
+    bin_max = np.full(s * num_bins * 3, -np.inf, dtype=np.float32)
+    np.minimum.at(bin_min, flat, lo.ravel())
+    np.maximum.at(bin_max, flat, hi.ravel())
+    bin_min = bin_min.reshape(s, num_bins, 3)
+    bin_max = bin_max.reshape(s, num_bins, 3)
+
+    # sweep the bins from both sides, split k puts bins <= k on the left
+    sweep_min = np.minimum.accumulate(bin_min, axis=1)
+    sweep_max = np.maximum.accumulate(bin_max, axis=1)
+    left_count = np.cumsum(bin_count, axis=1)[:, :-1]
+    left_area = box_area(sweep_min[:, :-1], sweep_max[:, :-1])
+    right_count = counts[:, None] - left_count
+    right_area = box_area(
+        np.minimum.accumulate(bin_min[:, ::-1], axis=1)[:, -2::-1],
+        np.maximum.accumulate(bin_max[:, ::-1], axis=1)[:, -2::-1])
+    cost = left_count * left_area + right_count * right_area
+    cost[(left_count == 0) | (right_count == 0)] = np.inf
+    best = np.argmin(cost, axis=1)
+    best_cost = cost[rows, best]
+
+    # degenerate centroids can not be binned, split them in half
+    binned = np.isfinite(best_cost)
+    num_left = np.where(binned, left_count[rows, best], counts // 2)
+    go_left = np.where(binned[seg], bins <= best[seg],
+                       pos - starts[seg] < num_left[seg])
+
+    # stable partition of every range
+    left_rank = np.cumsum(go_left)
+    left_rank -= np.r_[0, left_rank][offsets][seg]
+    right_rank = np.cumsum(~go_left)
+    right_rank -= np.r_[0, right_rank][offsets][seg]
+    dest = starts[seg] + np.where(go_left, left_rank - 1,
+                                  num_left[seg] + right_rank - 1)
+    box_min[dest] = lo
+    box_max[dest] = hi
+    order[dest] = ids
+
+    return (sweep_min[:, -1], sweep_max[:, -1], split_axis, num_left,
+            best_cost)
+
+
+def build_bvh(box_min, box_max, max_leaf_size=1, num_bins=16):
+    ''' Build a bvh over an array of boxes with the binned surface area
+        heuristic.  All nodes at a depth are split at once with numpy so
+        there is no recursion and no per node python work. '''
+    t = time()
+    # working copies, these are reordered along with order
+    box_min = np.array(box_min, dtype=np.float32).reshape(-1, 3)
+    box_max = np.array(box_max, dtype=np.float32).reshape(-1, 3)
+    n = len(box_min)
+    max_nodes = max(2 * n - 1, 1)
+
+    node_min = np.zeros((max_nodes, 3), dtype=np.float32)
+    node_max = np.zeros((max_nodes, 3), dtype=np.float32)
+    left = np.full(max_nodes, -1, dtype=np.int64)
+    right = np.full(max_nodes, -1, dtype=np.int64)
+    parent = np.full(max_nodes, -1, dtype=np.int64)
+    axis = np.zeros(max_nodes, dtype=np.int64)
+    first = np.zeros(max_nodes, dtype=np.int64)
+    count = np.zeros(max_nodes, dtype=np.int64)
+    depth = np.zeros(max_nodes, dtype=np.int64)
+    order = np.arange(n, dtype=np.int64)
+
+    # nodes of the current depth, their range in order
+    active = np.array([0])
+    active_start = np.array([0])
+    active_count = np.array([n])
+    num_nodes = 1
+    levels = []
+
+    while len(active):
+        levels.append(active)
+        first[active] = active_start
+        count[active] = active_count
+
+        single = active_count == 1
+        node_min[active[single]] = box_min[active_start[single]]
+        node_max[active[single]] = box_max[active_start[single]]
+
+        # only nodes with more than one object are binned, nodes are
+        # batched by size so small nodes get fewer bins
+        split = np.zeros(len(active), dtype=bool)
+        split_axis = np.zeros(len(active), dtype=np.int64)
+        num_left = np.zeros(len(active), dtype=np.int64)
+        size_class = np.minimum(np.log2(np.maximum(active_count, 1)),
+                                np.log2(num_bins)).astype(np.int64)
+        for c in np.unique(size_class[~single]):
+            batch = (size_class == c) & ~single
+            ids = active[batch]
+            starts = active_start[batch]
+            counts = active_count[batch]
+            bins = int(min(num_bins, counts.max()))
+            node_min[ids], node_max[ids], split_axis[batch], num_left[
+                batch], best_cost = find_splits(box_min, box_max, order,
+                                                starts, counts, bins)
+
+            area = box_area(node_min[ids], node_max[ids])
+            split_cost = TRAVERSAL_COST + \
+                INTERSECT_COST * best_cost / np.maximum(area, 1e-12)
+            leaf_cost = INTERSECT_COST * counts
+            split[batch] = (counts > max_leaf_size) | (split_cost < leaf_cost)
+
+        parents = active[split]
+        m = len(parents)
+        left_ids = num_nodes + 2 * np.arange(m)
+        right_ids = left_ids + 1
+        num_nodes += 2 * m
+        left[parents] = left_ids
+        right[parents] = right_ids
+        axis[parents] = split_axis[split]
+        count[parents] = 0
+        parent[left_ids] = parents
+        parent[right_ids] = parents
+        depth[left_ids] = depth[parents] + 1
+        depth[right_ids] = depth[parents] + 1
+
+        start = active_start[split]
+        nl = num_left[split]
+        active = np.stack((left_ids, right_ids), axis=1).ravel()
+        active_start = np.stack((start, start + nl), axis=1).ravel()
+        active_count = np.stack((nl, active_count[split] - nl),
+                                axis=1).ravel()
+
+    # number the nodes depth first, bottom up sizes then top down offsets
+    size = np.ones(num_nodes, dtype=np.int64)
+    for level in reversed(levels):
+        inner = level[left[level] != -1]
+        size[inner] = 1 + size[left[inner]] + size[right[inner]]
+    pre = np.zeros(num_nodes, dtype=np.int64)
+    for level in levels:
+        inner = level[left[level] != -1]
+        pre[left[inner]] = pre[inner] + 1
+        pre[right[inner]] = pre[inner] + 1 + size[left[inner]]
+
+    def renumber(ids):
+        return np.where(ids == -1, -1, pre[np.maximum(ids, 0)])
+
+    tree = FlatTree(num_nodes, n)
+    tree.node_min[pre] = node_min[:num_nodes]
+    tree.node_max[pre] = node_max[:num_nodes]
+    tree.left[pre] = renumber(left[:num_nodes])
+    tree.right[pre] = renumber(right[:num_nodes])
+    tree.parent[pre] = renumber(parent[:num_nodes])
+    tree.axis[pre] = axis[:num_nodes]
+    tree.first[pre] = first[:num_nodes]
+    tree.count[pre] = count[:num_nodes]
+    tree.depth[pre] = depth[:num_nodes]
+    skip = np.arange(num_nodes) + size[np.argsort(pre)]
+    tree.skip[:] = np.where(skip < num_nodes, skip, -1)
+    tree.prim_order[:] = order
+
+    tree.stats = {
+        'build_time': time() - t,
+        'num_prims': n,
+        'num_nodes': num_nodes,
+        'num_leaves': int(tree.is_leaf.sum()),
+        'max_depth': int(tree.depth.max()),
+        'max_leaf_size': int(tree.count.max()),
+        'sah_cost': tree.sah_cost(),
+    }
+    return tree
+
+
+def refit_levels(depth):
+    ''' The nodes sorted deepest first and the (start, end) range of each
+        depth in that order, a refit does one depth at a time so children
+        are done before their parents '''
+    order = np.argsort(-depth, kind='stable').astype(np.int32)
+    counts = np.bincount(depth)[::-1]
+    ends = np.cumsum(counts)
+    levels = [(int(end - count), int(end))
+              for count, end in zip(counts, ends) if count > 0]
+    return order, levels
+
+
+@ti.func
+def node_area(lo, hi):
+    d = ti.max(hi - lo, 0.0)
+    return 2.0 * (d[0] * d[1] + d[1] * d[2] + d[2] * d[0])
+
+
+@ti.func
+def sphere_box(center, radius, velocity):
+    ''' The box of a sphere over its motion '''
+    center1 = center + velocity
+    return ti.min(center, center1) - radius, ti.max(center, center1) + radius
 
 
 @ti.data_oriented
 class BVH:
-    ''' The BVH class takes a list of objects and creates a bvh from them.
-        The bvh structure contains a "next" pointer for walking the tree. '''
-    def __init__(self, object_list):
-        self.root = BVHNode(object_list, None)
+    ''' The BVH class takes the bounding boxes of objects and creates a bvh
+        from them.  The bvh structure contains a "next" pointer for walking
+        the tree.  A tree built before can be passed instead of the boxes. '''
+    def __init__(self, box_min, box_max, tree=None):
+        self.tree = tree or build_bvh(box_min, box_max)
+        self.stats = self.tree.stats
 
-        total = self.root.total
+        total = self.tree.num_nodes
 
         self.bvh_obj_id = ti.field(ti.i32)
         self.bvh_left_id = ti.field(ti.i32)
@@ -120,47 +319,66 @@ class BVH:
         self.bvh_next_id = ti.field(ti.i32)
         self.bvh_min = ti.Vector.field(3, dtype=ti.f32)
         self.bvh_max = ti.Vector.field(3, dtype=ti.f32)
+        self.refit_order = ti.field(ti.i32)
         ti.root.dense(ti.i, total).place(self.bvh_obj_id, self.bvh_left_id,
                                          self.bvh_right_id, self.bvh_next_id,
-                                         self.bvh_min, self.bvh_max)
+                                         self.bvh_min, self.bvh_max,
+                                         self.refit_order)
 
     def build(self):
-        ''' building function. Compress the object list to structure'''
-        i = 0
-
-        # first walk tree and give ids
-        def walk_bvh(node):
-            nonlocal i
-            node.id = i
-            i += 1
-            if node.left:
-                walk_bvh(node.left)
-            if node.right:
-                walk_bvh(node.right)
-
-        walk_bvh(self.root)
-
-        def save_bvh(node):
-            id = node.id
-
-            self.bvh_obj_id[id] = node.obj.id if node.obj is not None else -1
-            self.bvh_left_id[
-                id] = node.left.id if node.left is not None else -1
-            self.bvh_right_id[
-                id] = node.right.id if node.right is not None else -1
-            self.bvh_next_id[
-                id] = node.next.id if node.next is not None else -1
-            self.bvh_min[id] = node.box_min
-            self.bvh_max[id] = node.box_max
-
-            if node.left is not None:
-                save_bvh(node.left)
-            if node.right is not None:
-                save_bvh(node.right)
-
-        save_bvh(self.root)
+        ''' building function. Upload the flattened tree to the fields '''
+        tree = self.tree
+        self.bvh_obj_id.from_numpy(tree.obj_ids())
+        self.bvh_left_id.from_numpy(tree.left)
+        self.bvh_right_id.from_numpy(tree.right)
+        self.bvh_next_id.from_numpy(tree.skip)
+        self.bvh_min.from_numpy(tree.node_min)
+        self.bvh_max.from_numpy(tree.node_max)
+        order, self.levels = refit_levels(tree.depth)
+        self.refit_order.from_numpy(order)
         self.bvh_root = 0
-        dooo = 0
+
+    def set_tree(self, tree):
+        ''' Replace the tree with one over the same objects and upload it.
+            A one object per leaf tree always has the same number of nodes. '''
+        self.tree = tree
+        self.stats = tree.stats
+        self.build()
+
+    @ti.kernel
+    def refit_level(self, center: ti.template(), radius: ti.template(),
+                    velocity: ti.template(), start: ti.i32, end: ti.i32):
+        for j in range(start, end):
+            i = self.refit_order[j]
+            obj_id = self.bvh_obj_id[i]
+            if obj_id != -1:
+                self.bvh_min[i], self.bvh_max[i] = sphere_box(
+                    center[obj_id], radius[obj_id], velocity[obj_id])
+            else:
+                left, right = self.bvh_left_id[i], self.bvh_right_id[i]
+                self.bvh_min[i] = ti.min(self.bvh_min[left],
+                                         self.bvh_min[right])
+                self.bvh_max[i] = ti.max(self.bvh_max[left],
+                                         self.bvh_max[right])
+
+    def refit(self, center, radius, velocity):
+        ''' Recompute the node boxes bottom up for moved spheres without
+            changing the tree, one kernel launch per depth '''
+        for start, end in self.levels:
+            self.refit_level(center, radius, velocity, start, end)
+
+    @ti.kernel
+    def sah_cost(self) -> ti.f32:
+        ''' The sah cost of the boxes on the device, as FlatTree.sah_cost '''
+        cost = 0.0
+        for i in self.bvh_min:
+            area = node_area(self.bvh_min[i], self.bvh_max[i])
+            if self.bvh_obj_id[i] == -1:
+                cost += TRAVERSAL_COST * area
+            else:
+                cost += INTERSECT_COST * area
+        return cost / ti.max(node_area(self.bvh_min[0], self.bvh_max[0]),
+                             1e-12)
 
     @ti.func
     def get_id(self, bvh_id):
@@ -197,3 +415,146 @@ class BVH:
         ''' Gets the obj id, left_id, right_id, next_id for a bvh node '''
         return self.bvh_obj_id[i], self.bvh_left_id[i], self.bvh_right_id[
             i], self.bvh_next_id[i]
+
+
+@ti.func
+def inverse_direction(ray_direction):
+    ''' 1 / direction with zero components nudged so the slabs stay finite '''
+    inv = Vector(0.0, 0.0, 0.0)
+    for i in ti.static(range(3)):
+        d = ray_direction[i]
+        if ti.abs(d) < 1e-8:
+            d = 1e-8 if d >= 0.0 else -1e-8
+        inv[i] = 1.0 / d
+    return inv
+
+
+@ti.data_oriented
+class CompactBVH:
+    ''' A bvh packed into one record per node in depth first order.
+        Each record is the node box and (offset, count, skip, parent).  For
+        an internal node count is -1 - split axis, the left child is the next
+        node and offset is the right child.  A leaf holds up to leaf_size
+        objects at [offset, offset + count) so the objects must be stored in
+        prim_order.  A tree built before can be passed instead of the boxes.
+        With reserve the fields have room for a tree of any shape over the
+        same objects, so set_tree can swap in a rebuilt tree. '''
+    def __init__(self, box_min, box_max, leaf_size=4, tree=None,
+                 reserve=False):
+        self.tree = tree or build_bvh(
+            box_min, box_max, max_leaf_size=leaf_size)
+        self.stats = self.tree.stats
+        self.prim_order = self.tree.prim_order
+
+        # a binary tree with n leaves has 2n - 1 nodes
+        self.capacity = self.tree.num_nodes
+        if reserve:
+            self.capacity = max(2 * self.tree.num_prims - 1, 1)
+        self.node_min = ti.Vector.field(3, dtype=ti.f32)
+        self.node_max = ti.Vector.field(3, dtype=ti.f32)
+        self.node_data = ti.Vector.field(4, dtype=ti.i32)
+        self.refit_order = ti.field(ti.i32)
+        ti.root.dense(ti.i, self.capacity).place(self.node_min,
+                                                 self.node_max,
+                                                 self.node_data,
+                                                 self.refit_order)
+
+    def build(self):
+        ''' Upload the flattened tree to the node records '''
+        tree = self.tree
+        if tree.num_nodes > self.capacity:
+            raise ValueError('tree has {} nodes, room for {}'.format(
+                tree.num_nodes, self.capacity))
+        offset = np.where(tree.is_leaf, tree.first, tree.right)
+        count = np.where(tree.is_leaf, tree.count, -1 - tree.axis)
+        data = np.stack((offset, count, tree.skip, tree.parent), axis=1)
+        order, self.levels = refit_levels(tree.depth)
+
+        def padded(values):
+            out = np.zeros((self.capacity, ) + values.shape[1:],
+                           dtype=values.dtype)
+            out[:tree.num_nodes] = values
+            return out
+
+        self.node_min.from_numpy(padded(tree.node_min))
+        self.node_max.from_numpy(padded(tree.node_max))
+        self.node_data.from_numpy(padded(data.astype(np.int32)))
+        self.refit_order.from_numpy(padded(order))
+
+    def set_tree(self, tree):
+        ''' Replace the tree with one over the same objects and upload it,
+            the objects then have to be stored in the new prim_order '''
+        self.tree = tree
+        self.stats = tree.stats
+        self.prim_order = tree.prim_order
+        self.build()
+
+    @ti.kernel
+    def refit_level(self, center: ti.template(), radius: ti.template(),
+                    velocity: ti.template(), start: ti.i32, end: ti.i32):
+        for j in range(start, end):
+            i = self.refit_order[j]
+            offset, count, skip = self.get_node(i)
+            if count > 0:
+                lo, hi = sphere_box(center[offset], radius[offset],
+                                    velocity[offset])
+                for k in range(offset + 1, offset + count):
+                    k_lo, k_hi = sphere_box(center[k], radius[k], velocity[k])
+                    lo = ti.min(lo, k_lo)
+                    hi = ti.max(hi, k_hi)
+                self.node_min[i] = lo
+                self.node_max[i] = hi
+            else:
+                self.node_min[i] = ti.min(self.node_min[i + 1],
+                                          self.node_min[offset])
+                self.node_max[i] = ti.max(self.node_max[i + 1],
+                                          self.node_max[offset])
+
+    def refit(self, center, radius, velocity):
+        ''' Recompute the node boxes bottom up for moved spheres without
+            changing the tree, one kernel launch per depth '''
+        for start, end in self.levels:
+            self.refit_level(center, radius, velocity, start, end)
+
+    @ti.kernel
+    def sah_cost_nodes(self, num_nodes: ti.i32) -> ti.f32:
+        cost = 0.0
+        for i in range(num_nodes):
+            area = node_area(self.node_min[i], self.node_max[i])
+            count = self.node_data[i][1]
+            if count > 0:
+                cost += INTERSECT_COST * area * count
+            else:
+                cost += TRAVERSAL_COST * area
+        return cost / ti.max(node_area(self.node_min[0], self.node_max[0]),
+                             1e-12)
+
+    def sah_cost(self):
+        ''' The sah cost of the boxes on the device, as FlatTree.sah_cost '''
+        return self.sah_cost_nodes(self.tree.num_nodes)
+
+    @ti.func
+    def get_node(self, i):
+        ''' Gets the offset, count and skip of a node '''
+        data = self.node_data[i]
+        return data[0], data[1], data[2]
+
+    @ti.func
+    def near_far(self, i, inv_direction):
+        ''' The children of an internal node, nearest along the split axis
+            of the ray first.  The left child is on the low side. '''
+        data = self.node_data[i]
+        near, far = i + 1, data[0]
+        axis = -1 - data[1]
+        if inv_direction[axis] < 0.0:
+            near, far = far, near
+        return near, far
+
+    @ti.func
+    def hit_aabb(self, i, ray_origin, inv_direction, t_min, t_max):
+        ''' Slab test against a precomputed inverse direction '''
+        t0 = (self.node_min[i] - ray_origin) * inv_direction
+        t1 = (self.node_max[i] - ray_origin) * inv_direction
+        t_near = ti.max(ti.min(t0, t1).max(), t_min)
+        t_far = ti.min(ti.max(t0, t1).min(), t_max)
+        return t_near <= t_far
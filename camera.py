@@ -5,7 +5,33 @@ import math
 
 @ti.data_oriented
 class Camera:
-    def __init__(self, vfrom, at, up, fov, aspect_ratio, aperture, focus_dist):
+    ''' The camera lives in fields rather than in constants of the kernels,
+        so moving it with look does not compile them again.  A camera can
+        have several views, each placed with look(..., view=i), that a
+        Renderer traces in the same launches.  They all start as the view
+        given here. '''
+    def __init__(self, vfrom, at, up, fov, aspect_ratio, aperture, focus_dist,
+                 time0=0.0, time1=1.0, views=1):
+        self.views = views
+        self.origin = ti.Vector.field(3, dtype=ti.f32)
+        self.horizontal = ti.Vector.field(3, dtype=ti.f32)
+        self.vertical = ti.Vector.field(3, dtype=ti.f32)
+        self.lower_left_corner = ti.Vector.field(3, dtype=ti.f32)
+        self.lens_radius = ti.field(ti.f32)
+        # the shutter is open from time0 to time1
+        self.time0 = ti.field(ti.f32)
+        self.time1 = ti.field(ti.f32)
+        ti.root.dense(ti.i, views).place(self.origin, self.horizontal,
+                                         self.vertical,
+                                         self.lower_left_corner,
+                                         self.lens_radius, self.time0,
+                                         self.time1)
+        for view in range(views):
+            self.look(vfrom, at, up, fov, aspect_ratio, aperture, focus_dist,
+                      time0, time1, view)
+
+    def look(self, vfrom, at, up, fov, aspect_ratio, aperture, focus_dist,
+             time0=0.0, time1=1.0, view=0):
         theta = math.radians(fov)
         h = math.tan(theta / 2.0)
         viewport_height = 2.0 * h
@@ -16,16 +42,30 @@ class Camera:
         u = up.cross(w).normalized()
         v = w.cross(u)
 
-        self.origin = vfrom
-        self.horizontal = focus_dist * viewport_width * u
-        self.vertical = focus_dist * viewport_height * v
-        self.lower_left_corner = self.origin - (self.horizontal / 2.0) \
-                                    - (self.vertical / 2.0) \
+        horizontal = focus_dist * viewport_width * u
+        vertical = focus_dist * viewport_height * v
+        self.origin[view] = vfrom
+        self.horizontal[view] = horizontal
+        self.vertical[view] = vertical
+        self.lower_left_corner[view] = vfrom - (horizontal / 2.0) \
+                                    - (vertical / 2.0) \
                                     - focus_dist * w
-        self.lens_radius = aperture / 2.0
+        self.lens_radius[view] = aperture / 2.0
+        self.time0[view] = time0
+        self.time1[view] = time1
 
     @ti.func
     def get_ray(self, u, v):
-        rd = self.lens_radius * random_in_unit_disk()
+        return self.sample_ray(u, v, ti.random(), ti.random(), ti.random())
+
+    @ti.func
+    def sample_ray(self, u, v, lens_u, lens_v, time_u, view=0):
+        ''' The origin, direction and time of the ray of a view through u, v
+            from the point of the lens picked by the uniform numbers lens_u,
+            lens_v at the time in the shutter interval picked by time_u '''
+        origin = self.origin[view]
+        rd = self.lens_radius[view] * sample_unit_disk(lens_u, lens_v)
         offset = u * rd.x + v * rd.y
-        return self.origin + offset, self.lower_left_corner + u * self.horizontal + v * self.vertical - self.origin - offset
+        time0 = self.time0[view]
+        time = time0 + time_u * (self.time1[view] - time0)
+        return origin + offset, self.lower_left_corner[view] + u * self.horizontal[view] + v * self.vertical[view] - origin - offset, time
@@ -0,0 +1,172 @@
+import taichi as ti
+from vector import *
+from time import time
+
+# the B3 spline of the a-trous wavelet
+KERNEL = [1.0 / 16.0, 1.0 / 4.0, 3.0 / 8.0, 1.0 / 4.0, 1.0 / 16.0]
+
+
+@ti.data_oriented
+class Denoiser:
+    ''' The edge avoiding a-trous wavelet filter of Dammertz et al. run on
+        a finished render of a Renderer made with auxiliary=True.  Each of
+        the iterations blurs with a 5x5 kernel twice as spread out as the
+        last, weighted down across edges of the guide normals, by the
+        distance of a tap from the plane of the guide hit of the pixel
+        relative to its distance along the path, and across changes of
+        luminance large against the standard error of the pixel mean,
+        which is filtered along and blurred 3x3 before use like in SVGF.
+        The guides are taken past mirrors and glass, see Renderer.
+
+        The color is divided by the guide albedo before filtering and
+        multiplied back after, so the filter only blurs the lighting and
+        not the colors of objects.  The result is in output, in the same
+        gamma as Renderer.finish.  More iterations blur the shadows under
+        the spheres of the default scene away, two is about the best. '''
+    def __init__(self, renderer, iterations=2, sigma_color=3.0,
+                 sigma_normal=64.0, sigma_plane=0.01):
+        if not renderer.auxiliary:
+            raise ValueError('the renderer needs auxiliary=True')
+        self.renderer = renderer
+        self.iterations = iterations
+        self.sigma_color = sigma_color
+        self.sigma_normal = sigma_normal
+        self.sigma_plane = sigma_plane
+        self.stats = {}
+        # the buffers of the renderer the kernels read
+        self.pixels = renderer.pixels
+        self.sample_count = renderer.sample_count
+        self.sum_sq = renderer.sum_sq
+        self.albedo = renderer.albedo
+        self.normal = renderer.normal
+        self.position = renderer.position
+        self.distance = renderer.distance
+        self.tile = renderer.tile
+        self.frame_height = renderer.settings.frame_height
+
+        shape = (renderer.image_width, renderer.image_height)
+        # the lighting and its variance, twice to filter from one to the other
+        self.color = [ti.Vector.field(3, dtype=ti.f32) for _ in range(2)]
+        self.variance = [ti.field(dtype=ti.f32) for _ in range(2)]
+        self.output = ti.Vector.field(3, dtype=ti.f32)
+        ti.root.dense(ti.ij, shape).place(*self.color, *self.variance,
+                                          self.output)
+
+    @ti.kernel
+    def demodulate(self):
+        ''' The lighting of the linear pixel means and the variance of its
+            luminance from the samples '''
+        for x, y in self.pixels:
+            n = self.sample_count[x, y]
+            mean = self.pixels[x, y]**2
+            luminance = mean.sum() / 3.0
+            variance = ti.max(self.sum_sq[x, y] / ti.max(n, 1) -
+                              luminance * luminance, 0.0) / ti.max(n - 1, 1)
+            albedo = ti.max(self.albedo[x, y], 1e-3)
+            self.color[0][x, y] = mean / albedo
+            self.variance[0][x, y] = variance / (albedo.sum() / 3.0)**2
+
+    @ti.func
+    def blur_variance(self, x, y, variance: ti.template(), low, high):
+        ''' The variance of a pixel blurred 3x3, the estimate of a single
+            pixel is too noisy to stop the filter at edges with '''
+        tile = self.tile[None]
+        weight_sum = 0.0
+        variance_sum = 0.0
+        for i in ti.static(range(-1, 2)):
+            for j in ti.static(range(-1, 2)):
+                qx = x + i
+                qy = y + j
+                if 0 <= qx < tile[2] and low <= qy < high:
+                    w = ti.cast(
+                        ti.static(KERNEL[i * 2 + 2] * KERNEL[j * 2 + 2]),
+                        ti.f32)
+                    weight_sum += w
+                    variance_sum += w * variance[qx, qy]
+        return variance_sum / weight_sum
+
+    @ti.kernel
+    def filter_step(self, step: ti.i32, color: ti.template(),
+                    variance: ti.template(), out_color: ti.template(),
+                    out_variance: ti.template()):
+        ''' One a-trous iteration with the taps step pixels apart, taps
+            stay in the tile and in the view of the pixel '''
+        tile = self.tile[None]
+        height = self.frame_height[None]
+        for x, y in color:
+            if x < tile[2] and y < tile[3]:
+                # the rows of the view in the buffers
+                top = (tile[1] + y) // height * height - tile[1]
+                low = ti.max(top, 0)
+                high = ti.min(top + height, tile[3])
+
+                luminance = color[x, y].sum() / 3.0
+                normal = self.normal[x, y]
+                position = self.position[x, y]
+                sigma_luminance = self.sigma_color * ti.sqrt(
+                    self.blur_variance(x, y, variance, low, high)) + 1e-6
+                sigma_plane = self.sigma_plane * self.distance[x, y] + 1e-6
+
+                weight_sum = 0.0
+                color_sum = Color(0.0, 0.0, 0.0)
+                variance_sum = 0.0
+                for i in ti.static(range(-2, 3)):
+                    for j in ti.static(range(-2, 3)):
+                        qx = x + i * step
+                        qy = y + j * step
+                        if 0 <= qx < tile[2] and low <= qy < high:
+                            w = ti.cast(
+                                ti.static(KERNEL[i + 2] * KERNEL[j + 2]),
+                                ti.f32)
+                            if ti.static(i != 0 or j != 0):
+                                w *= ti.exp(-ti.abs(
+                                    color[qx, qy].sum() / 3.0 - luminance) /
+                                            sigma_luminance)
+                                w *= ti.max(normal.dot(self.normal[qx, qy]),
+                                            0.0)**self.sigma_normal
+                                w *= ti.exp(-ti.abs(
+                                    normal.dot(self.position[qx, qy] -
+                                               position)) / sigma_plane)
+                            weight_sum += w
+                            color_sum += w * color[qx, qy]
+                            variance_sum += w * w * variance[qx, qy]
+                out_color[x, y] = color_sum / weight_sum
+                out_variance[x, y] = variance_sum / (weight_sum * weight_sum)
+
+    @ti.kernel
+    def remodulate(self, color: ti.template()):
+        for x, y in color:
+            self.output[x, y] = ti.sqrt(
+                color[x, y] * ti.max(self.albedo[x, y], 1e-3))
+
+    def compile(self):
+        ''' Compile the kernels by running them on an empty tile, returns
+            the time it took '''
+        t = time()
+        tile = self.tile.to_numpy()
+        self.renderer.set_tile(0, 0, 0, 0)
+        # both ways between the buffers
+        self.filter(2)
+        self.remodulate(self.color[1])
+        self.tile.from_numpy(tile)
+        return time() - t
+
+    def filter(self, iterations):
+        self.demodulate()
+        for i in range(iterations):
+            self.filter_step(1 << i, self.color[i % 2], self.variance[i % 2],
+                             self.color[(i + 1) % 2],
+                             self.variance[(i + 1) % 2])
+        self.remodulate(self.color[iterations % 2])
+
+    def denoise(self):
+        ''' Filter the finished render into output, stats has the time '''
+        t = time()
+        self.filter(self.iterations)
+        ti.sync()
+        self.stats = {'denoise_time': time() - t}
+
+    def image(self):
+        ''' The denoised tile as a numpy array '''
+        tile = self.tile[None]
+        return self.output.to_numpy()[:tile[2], :tile[3]]
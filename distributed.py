@@ -0,0 +1,241 @@
+import taichi as ti
+import argparse
+import math
+import multiprocessing
+import os
+import queue
+import random
+import threading
+import numpy as np
+from multiprocessing.connection import Listener, Client
+from time import time, sleep
+from render import Renderer
+from wavefront import QueueRenderer
+from sampler import SAMPLERS
+
+RENDERERS = {
+    'megakernel': Renderer,
+    'wavefront': QueueRenderer,
+}
+
+
+def parse_address(address):
+    host, port = address.rsplit(':', 1)
+    return host, int(port)
+
+
+def make_jobs(width, height, tile_size, sample_slices, slice_spp):
+    ''' Split a frame into tiles and every tile into sample slices.
+        A job is the (x, y, width, height) of a tile and the index of the
+        first sample of the slice, so slices get different samples. '''
+    tile_size = tile_size or max(width, height)
+    jobs = []
+    for y in range(0, height, tile_size):
+        for x in range(0, width, tile_size):
+            tile = (x, y, min(tile_size, width - x), min(tile_size, height - y))
+            jobs.extend(tile + (i * slice_spp, ) for i in range(sample_slices))
+    return jobs
+
+
+def run_worker(address, authkey, seed):
+    ''' Connect to a coordinator and render jobs until told to stop.
+        Each worker has its own taichi runtime and random seed. '''
+    from main import make_world, make_camera
+
+    try:
+        conn = Client(address, authkey=authkey)
+        config = conn.recv()
+    except (ConnectionRefusedError, EOFError):
+        # every job was done before this worker got to connect
+        return
+    threads = {}
+    if config['threads']:
+        threads = dict(cpu_max_num_threads=config['threads'])
+    ti.init(arch=ti.cpu, random_seed=seed, **threads)
+
+    # every worker has to build the same scene
+    random.seed(config['scene_seed'])
+    world = make_world()
+    world.commit()
+    cam = make_camera(config['width'] / config['height'])
+    renderer = RENDERERS[config['renderer']](
+        world,
+        cam,
+        min(config['tile_size'] or config['width'], config['width']),
+        min(config['tile_size'] or config['height'], config['height']),
+        config['job_spp'],
+        config['max_depth'],
+        frame_width=config['width'],
+        frame_height=config['height'],
+        **config['options'])
+
+    while True:
+        job = conn.recv()
+        if job is None:
+            break
+        x, y, w, h, first_sample = job
+        renderer.set_tile(x, y, w, h, first_sample)
+        renderer.trace()
+        conn.send((job, renderer.pixels.to_numpy()[:w, :h],
+                   renderer.sample_count.to_numpy()[:w, :h]))
+    conn.close()
+
+
+class Coordinator:
+    ''' Hands out jobs to workers connecting over tcp and merges the
+        returned sums of samples weighted by their sample counts.
+        Local workers are separate processes connecting to localhost, remote
+        ones run "python distributed.py worker" with the same authkey. '''
+    def __init__(self, width, height, samples_per_pixel, max_depth,
+                 tile_size=0, sample_slices=1, renderer='megakernel',
+                 scene_seed=0, threads=None, address=('localhost', 0),
+                 authkey=None, **options):
+        self.width = width
+        self.height = height
+        job_spp = math.ceil(samples_per_pixel / sample_slices)
+        self.jobs = make_jobs(width, height, tile_size, sample_slices, job_spp)
+        self.config = {
+            'width': width,
+            'height': height,
+            'job_spp': job_spp,
+            'max_depth': max_depth,
+            'tile_size': tile_size,
+            'renderer': renderer,
+            'scene_seed': scene_seed,
+            'threads': threads,
+            'options': options,
+        }
+        self.authkey = authkey or os.urandom(16)
+        self.listener = Listener(address, authkey=self.authkey)
+        self.address = self.listener.address
+
+        self.sums = np.zeros((width, height, 3), dtype=np.float64)
+        self.counts = np.zeros((width, height), dtype=np.int64)
+        self.lock = threading.Lock()
+        self.stats = {}
+
+    def serve(self, conn, todo, worker_stats):
+        ''' Feed one worker jobs until there are none left '''
+        conn.send(self.config)
+        num_jobs = 0
+        # jobs of a worker that died are put back, so keep waiting until
+        # every job is merged rather than until the queue is empty
+        while todo.unfinished_tasks:
+            try:
+                job = todo.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            try:
+                conn.send(job)
+                (x, y, w, h, _), sums, counts = conn.recv()
+            except (EOFError, OSError):
+                # the worker died, give the job to another one.  put counts
+                # the job as unfinished again, so the get is done with
+                todo.put(job)
+                todo.task_done()
+                return
+            with self.lock:
+                self.sums[x:x + w, y:y + h] += sums
+                self.counts[x:x + w, y:y + h] += counts
+                todo.task_done()
+            num_jobs += 1
+        conn.send(None)
+        conn.close()
+        worker_stats.append(num_jobs)
+
+    def render(self, num_local_workers=1, seed=0):
+        ''' Start local workers, accept workers until all jobs are merged.
+            Returns the final image. '''
+        t = time()
+        todo = queue.Queue()
+        for job in self.jobs:
+            todo.put(job)
+
+        context = multiprocessing.get_context('spawn')
+        processes = [
+            context.Process(target=run_worker,
+                            args=(self.address, self.authkey, seed + i + 1))
+            for i in range(num_local_workers)
+        ]
+        for process in processes:
+            process.start()
+
+        worker_stats = []
+
+        def accept():
+            while True:
+                try:
+                    conn = self.listener.accept()
+                except OSError:
+                    break
+                threading.Thread(target=self.serve,
+                                 args=(conn, todo, worker_stats),
+                                 daemon=True).start()
+
+        threading.Thread(target=accept, daemon=True).start()
+        while todo.unfinished_tasks:
+            sleep(0.1)
+            if processes and not any(p.is_alive() for p in processes):
+                self.listener.close()
+                raise RuntimeError('all local workers exited')
+        self.listener.close()
+        for process in processes:
+            process.join()
+
+        self.stats = {
+            'render_time': time() - t,
+            'jobs': len(self.jobs),
+            'workers': len(worker_stats),
+            'jobs_per_worker': worker_stats,
+        }
+        return self.image()
+
+    def image(self):
+        return np.sqrt(self.sums / np.maximum(self.counts, 1)[..., None])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='distributed rendering')
+    sub = parser.add_subparsers(dest='command', required=True)
+    render = sub.add_parser('render', help='coordinate a render')
+    render.add_argument('--workers', type=int, default=os.cpu_count(),
+                        help='local worker processes')
+    render.add_argument('--listen', default='localhost:0',
+                        help='address remote workers connect to')
+    render.add_argument('--authkey', default=None)
+    render.add_argument('--width', type=int, default=1200)
+    render.add_argument('--spp', type=int, default=512)
+    render.add_argument('--max-depth', type=int, default=16)
+    render.add_argument('--tile-size', type=int, default=0)
+    render.add_argument('--slices', type=int, default=8,
+                        help='sample slices per tile')
+    render.add_argument('--renderer', default='megakernel',
+                        choices=list(RENDERERS))
+    render.add_argument('--threads', type=int, default=None,
+                        help='cpu threads per worker')
+    render.add_argument('--sampler', default='independent',
+                        choices=SAMPLERS)
+    render.add_argument('--seed', type=int, default=0)
+    worker = sub.add_parser('worker', help='render jobs for a coordinator')
+    worker.add_argument('--connect', required=True)
+    worker.add_argument('--authkey', required=True)
+    worker.add_argument('--seed', type=int, required=True)
+    args = parser.parse_args()
+
+    if args.command == 'worker':
+        run_worker(parse_address(args.connect), args.authkey.encode(),
+                   args.seed)
+    else:
+        aspect_ratio = 3.0 / 2.0
+        coordinator = Coordinator(
+            args.width, int(args.width / aspect_ratio), args.spp,
+            args.max_depth, tile_size=args.tile_size,
+            sample_slices=args.slices, renderer=args.renderer,
+            scene_seed=args.seed, threads=args.threads,
+            address=parse_address(args.listen),
+            authkey=args.authkey.encode() if args.authkey else None,
+            sampler=args.sampler, seed=args.seed)
+        print('listening on', coordinator.address)
+        image = coordinator.render(args.workers, seed=args.seed)
+        print('render', coordinator.stats)
+        ti.imwrite(image.astype(np.float32), 'out.png')
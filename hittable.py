@@ -1,10 +1,12 @@
 import taichi as ti
 from vector import *
 import ray
-from material import Materials
+from material import Materials, material_arrays, dedupe_materials
+import math
 import random
 import numpy as np
-from bvh import BVH
+from time import time
+from bvh import BVH, CompactBVH, build_bvh, inverse_direction
 
 
 @ti.func
@@ -36,19 +38,75 @@ def hit_sphere(center, radius, ray_origin, ray_direction, t_min, t_max):
     return hit, root
 
 
+@ti.func
+def axis_vector(k):
+    return Vector(float(k == 0), float(k == 1), float(k == 2))
+
+
+@ti.func
+def triangle_shear(ray_direction):
+    ''' The matrix moving points relative to the ray origin into the space
+        of the watertight ray triangle test of Woop, Benthin and Wald: the
+        largest axis of the direction becomes z and the ray is sheared onto
+        the z axis, z is scaled by 1 / dz.  Computed once per ray. '''
+    d = abs(ray_direction)
+    kz = 2
+    if d[0] >= d[1] and d[0] >= d[2]:
+        kz = 0
+    elif d[1] >= d[2]:
+        kz = 1
+    kx = (kz + 1) % 3
+    ky = (kx + 1) % 3
+    ez = axis_vector(kz)
+    dz = ray_direction.dot(ez)
+    if dz < 0.0:
+        # keep the winding of the triangle
+        kx, ky = ky, kx
+    ex = axis_vector(kx)
+    ey = axis_vector(ky)
+    return ti.Matrix.rows([
+        ex - ray_direction.dot(ex) / dz * ez,
+        ey - ray_direction.dot(ey) / dz * ez, ez / dz
+    ])
+
+
+@ti.func
+def hit_triangle(v0, v1, v2, ray_origin, shear, t_min, t_max):
+    ''' Watertight intersection of a triangle, shear is the triangle_shear
+        of the ray direction.  Edges shared by two triangles go through the
+        same arithmetic for both, so rays cannot slip between them.
+        Returns if it hit and the distance. '''
+    a = shear @ (v0 - ray_origin)
+    b = shear @ (v1 - ray_origin)
+    c = shear @ (v2 - ray_origin)
+    # scaled barycentric coordinates, all of one sign inside
+    u = c[0] * b[1] - c[1] * b[0]
+    v = a[0] * c[1] - a[1] * c[0]
+    w = b[0] * a[1] - b[1] * a[0]
+    det = u + v + w
+    hit = not ((u < 0.0 or v < 0.0 or w < 0.0) and
+               (u > 0.0 or v > 0.0 or w > 0.0)) and det != 0.0
+    t = -1.0
+    if hit:
+        t = (u * a[2] + v * b[2] + w * c[2]) / det
+        hit = t_min <= t and t <= t_max
+    return hit, t
+
+
 class Sphere:
-    def __init__(self, center, radius, material):
+    ''' A sphere, moving from center at time 0 to center1 at time 1 if
+        center1 is given.  The box covers the whole motion. '''
+    def __init__(self, center, radius, material, center1=None):
         self.center = center
+        self.center1 = center if center1 is None else center1
         self.radius = radius
         self.material = material
         self.id = -1
         self.box_min = [
-            self.center[0] - radius, self.center[1] - radius,
-            self.center[2] - radius
+            min(self.center[i], self.center1[i]) - radius for i in range(3)
         ]
         self.box_max = [
-            self.center[0] + radius, self.center[1] + radius,
-            self.center[2] + radius
+            max(self.center[i], self.center1[i]) + radius for i in range(3)
         ]
 
     @property
@@ -58,67 +116,441 @@ class Sphere:
 
 BRANCH = 1.0
 LEAF = 0.0
+# extra traversal stack for bvhs rebuilt by World.update
+STACK_HEADROOM = 8
 
 
 @ti.data_oriented
 class World:
     def __init__(self):
         self.spheres = []
+        # arrays of centers, radii, material ids and centers at time 1 from
+        # add_many, the spheres from add are turned into one when add_many
+        # is called
+        self.batches = []
+        # arrays of vertices, faces and face material ids from add_mesh
+        self.meshes = []
+        self.num_added = 0
+        self.material_table = []
+        self.material_ids = {}
+        self.counters = None
+        self.counting = False
+        self.stats = {}
+
+    def add_material(self, material):
+        ''' The id of a material object in the material table, each object
+            is added once.  Objects with the same parameters are merged into
+            one entry at commit. '''
+        if id(material) not in self.material_ids:
+            self.material_ids[id(material)] = len(self.material_table)
+            self.material_table.append(material)
+        return self.material_ids[id(material)]
 
     def add(self, sphere):
-        sphere.id = len(self.spheres)
+        sphere.id = self.num_added
+        self.num_added += 1
         self.spheres.append(sphere)
 
-    def commit(self):
+    def add_many(self, centers, radii, material_ids, centers1=None):
+        ''' Add spheres from an (n, 3) array of centers, an array of radii
+            and an array of ids from add_material.  Spheres move to centers1
+            at time 1 if it is given. '''
+        self.flush_spheres()
+        centers = np.asarray(centers, dtype=np.float32).reshape(-1, 3)
+        radii = np.asarray(radii, dtype=np.float32).reshape(-1)
+        material_ids = np.asarray(material_ids, dtype=np.int32).reshape(-1)
+        if centers1 is None:
+            centers1 = centers
+        centers1 = np.asarray(centers1, dtype=np.float32).reshape(-1, 3)
+        self.batches.append((centers, radii, material_ids, centers1))
+        self.num_added += len(radii)
+
+    def add_mesh(self, vertices, faces, material_ids):
+        ''' Add a triangle mesh from an (n, 3) array of vertices and an
+            (m, 3) array of vertex indices, material_ids is one id from
+            add_material or one per face.  Meshes do not move. '''
+        vertices = np.asarray(vertices, dtype=np.float32).reshape(-1, 3)
+        faces = np.asarray(faces, dtype=np.int32).reshape(-1, 3)
+        material_ids = np.broadcast_to(
+            np.asarray(material_ids, dtype=np.int32), len(faces))
+        self.meshes.append((vertices, faces, material_ids))
+
+    def mesh_arrays(self):
+        ''' The vertices, faces and face material ids of all meshes added,
+            with the faces indexing the joined vertices '''
+        vertices = [np.zeros((0, 3), dtype=np.float32)]
+        faces = [np.zeros((0, 3), dtype=np.int32)]
+        material_ids = [np.zeros(0, dtype=np.int32)]
+        num_vertices = 0
+        for mesh_vertices, mesh_faces, mesh_material_ids in self.meshes:
+            vertices.append(mesh_vertices)
+            faces.append(mesh_faces + num_vertices)
+            material_ids.append(mesh_material_ids)
+            num_vertices += len(mesh_vertices)
+        return (np.concatenate(vertices), np.concatenate(faces),
+                np.concatenate(material_ids))
+
+    def flush_spheres(self):
+        ''' Move the spheres from add to a batch of arrays '''
+        if self.spheres:
+            centers = [[s.center[0], s.center[1], s.center[2]]
+                       for s in self.spheres]
+            radii = [s.radius for s in self.spheres]
+            material_ids = [
+                self.add_material(s.material) for s in self.spheres
+            ]
+            centers1 = [[s.center1[0], s.center1[1], s.center1[2]]
+                        for s in self.spheres]
+            self.batches.append((np.array(centers, dtype=np.float32),
+                                 np.array(radii, dtype=np.float32),
+                                 np.array(material_ids, dtype=np.int32),
+                                 np.array(centers1, dtype=np.float32)))
+            self.spheres = []
+
+    def sphere_arrays(self):
+        ''' The centers, radii, material ids and centers at time 1 of all
+            spheres added '''
+        self.flush_spheres()
+        if not self.batches:
+            return (np.zeros((0, 3), dtype=np.float32),
+                    np.zeros(0, dtype=np.float32), np.zeros(0, dtype=np.int32),
+                    np.zeros((0, 3), dtype=np.float32))
+        return tuple(np.concatenate(parts) for parts in zip(*self.batches))
+
+    def commit(self, compact=False, leaf_size=4, traversal='threaded',
+               dynamic=False):
         ''' Commit should be called after all objects added.  
-            Will compile bvh and materials. '''
-        self.n = len(self.spheres)
+            Will compile bvh and materials, materials with the same
+            parameters become one entry of the material table.
+            compact packs the bvh into one record per node with up to
+            leaf_size spheres per leaf.  The spheres are then reordered to
+            match the leaves, prim_order[i] is the original index of sphere i.
+            traversal is 'threaded' to walk the nodes in a fixed order or
+            'ordered' to visit the nearer child first, which needs compact.
+            dynamic keeps room to rebuild the bvh in update, it does not
+            support meshes.
+            stats has the time of each step of the commit. '''
+        t = time()
+        center, radius, material_ids, center1 = self.sphere_arrays()
+        vertices, faces, face_material_ids = self.mesh_arrays()
+        materials, table_ids = dedupe_materials(
+            material_arrays(self.material_table))
+        material_ids = np.concatenate((material_ids, face_material_ids))
+        del self.spheres
+        del self.batches
+        del self.meshes
+        gather_time = time() - t
+
+        self.commit_arrays(center, radius, table_ids[material_ids], materials,
+                           compact, leaf_size, traversal, dynamic=dynamic,
+                           center1=center1, vertices=vertices, faces=faces)
+        self.stats['gather_time'] = gather_time
+        self.stats['commit_time'] = time() - t
 
-        self.materials = Materials(self.n)
-        self.bvh = BVH(self.spheres)
+    def commit_arrays(self, center, radius, material_id, materials,
+                      compact=False, leaf_size=4, traversal='threaded',
+                      tree=None, dynamic=False, center1=None,
+                      vertices=None, faces=None):
+        ''' Commit spheres given as arrays of centers, radii and ids into
+            materials, the material table arrays from
+            material.material_arrays.
+            Spheres move to center1 at time 1 if it is given, the bvh is
+            built over the boxes swept by the motion.  Worlds without motion
+            do not compile any of the motion code.
+            Triangles are given as vertices and faces indexing them, they
+            are numbered after the spheres and material_id has an entry for
+            each of them too.  A bvh leaf can hold both kinds, worlds
+            without triangles do not compile the triangle code.
+            tree is a bvh.FlatTree built before for the same objects,
+            compact and leaf_size, otherwise the bvh is built here.  Every
+            field is uploaded with a single from_numpy. '''
+        if traversal not in ('threaded', 'ordered'):
+            raise ValueError('unknown traversal {}'.format(traversal))
+        if traversal == 'ordered' and not compact:
+            raise ValueError('ordered traversal needs the compact bvh')
+        self.n = len(radius)
+        self.num_triangles = 0 if faces is None else len(faces)
+        self.num_prims = self.n + self.num_triangles
+        if dynamic and self.num_triangles:
+            raise ValueError('dynamic worlds can not have triangles')
+        # the compact bvh reorders the spheres to its leaves, with
+        # triangles the objects stay in place and leaves look them up
+        self.reorder = compact and not self.num_triangles
+        self.compact = compact
+        self.leaf_size = leaf_size
+        self.traversal = traversal
+        self.dynamic = dynamic
+        # the spheres in the order they were added, for update
+        self.host_center = np.asarray(center, dtype=np.float32)
+        self.host_radius = np.asarray(radius, dtype=np.float32)
+        self.host_material_id = np.asarray(material_id, dtype=np.int32)
+        self.host_materials = materials
+        self.host_velocity = np.zeros_like(self.host_center)
+        if center1 is not None:
+            self.host_velocity = np.asarray(center1,
+                                            dtype=np.float32) - center
+        self.has_motion = bool(np.any(self.host_velocity != 0.0))
+
+        t = time()
+        self.materials = Materials(materials)
+        if self.num_triangles:
+            self.host_vertices = np.asarray(vertices, dtype=np.float32)
+            self.host_faces = np.asarray(faces, dtype=np.int32)
+        box_min, box_max = self.boxes()
+        if compact:
+            self.bvh = CompactBVH(box_min, box_max, leaf_size, tree,
+                                  reserve=dynamic)
+            self.prim_order = self.bvh.prim_order
+        else:
+            self.bvh = BVH(box_min, box_max, tree)
+            self.prim_order = np.arange(self.num_prims)
         self.radius = ti.field(ti.f32)
         self.center = ti.Vector.field(3, dtype=ti.f32)
-        ti.root.dense(ti.i, self.n).place(self.radius, self.center)
+        self.velocity = ti.Vector.field(3, dtype=ti.f32)
+        # a world of only triangles still gets one unused sphere
+        ti.root.dense(ti.i, max(self.n, 1)).place(self.radius, self.center,
+                                                  self.velocity)
+        self.material_id = ti.field(ti.i32)
+        ti.root.dense(ti.i, self.num_prims).place(self.material_id)
+        # the emissive spheres are the lights, emissive triangles still
+        # glow when hit but are not sampled
+        self.emissive = np.any(np.asarray(materials['emission']) > 0.0,
+                               axis=1)
+        self.has_emission = bool(np.any(self.emissive[self.host_material_id]))
+        self.num_lights = int(np.count_nonzero(
+            self.emissive[self.host_material_id[:self.n]]))
+        self.lights = ti.field(ti.i32)
+        ti.root.dense(ti.i, max(self.num_lights, 1)).place(self.lights)
+        if self.num_triangles:
+            self.vertices = ti.Vector.field(3, dtype=ti.f32)
+            self.faces = ti.Vector.field(3, dtype=ti.i32)
+            ti.root.dense(ti.i, len(self.host_vertices)).place(self.vertices)
+            ti.root.dense(ti.i, self.num_triangles).place(self.faces)
+            if compact:
+                self.prim_id = ti.field(ti.i32)
+                ti.root.dense(ti.i, self.num_prims).place(self.prim_id)
+
+        bvh_time = time() - t
 
+        t = time()
         self.bvh.build()
+        # one far child per level plus the near child are pending at most,
+        # a rebuilt tree can be a little deeper
+        self.stack_size = self.bvh.stats['max_depth'] + 2
+        if dynamic:
+            self.stack_size += STACK_HEADROOM
 
-        for i in range(self.n):
-            self.center[i] = self.spheres[i].center
-            self.radius[i] = self.spheres[i].radius
-            self.materials.set(i, self.spheres[i].material)
+        self.upload_spheres(material_id=True)
+        if self.num_triangles:
+            self.vertices.from_numpy(self.host_vertices)
+            self.faces.from_numpy(self.host_faces)
+            if compact:
+                self.prim_id.from_numpy(self.prim_order.astype(np.int32))
+        self.stats = {'bvh_time': bvh_time, 'upload_time': time() - t}
 
-        del self.spheres
+    def upload_spheres(self, material_id=False):
+        ''' Upload the host spheres, in the order of the leaves for the
+            compact bvh '''
+        def ordered(values):
+            values = values[self.prim_order] if self.reorder else values
+            if not len(values):
+                return np.zeros((1, ) + values.shape[1:], dtype=values.dtype)
+            return values
+
+        self.center.from_numpy(ordered(self.host_center))
+        self.radius.from_numpy(ordered(self.host_radius))
+        self.velocity.from_numpy(ordered(self.host_velocity))
+        if material_id:
+            values = self.host_material_id
+            self.material_id.from_numpy(
+                values[self.prim_order] if self.reorder else values)
+            self.upload_lights()
+
+    def upload_lights(self):
+        ''' The indices of the emissive spheres, in the order of the leaves
+            for the compact bvh '''
+        values = self.host_material_id[:self.n]
+        if self.reorder:
+            values = values[self.prim_order]
+        if self.num_lights:
+            self.lights.from_numpy(
+                np.flatnonzero(self.emissive[values]).astype(np.int32))
+
+    def sphere_boxes(self):
+        ''' The boxes of the host spheres over their motion '''
+        center1 = self.host_center + self.host_velocity
+        radius = self.host_radius[:, None]
+        return (np.minimum(self.host_center, center1) - radius,
+                np.maximum(self.host_center, center1) + radius)
+
+    def boxes(self):
+        ''' The boxes of all objects, spheres then triangles '''
+        box_min, box_max = self.sphere_boxes()
+        if self.num_triangles:
+            corners = self.host_vertices[self.host_faces]
+            box_min = np.concatenate((box_min, corners.min(axis=1)))
+            box_max = np.concatenate((box_max, corners.max(axis=1)))
+        return box_min, box_max
+
+    def update(self, center=None, radius=None, center1=None,
+               rebuild_threshold=1.5):
+        ''' Move or resize the spheres of a world committed with dynamic,
+            the arrays are in the order the spheres were added.  Spheres
+            keep their motion unless center1 is given, only worlds
+            committed with moving spheres can be given motion.  The bvh
+            boxes are refit to the spheres without changing the tree, the
+            tree is only rebuilt once the sah cost grows past
+            rebuild_threshold times the cost after the last build, or
+            after the last rebuild that was skipped.
+            Returns if the bvh was rebuilt. '''
+        if not self.dynamic:
+            raise ValueError('update needs a world committed with dynamic')
+        t = time()
+        if center is not None:
+            self.host_center = np.asarray(center,
+                                          dtype=np.float32).reshape(-1, 3)
+        if radius is not None:
+            self.host_radius = np.asarray(radius, dtype=np.float32).reshape(-1)
+        if center1 is not None:
+            velocity = np.asarray(center1, dtype=np.float32).reshape(
+                -1, 3) - self.host_center
+            if not self.has_motion and np.any(velocity != 0.0):
+                raise ValueError('the world was committed without motion')
+            self.host_velocity = velocity
+        self.upload_spheres()
+        self.bvh.refit(self.center, self.radius, self.velocity)
+        cost = self.bvh.sah_cost()
+        rebuilt = cost > rebuild_threshold * self.bvh.stats['sah_cost']
+        if rebuilt:
+            rebuilt = self.rebuild()
+        self.stats['update_time'] = time() - t
+        self.stats['refit_sah_cost'] = cost
+        return rebuilt
+
+    def rebuild(self):
+        ''' Build a new bvh for the current spheres into the same fields.
+            With the ordered traversal it is skipped if the new tree is too
+            deep for the stack, the refit tree is then kept as the one the
+            cost of later updates is compared to, so the next rebuild waits
+            until that has grown too.  Returns if it was rebuilt. '''
+        box_min, box_max = self.sphere_boxes()
+        tree = build_bvh(box_min, box_max,
+                         max_leaf_size=self.leaf_size if self.compact else 1)
+        if self.traversal == 'ordered' and (tree.stats['max_depth'] + 2 >
+                                            self.stack_size):
+            self.bvh.stats['sah_cost'] = self.bvh.sah_cost()
+            self.stats['skipped_rebuilds'] = self.stats.get(
+                'skipped_rebuilds', 0) + 1
+            return False
+        self.bvh.set_tree(tree)
+        if self.compact:
+            self.prim_order = self.bvh.prim_order
+            self.upload_spheres(material_id=True)
+        self.stats['rebuilds'] = self.stats.get('rebuilds', 0) + 1
+        return True
 
     def bounding_box(self, i):
         return self.bvh_min(i), self.bvh_max(i)
 
     @ti.func
-    def hit_all(self, ray_origin, ray_direction):
-        ''' Intersects a ray against all objects. '''
+    def sphere_center(self, i, time):
+        ''' The center of sphere i at a time in [0, 1] '''
+        center = self.center[i]
+        if ti.static(self.has_motion):
+            center += time * self.velocity[i]
+        return center
+
+    def set_counters(self, counters):
+        ''' Count the traversals in an instrument.RayCounters, has to be
+            set before the kernels using the world are compiled '''
+        self.counters = counters
+        self.counting = counters is not None
+
+    @ti.func
+    def count_walk(self, nodes, tests):
+        if ti.static(self.counting):
+            self.counters.count_walk(nodes, tests)
+
+    @ti.func
+    def ray_shear(self, ray_direction):
+        ''' The triangle_shear of a ray, only computed with triangles '''
+        shear = ti.Matrix.identity(ti.f32, 3)
+        if ti.static(self.num_triangles):
+            shear = triangle_shear(ray_direction)
+        return shear
+
+    @ti.func
+    def hit_object(self, i, ray_origin, ray_direction, shear, time, t_min,
+                   t_max):
+        ''' Intersect the object at leaf slot i.  Returns if it hit, the
+            distance and the index of the object. '''
+        index = i
+        if ti.static(self.num_triangles and self.compact):
+            index = self.prim_id[i]
+        hit, t = False, t_max
+        if ti.static(not self.num_triangles):
+            hit, t = hit_sphere(self.sphere_center(index, time),
+                                self.radius[index], ray_origin, ray_direction,
+                                t_min, t_max)
+        elif index < self.n:
+            hit, t = hit_sphere(self.sphere_center(index, time),
+                                self.radius[index], ray_origin, ray_direction,
+                                t_min, t_max)
+        else:
+            face = self.faces[index - self.n]
+            hit, t = hit_triangle(self.vertices[face[0]],
+                                  self.vertices[face[1]],
+                                  self.vertices[face[2]], ray_origin, shear,
+                                  t_min, t_max)
+        return hit, t, index
+
+    @ti.func
+    def normal(self, index, p, time):
+        ''' The outward normal of object index at a point p on it, the
+            face normal for triangles '''
+        n = Vector(0.0, 0.0, 0.0)
+        if ti.static(not self.num_triangles):
+            n = (p - self.sphere_center(index, time)) / self.radius[index]
+        elif index < self.n:
+            n = (p - self.sphere_center(index, time)) / self.radius[index]
+        else:
+            face = self.faces[index - self.n]
+            v0 = self.vertices[face[0]]
+            n = (self.vertices[face[1]] - v0).cross(self.vertices[face[2]] -
+                                                    v0).normalized()
+        return n
+
+    @ti.func
+    def walk_threaded(self, ray_origin, ray_direction, time, t_min, t_max,
+                      any_hit: ti.template()):
+        ''' Walk the one object per leaf bvh along the next pointers '''
         hit_anything = False
-        t_min = 0.0001
-        closest_so_far = 9999999999.9
+        closest_so_far = t_max
         hit_index = 0
-        p = Point(0.0, 0.0, 0.0)
-        n = Vector(0.0, 0.0, 0.0)
-        front_facing = True
-        i = 0
+        nodes = 0
+        tests = 0
+        shear = self.ray_shear(ray_direction)
         curr = self.bvh.bvh_root
 
         # walk the bvh tree
         while curr != -1:
+            nodes += 1
             obj_id, left_id, right_id, next_id = self.bvh.get_full_id(curr)
 
             if obj_id != -1:
-                # this is a leaf node, check the sphere
-                hit, t = hit_sphere(self.center[obj_id], self.radius[obj_id],
-                                    ray_origin, ray_direction, t_min,
-                                    closest_so_far)
+                # this is a leaf node, check the object
+                tests += 1
+                hit, t, index = self.hit_object(obj_id, ray_origin,
+                                                ray_direction, shear, time,
+                                                t_min, closest_so_far)
                 if hit:
                     hit_anything = True
                     closest_so_far = t
-                    hit_index = obj_id
+                    hit_index = index
                 curr = next_id
+                if ti.static(any_hit):
+                    if hit_anything:
+                        curr = -1
             else:
                 if self.bvh.hit_aabb(curr, ray_origin, ray_direction, t_min,
                                      closest_so_far):
@@ -132,15 +564,257 @@ class World:
                 else:
                     curr = next_id
 
+        self.count_walk(nodes, tests)
+        return hit_anything, closest_so_far, hit_index
+
+    @ti.func
+    def walk_compact(self, ray_origin, ray_direction, time, t_min, t_max,
+                     any_hit: ti.template()):
+        ''' Walk the compact bvh in depth first order, the left child is
+            the next record and a missed or finished node jumps to skip '''
+        hit_anything = False
+        closest_so_far = t_max
+        hit_index = 0
+        nodes = 0
+        tests = 0
+        inv_direction = inverse_direction(ray_direction)
+        shear = self.ray_shear(ray_direction)
+        curr = 0
+
+        while curr != -1:
+            nodes += 1
+            offset, count, skip = self.bvh.get_node(curr)
+
+            if self.bvh.hit_aabb(curr, ray_origin, inv_direction, t_min,
+                                 closest_so_far):
+                if count > 0:
+                    # leaf node, check its range of objects
+                    for obj_id in range(offset, offset + count):
+                        tests += 1
+                        hit, t, index = self.hit_object(
+                            obj_id, ray_origin, ray_direction, shear, time,
+                            t_min, closest_so_far)
+                        if hit:
+                            hit_anything = True
+                            closest_so_far = t
+                            hit_index = index
+                            if ti.static(any_hit):
+                                break
+                    curr = skip
+                    if ti.static(any_hit):
+                        if hit_anything:
+                            curr = -1
+                else:
+                    curr = curr + 1
+            else:
+                curr = skip
+
+        self.count_walk(nodes, tests)
+        return hit_anything, closest_so_far, hit_index
+
+    @ti.func
+    def walk_ordered(self, ray_origin, ray_direction, time, t_min, t_max,
+                     any_hit: ti.template()):
+        ''' Walk the compact bvh nearest child first with a small stack of
+            far children.  The stack is sized to the depth of the tree. '''
+        hit_anything = False
+        closest_so_far = t_max
+        hit_index = 0
+        nodes = 0
+        tests = 0
+        inv_direction = inverse_direction(ray_direction)
+        shear = self.ray_shear(ray_direction)
+        stack = ti.Vector([0] * ti.static(self.stack_size))
+        stack_top = 1
+
+        while stack_top > 0:
+            stack_top -= 1
+            curr = stack[stack_top]
+            nodes += 1
+            offset, count, skip = self.bvh.get_node(curr)
+
+            if self.bvh.hit_aabb(curr, ray_origin, inv_direction, t_min,
+                                 closest_so_far):
+                if count > 0:
+                    # leaf node, check its range of objects
+                    for obj_id in range(offset, offset + count):
+                        tests += 1
+                        hit, t, index = self.hit_object(
+                            obj_id, ray_origin, ray_direction, shear, time,
+                            t_min, closest_so_far)
+                        if hit:
+                            hit_anything = True
+                            closest_so_far = t
+                            hit_index = index
+                            if ti.static(any_hit):
+                                break
+                    if ti.static(any_hit):
+                        if hit_anything:
+                            stack_top = 0
+                else:
+                    # the near child is popped next, the far one later
+                    near, far = self.bvh.near_far(curr, inv_direction)
+                    stack[stack_top] = far
+                    stack[stack_top + 1] = near
+                    stack_top += 2
+
+        self.count_walk(nodes, tests)
+        return hit_anything, closest_so_far, hit_index
+
+    @ti.func
+    def walk(self, ray_origin, ray_direction, time, t_min, t_max,
+             any_hit: ti.template()):
+        ''' Walk the bvh with the layout and traversal chosen at commit.
+            With any_hit the walk stops at the first object hit. '''
+        hit_anything, closest_so_far, hit_index = False, 0.0, 0
+        if ti.static(self.traversal == 'ordered'):
+            hit_anything, closest_so_far, hit_index = self.walk_ordered(
+                ray_origin, ray_direction, time, t_min, t_max, any_hit)
+        elif ti.static(self.compact):
+            hit_anything, closest_so_far, hit_index = self.walk_compact(
+                ray_origin, ray_direction, time, t_min, t_max, any_hit)
+        else:
+            hit_anything, closest_so_far, hit_index = self.walk_threaded(
+                ray_origin, ray_direction, time, t_min, t_max, any_hit)
+        return hit_anything, closest_so_far, hit_index
+
+    @ti.func
+    def occluded(self, ray_origin, ray_direction, t_max, time):
+        ''' Returns if any object is hit between the origin and t_max at a
+            time in the shutter interval.
+            Cheaper than hit_all as it stops at the first hit and does not
+            compute the hit point or normal. '''
+        hit_anything, _, _ = self.walk(ray_origin, ray_direction, time,
+                                       0.0001, t_max, True)
+        return hit_anything
+
+    @ti.func
+    def hit_all(self, ray_origin, ray_direction, time):
+        ''' Intersects a ray at a time against all objects. '''
+        t_min = 0.0001
+        p = Point(0.0, 0.0, 0.0)
+        n = Vector(0.0, 0.0, 0.0)
+        front_facing = True
+
+        hit_anything, closest_so_far, hit_index = self.walk(
+            ray_origin, ray_direction, time, t_min, 9999999999.9, False)
+
         if hit_anything:
             p = ray.at(ray_origin, ray_direction, closest_so_far)
-            n = (p - self.center[hit_index]) / self.radius[hit_index]
+            n = self.normal(hit_index, p, time)
             front_facing = is_front_facing(ray_direction, n)
             n = n if front_facing else -n
 
         return hit_anything, p, n, front_facing, hit_index
 
     @ti.func
-    def scatter(self, ray_direction, p, n, front_facing, index):
+    def scatter(self, ray_direction, p, n, front_facing, index, rnd):
         ''' Get the scattered direction for a ray hitting an object '''
-        return self.materials.scatter(index, ray_direction, p, n, front_facing)
+        return self.materials.scatter(self.material_id[index], ray_direction,
+                                      p, n, front_facing, rnd)
+
+    @ti.func
+    def scatter_as(self, mat_index: ti.template(), ray_direction, p, n,
+                   front_facing, index, rnd):
+        ''' scatter for an object known to have material type mat_index '''
+        return self.materials.scatter_as(mat_index, self.material_id[index],
+                                         ray_direction, p, n, front_facing,
+                                         rnd)
+
+    @ti.func
+    def material_type(self, index):
+        ''' The material type of an object '''
+        return self.materials.mat_index[self.material_id[index]]
+
+    @ti.func
+    def is_specular(self, index):
+        return self.materials.is_specular(self.material_id[index])
+
+    @ti.func
+    def emitted(self, index):
+        ''' The light an object emits '''
+        return self.materials.emitted(self.material_id[index])
+
+    @ti.func
+    def eval(self, index, in_direction, n, out_direction):
+        ''' The bsdf times the cosine and the scatter pdf of an object, see
+            material._material.eval '''
+        return self.materials.eval(self.material_id[index], in_direction, n,
+                                   out_direction)
+
+    @ti.func
+    def is_light(self, index):
+        ''' If an emissive object is one of the lights, the spheres are '''
+        return index < self.n
+
+    @ti.func
+    def light_cone(self, p, i, time):
+        ''' The vector from p to the center of sphere i and one minus the
+            cosine of the cone of directions to the sphere seen from p,
+            zero if p is inside it '''
+        d = self.sphere_center(i, time) - p
+        sin2 = self.radius[i]**2 / d.norm_sqr()
+        one_minus_cos = 0.0
+        if sin2 < 1.0:
+            # 1 - sqrt(1 - sin2) without cancelling for far spheres
+            one_minus_cos = sin2 / (1.0 + ti.sqrt(1.0 - sin2))
+        return d, one_minus_cos
+
+    @ti.func
+    def light_weight(self, p, i, time):
+        ''' The light sphere i sends to p if it is not in the way, its
+            luminance times the solid angle it covers over 2 pi '''
+        _, one_minus_cos = self.light_cone(p, i, time)
+        return self.emitted(i).sum() / 3.0 * one_minus_cos
+
+    @ti.func
+    def light_pdf(self, p, index, time):
+        ''' The pdf in solid angle of sample_light picking the direction
+            from p to light index '''
+        total = 0.0
+        for k in range(self.num_lights):
+            total += self.light_weight(p, self.lights[k], time)
+        pdf = 0.0
+        if total > 0.0:
+            pdf = self.emitted(index).sum() / 3.0 / (2.0 * math.pi * total)
+        return pdf
+
+    @ti.func
+    def sample_light(self, p, time, rnd):
+        ''' A direction from p to one of the lights, picked by the uniform
+            numbers rnd.  The light is picked by light_weight, so the near
+            and bright ones get most samples, then a direction uniformly in
+            the cone of directions to it.  Returns the unit direction, the
+            distance to the sphere along it, the emission of the light and
+            the pdf of the direction in solid angle, zero if p is inside
+            the lights.  Both loop over all the lights. '''
+        total = 0.0
+        for k in range(self.num_lights):
+            total += self.light_weight(p, self.lights[k], time)
+        # the light the cumulative weight passes rnd[0] * total at
+        i = self.lights[0]
+        target = rnd[0] * total
+        for k in range(self.num_lights):
+            light = self.lights[k]
+            target -= self.light_weight(p, light, time)
+            if target < 0.0:
+                i = light
+                break
+        d, one_minus_cos = self.light_cone(p, i, time)
+        direction = Vector(0.0, 0.0, 0.0)
+        distance = 0.0
+        pdf = 0.0
+        if one_minus_cos > 0.0:
+            w = d.normalized()
+            u, v = orthonormal_basis(w)
+            cos_theta = 1.0 - rnd[1] * one_minus_cos
+            sin_theta = ti.sqrt(ti.max(1.0 - cos_theta * cos_theta, 0.0))
+            phi = 2.0 * math.pi * rnd[2]
+            direction = (u * ti.cos(phi) + v * ti.sin(phi)) * sin_theta + \
+                w * cos_theta
+            # the near side of the sphere
+            b = direction.dot(d)
+            distance = b - ti.sqrt(
+                ti.max(self.radius[i]**2 - d.norm_sqr() + b * b, 0.0))
+            pdf = self.emitted(i).sum() / 3.0 / (2.0 * math.pi * total)
+        return direction, distance, self.emitted(i), pdf
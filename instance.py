@@ -0,0 +1,266 @@
+import taichi as ti
+from vector import *
+import ray
+import numpy as np
+from time import time
+from bvh import CompactBVH, inverse_direction
+from hittable import is_front_facing
+from material import Materials
+
+
+def box_corners(box_min, box_max):
+    ''' The 8 corners of a box as an (8, 3) array '''
+    return np.array([[(box_min, box_max)[(i >> axis) & 1][axis]
+                      for axis in range(3)] for i in range(8)])
+
+
+def as_affine(transforms):
+    ''' An (n, 4, 4) array of affine transforms given as (n, 3, 4) or
+        (n, 4, 4) arrays '''
+    transforms = np.asarray(transforms, dtype=np.float64)
+    transforms = transforms.reshape((-1, ) + transforms.shape[-2:])
+    affine = np.zeros((len(transforms), 4, 4))
+    affine[:, :3] = transforms[:, :3]
+    affine[:, 3, 3] = 1.0
+    return affine
+
+
+@ti.data_oriented
+class InstancedWorld:
+    ''' Copies of committed worlds, the prototypes, placed by affine
+        transforms.  Every prototype keeps its own bvh (the bottom level)
+        and the instances get a compact bvh over their world space boxes
+        (the top level).  A ray reaching an instance is moved into the
+        space of its prototype and walks the prototype bvh, so memory grows
+        with the number of instances and not with the objects they repeat.
+
+        The material tables of the prototypes are joined into one, hit_all
+        returns the material id of the object hit in place of its index.
+        Prototypes are picked with a static branch per prototype, so keep
+        to a few of them with many instances each. '''
+    def __init__(self):
+        self.prototypes = []
+        # arrays of prototype ids and transforms from add_instances
+        self.batches = []
+        self.counters = None
+        self.counting = False
+        self.stats = {}
+
+    def add_prototype(self, world):
+        ''' Add a committed world, returns its prototype id '''
+        self.prototypes.append(world)
+        return len(self.prototypes) - 1
+
+    def add_instance(self, prototype, transform):
+        ''' Place a prototype with a 3x4 or 4x4 transform from prototype
+            space to world space '''
+        self.add_instances(np.full(1, prototype), [transform])
+
+    def add_instances(self, prototypes, transforms):
+        ''' Place prototypes, an array of ids or a single id, with an array
+            of 3x4 or 4x4 transforms '''
+        transforms = as_affine(transforms)
+        prototypes = np.broadcast_to(np.asarray(prototypes, dtype=np.int32),
+                                     len(transforms))
+        self.batches.append((prototypes, transforms))
+
+    def commit(self, leaf_size=4):
+        ''' Build the top level bvh and upload the instances.
+            stats has the number of objects in the scene and the number
+            stored in the prototypes. '''
+        t = time()
+        prototype = np.concatenate([b[0] for b in self.batches])
+        to_world = np.concatenate([b[1] for b in self.batches])
+        del self.batches
+        to_object = np.linalg.inv(to_world)
+        self.n = len(prototype)
+
+        # the box of an instance covers the transformed prototype box
+        box_min = np.zeros((self.n, 3))
+        box_max = np.zeros((self.n, 3))
+        for k, world in enumerate(self.prototypes):
+            lo, hi = world.boxes()
+            corners = box_corners(lo.min(axis=0), hi.max(axis=0))
+            mask = prototype == k
+            moved = np.einsum('nij,cj->nci', to_world[mask, :3, :3],
+                              corners) + to_world[mask, None, :3, 3]
+            box_min[mask] = moved.min(axis=1)
+            box_max[mask] = moved.max(axis=1)
+        self.bvh = CompactBVH(box_min, box_max, leaf_size)
+        bvh_time = time() - t
+
+        t = time()
+        self.prototype = ti.field(ti.i32)
+        self.linear = ti.Matrix.field(3, 3, dtype=ti.f32)
+        self.offset = ti.Vector.field(3, dtype=ti.f32)
+        ti.root.dense(ti.i, self.n).place(self.prototype, self.linear,
+                                          self.offset)
+        self.bvh.build()
+        order = self.bvh.prim_order
+        self.prototype.from_numpy(prototype[order])
+        self.linear.from_numpy(to_object[order, :3, :3].astype(np.float32))
+        self.offset.from_numpy(to_object[order, :3, 3].astype(np.float32))
+
+        # material ids of prototype k start at material_offset[k]
+        self.material_offset = []
+        tables = []
+        for world in self.prototypes:
+            self.material_offset.append(sum(
+                len(table['mat_index']) for table in tables))
+            tables.append(world.host_materials)
+        self.materials = Materials({
+            name: np.concatenate([table[name] for table in tables])
+            for name in tables[0]
+        })
+        # emissive prototypes glow when hit but are not sampled as lights
+        self.has_emission = any(w.has_emission for w in self.prototypes)
+        self.num_lights = 0
+
+        counts = np.bincount(prototype, minlength=len(self.prototypes))
+        self.stats = {
+            'bvh_time': bvh_time,
+            'upload_time': time() - t,
+            'instances': self.n,
+            'objects': int(sum(c * w.num_prims
+                               for c, w in zip(counts, self.prototypes))),
+            'stored_objects': sum(w.num_prims for w in self.prototypes),
+        }
+
+    def set_counters(self, counters):
+        ''' Count the traversals of both levels in counters, the instances
+            count as nodes '''
+        self.counters = counters
+        self.counting = counters is not None
+        for world in self.prototypes:
+            world.set_counters(counters)
+
+    @ti.func
+    def walk_instance(self, i, ray_origin, ray_direction, time, t_min,
+                      t_max, any_hit: ti.template()):
+        ''' Walk the prototype of instance i with the ray in prototype
+            space.  The ray direction is not normalized, so distances along
+            it are the same in both spaces. '''
+        linear = self.linear[i]
+        origin = linear @ ray_origin + self.offset[i]
+        direction = linear @ ray_direction
+        hit_anything, closest_so_far, hit_index = False, t_max, 0
+        for k in ti.static(range(len(self.prototypes))):
+            if self.prototype[i] == k:
+                hit_anything, closest_so_far, hit_index = self.prototypes[
+                    k].walk(origin, direction, time, t_min, t_max, any_hit)
+        return hit_anything, closest_so_far, hit_index
+
+    @ti.func
+    def walk(self, ray_origin, ray_direction, time, t_min, t_max,
+             any_hit: ti.template()):
+        ''' Walk the top level bvh like World.walk_compact, leaves walk
+            their instances.  Returns the instance and the index of the
+            object hit in its prototype. '''
+        hit_anything = False
+        closest_so_far = t_max
+        hit_instance = 0
+        hit_index = 0
+        nodes = 0
+        inv_direction = inverse_direction(ray_direction)
+        curr = 0
+
+        while curr != -1:
+            nodes += 1
+            offset, count, skip = self.bvh.get_node(curr)
+
+            if self.bvh.hit_aabb(curr, ray_origin, inv_direction, t_min,
+                                 closest_so_far):
+                if count > 0:
+                    for i in range(offset, offset + count):
+                        nodes += 1
+                        hit, t, index = self.walk_instance(
+                            i, ray_origin, ray_direction, time, t_min,
+                            closest_so_far, any_hit)
+                        if hit:
+                            hit_anything = True
+                            closest_so_far = t
+                            hit_instance = i
+                            hit_index = index
+                            if ti.static(any_hit):
+                                break
+                    curr = skip
+                    if ti.static(any_hit):
+                        if hit_anything:
+                            curr = -1
+                else:
+                    curr = curr + 1
+            else:
+                curr = skip
+
+        if ti.static(self.counting):
+            self.counters.count_walk(nodes, 0)
+        return hit_anything, closest_so_far, hit_instance, hit_index
+
+    @ti.func
+    def occluded(self, ray_origin, ray_direction, t_max, time):
+        ''' Returns if any object is hit between the origin and t_max '''
+        hit_anything, _, _, _ = self.walk(ray_origin, ray_direction, time,
+                                          0.0001, t_max, True)
+        return hit_anything
+
+    @ti.func
+    def hit_all(self, ray_origin, ray_direction, time):
+        ''' Intersects a ray at a time against all instances.  The normal
+            is moved to world space with the transpose of the inverse
+            transform. '''
+        t_min = 0.0001
+        p = Point(0.0, 0.0, 0.0)
+        n = Vector(0.0, 0.0, 0.0)
+        front_facing = True
+        material_id = 0
+
+        hit_anything, closest_so_far, i, index = self.walk(
+            ray_origin, ray_direction, time, t_min, 9999999999.9, False)
+
+        if hit_anything:
+            p = ray.at(ray_origin, ray_direction, closest_so_far)
+            linear = self.linear[i]
+            local_p = linear @ p + self.offset[i]
+            for k in ti.static(range(len(self.prototypes))):
+                if self.prototype[i] == k:
+                    world = self.prototypes[k]
+                    n = world.normal(index, local_p, time)
+                    material_id = ti.static(
+                        self.material_offset[k]) + world.material_id[index]
+            n = (linear.transpose() @ n).normalized()
+            front_facing = is_front_facing(ray_direction, n)
+            n = n if front_facing else -n
+
+        return hit_anything, p, n, front_facing, material_id
+
+    @ti.func
+    def scatter(self, ray_direction, p, n, front_facing, index, rnd):
+        ''' Get the scattered direction for a ray hitting material index '''
+        return self.materials.scatter(index, ray_direction, p, n,
+                                      front_facing, rnd)
+
+    @ti.func
+    def scatter_as(self, mat_index: ti.template(), ray_direction, p, n,
+                   front_facing, index, rnd):
+        return self.materials.scatter_as(mat_index, index, ray_direction, p,
+                                         n, front_facing, rnd)
+
+    @ti.func
+    def material_type(self, index):
+        return self.materials.mat_index[index]
+
+    @ti.func
+    def is_specular(self, index):
+        return self.materials.is_specular(index)
+
+    @ti.func
+    def emitted(self, index):
+        return self.materials.emitted(index)
+
+    @ti.func
+    def eval(self, index, in_direction, n, out_direction):
+        return self.materials.eval(index, in_direction, n, out_direction)
+
+    @ti.func
+    def is_light(self, index):
+        return False
@@ -0,0 +1,68 @@
+import taichi as ti
+import json
+
+
+@ti.data_oriented
+class RayCounters:
+    ''' Device counters of the rays traced, the bvh nodes visited and
+        objects tested by their traversals, and a histogram of the number of
+        rays in each path.  Worlds and renderers only count when given
+        counters, otherwise none of the counting is compiled. '''
+    def __init__(self, max_depth):
+        self.max_depth = max_depth
+        self.rays = ti.field(ti.i64)
+        self.nodes = ti.field(ti.i64)
+        self.tests = ti.field(ti.i64)
+        ti.root.place(self.rays, self.nodes, self.tests)
+        self.path_lengths = ti.field(ti.i64)
+        ti.root.dense(ti.i, max_depth + 1).place(self.path_lengths)
+
+    @ti.kernel
+    def clear(self):
+        self.rays[None] = 0
+        self.nodes[None] = 0
+        self.tests[None] = 0
+        for i in self.path_lengths:
+            self.path_lengths[i] = 0
+
+    @ti.func
+    def count_ray(self):
+        self.rays[None] += 1
+
+    @ti.func
+    def count_walk(self, nodes, tests):
+        ''' Add the nodes visited and objects tested by one traversal '''
+        self.nodes[None] += nodes
+        self.tests[None] += tests
+
+    @ti.func
+    def count_path(self, length):
+        self.path_lengths[length] += 1
+
+    def to_dict(self):
+        return {
+            'rays': int(self.rays[None]),
+            'nodes': int(self.nodes[None]),
+            'tests': int(self.tests[None]),
+            'path_lengths': self.path_lengths.to_numpy().tolist(),
+        }
+
+
+def add_rates(stats):
+    ''' Add the Mrays/s, the nodes and tests per ray and the mean path
+        length to stats with counts from RayCounters.to_dict and a
+        render_time '''
+    rays = max(stats['rays'], 1)
+    stats['mrays_per_second'] = stats['rays'] / max(stats['render_time'],
+                                                    1e-9) / 1e6
+    stats['nodes_per_ray'] = stats['nodes'] / rays
+    stats['tests_per_ray'] = stats['tests'] / rays
+    lengths = stats['path_lengths']
+    stats['mean_path_length'] = sum(
+        i * n for i, n in enumerate(lengths)) / max(sum(lengths), 1)
+
+
+def write_stats(path, stats):
+    ''' Write a dict of stats as json, numpy numbers become python ones '''
+    with open(path, 'w') as f:
+        json.dump(stats, f, indent=1, default=lambda o: o.item())
@@ -1,42 +1,30 @@
 import taichi as ti
 from vector import *
-import ray
 from time import time
 from hittable import World, Sphere
 from camera import Camera
 from material import *
+from render import Renderer, buffer_size, split_views
+from wavefront import QueueRenderer
+from tiles import TileRenderer, TILE_ORDERS
+from sampler import SAMPLERS
+from scene import Scene
+from instrument import write_stats
+from progress import Progress, read_checkpoint
+from denoise import Denoiser
+import argparse
 import math
+import numpy as np
 import random
 
 
-# switch to cpu if needed
-ti.init(arch=ti.gpu)
-
-
-@ti.func
-def get_background(dir):
-    ''' Returns the background color for a given direction vector '''
-    unit_direction = dir.normalized()
-    t = 0.5 * (unit_direction[1] + 1.0)
-    return (1.0 - t) * WHITE + t * BLUE
-
-
-if __name__ == '__main__':
-    # image data
-    aspect_ratio = 3.0 / 2.0
-    image_width = 1200
-    image_height = int(image_width / aspect_ratio)
-    rays = ray.Rays(image_width, image_height)
-    pixels = ti.Vector.field(3, dtype=float)
-    sample_count = ti.field(dtype=ti.i32)
-    needs_sample = ti.field(dtype=ti.i32)
-    ti.root.dense(ti.ij,
-                  (image_width, image_height)).place(pixels, sample_count,
-                                                     needs_sample)
-
-    samples_per_pixel = 512
-    max_depth = 16
-
+def make_world(motion_blur=False, grid=11, lights=0):
+    ''' The random spheres scene from the book cover, not yet committed.
+        With motion_blur the small diffuse spheres bounce up during the
+        shutter interval as in "The Next Week".  The small spheres are on a
+        2 * grid by 2 * grid grid, 11 is the book cover.  lights small
+        lamps float among the spheres in front of the camera, for a night
+        scene with a dark sky. '''
     # materials
     mat_ground = Lambert([0.5, 0.5, 0.5])
     mat2 = Lambert([0.4, 0.2, 0.2])
@@ -49,18 +37,22 @@ if __name__ == '__main__':
     world.add(Sphere([0.0, -1000, 0], 1000.0, mat_ground))
 
     static_point = Point(4.0, 0.2, 0.0)
-    for a in range(-11, 11):
-        for b in range(-11, 11):
+    for a in range(-grid, grid):
+        for b in range(-grid, grid):
             choose_mat = random.random()
             center = Point(a + 0.9 * random.random(), 0.2,
                            b + 0.9 * random.random())
 
+            center1 = None
             if (center - static_point).norm() > 0.9:
                 if choose_mat < 0.8:
                     # diffuse
                     mat = Lambert(
                         Color(random.random(), random.random(),
                               random.random())**2)
+                    if motion_blur:
+                        center1 = center + Point(0.0, 0.5 * random.random(),
+                                                 0.0)
                 elif choose_mat < 0.95:
                     # metal
                     mat = Metal(
@@ -70,95 +62,261 @@ if __name__ == '__main__':
                 else:
                     mat = Dielectric(1.5)
 
-            world.add(Sphere(center, 0.2, mat))
+            world.add(Sphere(center, 0.2, mat, center1))
 
     world.add(Sphere([0.0, 1.0, 0.0], 1.0, mat1))
     world.add(Sphere([-4.0, 1.0, 0.0], 1.0, mat2))
     world.add(Sphere([4.0, 1.0, 0.0], 1.0, mat3))
-    world.commit()
-
-    # camera
-    vfrom = Point(13.0, 2.0, 3.0)
-    at = Point(0.0, 0.0, 0.0)
-    up = Vector(0.0, 1.0, 0.0)
-    focus_dist = 10.0
-    aperture = 0.1
-    cam = Camera(vfrom, at, up, 20.0, aspect_ratio, aperture, focus_dist)
-
-    start_attenuation = Vector(1.0, 1.0, 1.0)
-    initial = True
-
-    @ti.kernel
-    def finish():
-        for x, y in pixels:
-            pixels[x, y] = ti.sqrt(pixels[x, y] / samples_per_pixel)
-
-    @ti.kernel
-    def wavefront_initial():
-        for x, y in pixels:
-            sample_count[x, y] = 0
-            needs_sample[x, y] = 1
-
-    @ti.kernel
-    def wavefront_big() -> ti.i32:
-        ''' Loops over pixels
-            for each pixel:
-                generate ray if needed
-                intersect scene with ray
-                if miss or last bounce sample backgound
-            return pixels that hit max samples
-        '''
-        num_completed = 0
-        for x, y in pixels:
-            if sample_count[x, y] == samples_per_pixel:
-                continue
-
-            # gen sample
-            ray_org = Point(0.0, 0.0, 0.0)
-            ray_dir = Vector(0.0, 0.0, 0.0)
-            depth = max_depth
-            pdf = start_attenuation
-
-            if needs_sample[x, y] == 1:
-                needs_sample[x, y] = 0
-                u = (x + ti.random()) / (image_width - 1)
-                v = (y + ti.random()) / (image_height - 1)
-                ray_org, ray_dir = cam.get_ray(u, v)
-                rays.set(x, y, ray_org, ray_dir, depth, pdf)
-            else:
-                ray_org, ray_dir, depth, pdf = rays.get(x, y)
-
-            # intersect
-            hit, p, n, front_facing, index = world.hit_all(ray_org, ray_dir)
-            depth -= 1
-            rays.depth[x, y] = depth
-            if hit:
-                reflected, out_origin, out_direction, attenuation = world.materials.scatter(
-                    index, ray_dir, p, n, front_facing)
-                rays.set(x, y, out_origin, out_direction, depth,
-                         pdf * attenuation)
-                ray_dir = out_direction
-
-            if not hit or depth == 0:
-                pixels[x, y] += pdf * get_background(ray_dir)
-                sample_count[x, y] += 1
-                needs_sample[x, y] = 1
-
-                if sample_count[x, y] == samples_per_pixel:
-                    num_completed += 1
-
-        return num_completed
-
-    num_pixels = image_width * image_height
+
+    # after the other spheres so they are the same with and without lamps
+    for _ in range(lights):
+        center = Point(random.uniform(-4.0, 6.0), random.uniform(0.4, 1.6),
+                       random.uniform(-2.5, 2.5))
+        emission = Color(1.0, 0.6 + 0.3 * random.random(),
+                         0.3 + 0.3 * random.random()) * 60.0
+        world.add(Sphere(center, 0.08, Emissive(emission)))
+    return world
+
+
+# the camera of the book cover, in the form scene files use
+BOOK_CAMERA = {
+    'from': [13.0, 2.0, 3.0],
+    'at': [0.0, 0.0, 0.0],
+    'up': [0.0, 1.0, 0.0],
+    'fov': 20.0,
+    'aperture': 0.1,
+    'focus_dist': 10.0,
+    'shutter': [0.0, 1.0],
+}
+
+
+def camera_args(aspect_ratio, settings):
+    time0, time1 = settings.get('shutter', [0.0, 1.0])
+    return (Point(*settings['from']), Point(*settings['at']),
+            Vector(*settings['up']), settings['fov'], aspect_ratio,
+            settings['aperture'], settings['focus_dist'], time0, time1)
+
+
+def make_camera(aspect_ratio, settings=BOOK_CAMERA):
+    ''' A Camera from settings in the form of scene files, a list of
+        settings makes a camera with a view for each '''
+    views = settings if isinstance(settings, list) else [settings]
+    cam = Camera(*camera_args(aspect_ratio, views[0]), views=len(views))
+    for view in range(1, len(views)):
+        cam.look(*camera_args(aspect_ratio, views[view]), view=view)
+    return cam
+
+
+def turntable(settings, views):
+    ''' Camera settings for views spaced evenly on a circle around the up
+        axis through the look at point, the first is settings '''
+    at = np.array(settings['at'], dtype=np.float64)
+    axis = np.array(settings['up'], dtype=np.float64)
+    axis /= np.linalg.norm(axis)
+    offset = np.array(settings['from'], dtype=np.float64) - at
+    cameras = [settings]
+    for view in range(1, views):
+        # rodrigues' rotation of the offset around the axis
+        angle = 2.0 * math.pi * view / views
+        rotated = offset * math.cos(angle) + np.cross(
+            axis, offset) * math.sin(angle) + axis * np.dot(
+                axis, offset) * (1.0 - math.cos(angle))
+        cameras.append(dict(settings, **{'from': (at + rotated).tolist()}))
+    return cameras
+
+
+if __name__ == '__main__':
+    start = time()
+    parser = argparse.ArgumentParser(description='ray tracing in one weekend')
+    parser.add_argument('--arch', default='gpu', choices=['cpu', 'gpu'])
+    parser.add_argument('--width', type=int, default=1200)
+    parser.add_argument('--spp', type=int, default=512)
+    parser.add_argument('--max-depth', type=int, default=16)
+    parser.add_argument('--roulette-depth', type=int, default=0,
+                        help='russian roulette after this many bounces, '
+                        '0 for none')
+    parser.add_argument('--renderer', default='megakernel',
+                        choices=['megakernel', 'wavefront'])
+    parser.add_argument('--pass-batch', type=int, default=16,
+                        help='passes per kernel launch')
+    parser.add_argument('--adaptive-threshold', type=float, default=0.0,
+                        help='stop pixels under this relative error')
+    parser.add_argument('--min-samples', type=int, default=16)
+    parser.add_argument('--max-samples', type=int, default=None,
+                        help='give saved samples to noisy pixels up to this')
+    parser.add_argument('--tile-size', type=int, default=0,
+                        help='render in tiles of this size, 0 for no tiles')
+    parser.add_argument('--tile-order', default='center',
+                        choices=list(TILE_ORDERS))
+    parser.add_argument('--sampler', default='independent', choices=SAMPLERS)
+    parser.add_argument('--seed', type=int, default=0,
+                        help='seed of the scene and the sampler')
+    parser.add_argument('--scene', default=None,
+                        help='render a scene file instead of the book cover')
+    parser.add_argument('--views', type=int, default=1,
+                        help='render a turntable of this many views in the '
+                        'same launches, written to out_N.png')
+    parser.add_argument('--motion-blur', action='store_true',
+                        help='bouncing spheres in the book cover scene')
+    parser.add_argument('--lights', type=int, default=0,
+                        help='small lamps in the book cover scene')
+    parser.add_argument('--sky', type=float, default=1.0,
+                        help='brightness of the background, 0 for a scene '
+                        'lit only by its lamps')
+    parser.add_argument('--no-light-sampling', action='store_true',
+                        help='only find the lamps by bouncing into them')
+    parser.add_argument('--instrument', action='store_true',
+                        help='count rays, bvh nodes, tests and path lengths')
+    parser.add_argument('--stats-json', default=None,
+                        help='write the timings and counters to this file')
+    parser.add_argument('--kernel-cache', default=None,
+                        help='directory of the compiled kernel cache')
+    parser.add_argument('--no-kernel-cache', action='store_true',
+                        help='compile every kernel from scratch')
+    parser.add_argument('--warm-start', action='store_true',
+                        help='round the buffers up to powers of two so '
+                        'other image sizes reuse the cached kernels')
+    parser.add_argument('--preview', default=None,
+                        help='write the image so far to this file')
+    parser.add_argument('--preview-interval', type=float, default=10.0,
+                        help='seconds between previews')
+    parser.add_argument('--checkpoint', default=None,
+                        help='save the samples so far to this npz file')
+    parser.add_argument('--checkpoint-interval', type=float, default=60.0,
+                        help='seconds between checkpoints')
+    parser.add_argument('--resume', default=None,
+                        help='go on from a checkpoint of the same render, '
+                        'a higher --spp adds samples')
+    parser.add_argument('--denoise', action='store_true',
+                        help='filter the finished image guided by the '
+                        'albedo, normals and depth of the first hits')
+    args = parser.parse_args()
+    if args.tile_size > 0 and (args.preview or args.checkpoint or
+                               args.resume):
+        parser.error('tiles are written as they finish, previews and '
+                     'checkpoints are for renders without tiles')
+    if args.denoise and (args.tile_size > 0 or args.resume):
+        parser.error('--denoise needs the whole image in one render, the '
+                     'checkpoints do not have the guide buffers')
+
+    # switch to cpu if needed
+    cache_options = {}
+    if args.kernel_cache:
+        cache_options['offline_cache_file_path'] = args.kernel_cache
+    ti.init(arch=getattr(ti, args.arch), random_seed=args.seed,
+            offline_cache=not args.no_kernel_cache, **cache_options)
+    random.seed(args.seed)
+
+    # image data
+    aspect_ratio = 3.0 / 2.0
+    image_width = args.width
+    image_height = int(image_width / aspect_ratio)
+    samples_per_pixel = args.spp
+    max_depth = args.max_depth
 
     t = time()
+    camera = BOOK_CAMERA
+    scene_stats = {}
+    if args.scene:
+        scene = Scene(args.scene)
+        scene_stats = scene.stats
+        print('scene', scene_stats)
+        world = scene.world
+        camera = scene.camera or camera
+    else:
+        world = make_world(args.motion_blur, lights=args.lights)
+        world.commit()
+    scene_time = time() - t
+    print('bvh', world.bvh.stats)
+    cam = make_camera(aspect_ratio, turntable(camera, args.views))
+    # the views are stacked in the buffers
+    frame_rows = image_height * args.views
+
+    renderer_class = QueueRenderer if args.renderer == 'wavefront' else Renderer
+    options = dict(pass_batch=args.pass_batch,
+                   adaptive_threshold=args.adaptive_threshold,
+                   min_samples=args.min_samples,
+                   max_samples=args.max_samples,
+                   sampler=args.sampler,
+                   seed=args.seed,
+                   instrument=args.instrument,
+                   roulette_depth=args.roulette_depth,
+                   auxiliary=args.denoise,
+                   sky=args.sky,
+                   light_sampling=not args.no_light_sampling)
+
     print('starting big wavefront')
-    wavefront_initial()
-    num_completed = 0
-    while num_completed < num_pixels:
-        num_completed += wavefront_big()
-        # print('completed', num_completed)
-
-    finish()
-    print(time() - t)
-    ti.imwrite(pixels.to_numpy(), 'out.png')
+    if args.tile_size > 0:
+        renderer = TileRenderer(renderer_class, world, cam, image_width,
+                                image_height, samples_per_pixel, max_depth,
+                                tile_size=args.tile_size,
+                                tile_order=args.tile_order, **options)
+
+        def on_tile(x, y, pixels):
+            print('tile', x, y, 'done')
+
+        compile_time = renderer.compile()
+        t = time()
+        startup_time = t - start
+        renderer.render(on_tile)
+        image = renderer.image
+    else:
+        buffer_width, buffer_height = image_width, frame_rows
+        if args.warm_start:
+            buffer_width, buffer_height = buffer_size(image_width,
+                                                      frame_rows)
+        renderer = renderer_class(world, cam, buffer_width, buffer_height,
+                                  samples_per_pixel, max_depth,
+                                  frame_width=image_width,
+                                  frame_height=image_height, **options)
+        renderer.set_tile(0, 0, image_width, frame_rows)
+        compile_time = renderer.compile()
+        if args.resume:
+            renderer.restore(read_checkpoint(args.resume))
+        progress = None
+        if args.preview or args.checkpoint:
+            progress = Progress(renderer, args.preview,
+                                args.preview_interval, args.checkpoint,
+                                args.checkpoint_interval)
+        t = time()
+        startup_time = t - start
+        renderer.render(args.resume is not None, progress)
+        if progress is not None:
+            progress.close()
+            print('progress', progress.stats)
+        image = renderer.pixels.to_numpy()[:image_width, :frame_rows]
+    render_time = time() - t
+    denoise_time = 0.0
+    if args.denoise:
+        denoiser = Denoiser(renderer)
+        compile_time += denoiser.compile()
+        denoiser.denoise()
+        denoise_time = denoiser.stats['denoise_time']
+        print('denoise', denoise_time)
+        image = denoiser.image()
+    print('compile', compile_time, 'startup', startup_time)
+    print(render_time)
+    print('render', renderer.stats)
+    if args.views > 1:
+        for view, layer in enumerate(split_views(image, args.views)):
+            ti.imwrite(layer, 'out_{}.png'.format(view))
+    else:
+        ti.imwrite(image, 'out.png')
+
+    if args.stats_json:
+        write_stats(
+            args.stats_json, {
+                'args': vars(args),
+                'timings': {
+                    'scene_time': scene_time,
+                    'bvh_time': world.stats['bvh_time'],
+                    'compile_time': compile_time,
+                    'render_time': render_time,
+                    'startup_time': startup_time,
+                    'denoise_time': denoise_time,
+                },
+                'scene': scene_stats,
+                'world': world.stats,
+                'bvh': world.bvh.stats,
+                'render': renderer.stats,
+            })
@@ -1,4 +1,6 @@
 import taichi as ti
+import numpy as np
+import math
 from taichi_glsl.vector import reflect
 from vector import *
 
@@ -22,53 +24,111 @@ def refract(v, n, etai_over_etat):
     return r_out_perp + r_out_parallel
 
 
+# metals smoother than this count as mirrors for the denoiser guides
+SPECULAR_ROUGHNESS = 0.05
+
+# the parameter columns of the material arrays, the number of components
+# and the attribute of the material objects they come from
+COLUMNS = {
+    'colors': (3, 'color'),
+    'roughness': (1, 'roughness'),
+    'ior': (1, 'ior'),
+    'emission': (3, 'emission'),
+}
+
+
 class _material:
-    def scatter(self, in_direction, p, n):
-        pass
+    ''' A material type is a class with its index in MATERIAL_CLASSES, the
+        params (columns) its scatter reads and scatter and is_specular
+        ti.funcs taking the table of the type and the slot of the material
+        in it.  Attributes not in params are the defaults of the columns.
+        Types that emit light have emitted, types that lights are sampled
+        at have eval. '''
+    params = ()
+    color = (1.0, 1.0, 1.0)
+    roughness = 0.0
+    ior = 1.0
+    emission = (0.0, 0.0, 0.0)
+
+    @staticmethod
+    @ti.func
+    def is_specular(table, slot):
+        return False
+
+    @staticmethod
+    @ti.func
+    def emitted(table, slot):
+        return Color(0.0, 0.0, 0.0)
+
+    @staticmethod
+    @ti.func
+    def eval(table, slot, in_direction, n, out_direction):
+        ''' The bsdf times the cosine of scattering in_direction to the unit
+            out_direction and the pdf of scatter picking it, in solid
+            angle.  Zero for types whose scatter has no such pdf, lights
+            are not sampled at those. '''
+        return Color(0.0, 0.0, 0.0), 0.0
 
 
 class Lambert(_material):
+    index = 0
+    params = ('colors', )
+
     def __init__(self, color):
         self.color = color
-        self.index = 0
-        self.roughness = 0.0
-        self.ior = 1.0
 
     @staticmethod
     @ti.func
-    def scatter(in_direction, p, n, color):
-        out_direction = n + random_in_hemisphere(n)
-        attenuation = color
+    def scatter(table, slot, in_direction, p, n, front_facing, rnd):
+        # a unit vector off the normal is cosine distributed
+        out_direction = n + sample_unit_vector(rnd)
+        if out_direction.norm_sqr() < 1e-8:
+            out_direction = n
+        attenuation = table.colors[slot]
         return True, p, out_direction, attenuation
 
+    @staticmethod
+    @ti.func
+    def eval(table, slot, in_direction, n, out_direction):
+        pdf = ti.max(n.dot(out_direction), 0.0) / math.pi
+        return table.colors[slot] * pdf, pdf
+
 
 class Metal(_material):
+    index = 1
+    params = ('colors', 'roughness')
+
     def __init__(self, color, roughness):
         self.color = color
-        self.index = 1
         self.roughness = min(roughness, 1.0)
-        self.ior = 1.0
 
     @staticmethod
     @ti.func
-    def scatter(in_direction, p, n, color, roughness):
+    def scatter(table, slot, in_direction, p, n, front_facing, rnd):
+        roughness = table.roughness[slot]
         out_direction = reflect(in_direction.normalized(),
-                                n) + roughness * random_in_unit_sphere()
-        attenuation = color
+                                n) + roughness * sample_unit_sphere(rnd)
+        attenuation = table.colors[slot]
         reflected = out_direction.dot(n) > 0.0
         return reflected, p, out_direction, attenuation
 
+    @staticmethod
+    @ti.func
+    def is_specular(table, slot):
+        return table.roughness[slot] < SPECULAR_ROUGHNESS
+
 
 class Dielectric(_material):
+    index = 2
+    params = ('ior', )
+
     def __init__(self, ior):
-        self.color = Color(1.0, 1.0, 1.0)
-        self.index = 2
-        self.roughness = 0.0
         self.ior = ior
 
     @staticmethod
     @ti.func
-    def scatter(in_direction, p, n, color, ior, front_facing):
+    def scatter(table, slot, in_direction, p, n, front_facing, rnd):
+        ior = table.ior[slot]
         refraction_ratio = 1.0 / ior if front_facing else ior
         unit_dir = in_direction.normalized()
         cos_theta = min(-unit_dir.dot(n), 1.0)
@@ -77,51 +137,177 @@ class Dielectric(_material):
         out_direction = Vector(0.0, 0.0, 0.0)
         cannot_refract = refraction_ratio * sin_theta > 1.0
         if cannot_refract or reflectance(cos_theta,
-                                         refraction_ratio) > ti.random():
+                                         refraction_ratio) > rnd[0]:
             out_direction = reflect(unit_dir, n)
         else:
             out_direction = refract(unit_dir, n, refraction_ratio)
-        attenuation = color
+        attenuation = Color(1.0, 1.0, 1.0)
 
         return True, p, out_direction, attenuation
 
+    @staticmethod
+    @ti.func
+    def is_specular(table, slot):
+        return True
+
+
+class Emissive(_material):
+    ''' A light, its front side emits emission and it scatters nothing '''
+    index = 3
+    params = ('emission', )
+
+    def __init__(self, emission):
+        self.emission = emission
+
+    @staticmethod
+    @ti.func
+    def scatter(table, slot, in_direction, p, n, front_facing, rnd):
+        return False, p, n, Color(0.0, 0.0, 0.0)
+
+    @staticmethod
+    @ti.func
+    def emitted(table, slot):
+        return table.emission[slot]
+
+
+# the material types by index
+MATERIAL_CLASSES = [Lambert, Metal, Dielectric, Emissive]
+NUM_MATERIALS = len(MATERIAL_CLASSES)
+
+
+@ti.data_oriented
+class MaterialTable:
+    ''' The parameters of the materials of one type, a field per param '''
+    def __init__(self, params, arrays):
+        self.n = len(arrays[params[0]]) if params else 0
+        for name in params:
+            size = COLUMNS[name][0]
+            field = ti.field(ti.f32) if size == 1 else ti.Vector.field(
+                size, dtype=ti.f32)
+            # an empty table still needs a row to place its fields
+            ti.root.dense(ti.i, max(self.n, 1)).place(field)
+            if self.n:
+                field.from_numpy(arrays[name])
+            setattr(self, name, field)
+
 
 @ti.data_oriented
 class Materials:
-    ''' List of materials for a scene.'''
-    def __init__(self, n):
-        self.roughness = ti.field(ti.f32)
-        self.colors = ti.Vector.field(3, dtype=ti.f32)
+    ''' The material table of a scene, objects refer to an entry by its
+        material id.  An entry is the type of the material and its slot in
+        the table of that type, which has only the params of the type, so
+        a hit reads the type, the slot and what its scatter needs.  Built
+        from arrays of material_arrays. '''
+    def __init__(self, arrays):
+        mat_index = np.asarray(arrays['mat_index'], dtype=np.uint32)
         self.mat_index = ti.field(ti.u32)
-        self.ior = ti.field(ti.f32)
-        ti.root.dense(ti.i, n).place(self.roughness, self.colors,
-                                     self.mat_index, self.ior)
+        self.slot = ti.field(ti.i32)
+        ti.root.dense(ti.i, len(mat_index)).place(self.mat_index, self.slot)
+        self.mat_index.from_numpy(mat_index)
 
-    def set(self, i, material):
-        self.colors[i] = material.color
-        self.mat_index[i] = material.index
-        self.roughness[i] = material.roughness
-        self.ior[i] = material.ior
+        slot = np.zeros(len(mat_index), dtype=np.int32)
+        self.tables = []
+        for material in MATERIAL_CLASSES:
+            of_type = mat_index == material.index
+            slot[of_type] = np.arange(np.count_nonzero(of_type))
+            self.tables.append(MaterialTable(material.params, {
+                name: np.asarray(arrays[name],
+                                 dtype=np.float32)[of_type]
+                for name in material.params
+            }))
+        self.slot.from_numpy(slot)
 
     @ti.func
-    def scatter(self, i, ray_direction, p, n, front_facing):
-        ''' Get the scattered ray that hits a material '''
+    def scatter_as(self, mat_index: ti.template(), i, ray_direction, p, n,
+                   front_facing, rnd):
+        ''' Scatter off material i known to be of type mat_index.
+            Only the parameters of that type are read and there is no
+            branch on the type. '''
+        return MATERIAL_CLASSES[mat_index].scatter(
+            self.tables[mat_index], self.slot[i], ray_direction, p, n,
+            front_facing, rnd)
+
+    @ti.func
+    def scatter(self, i, ray_direction, p, n, front_facing, rnd):
+        ''' Get the scattered ray that hits material i, rnd are the
+            uniform numbers it uses '''
         mat_index = self.mat_index[i]
-        color = self.colors[i]
-        roughness = self.roughness[i]
-        ior = self.ior[i]
         reflected = True
         out_origin = Point(0.0, 0.0, 0.0)
         out_direction = Vector(0.0, 0.0, 0.0)
         attenuation = Color(0.0, 0.0, 0.0)
-
-        if mat_index == 0:
-            reflected, out_origin, out_direction, attenuation = Lambert.scatter(
-                ray_direction, p, n, color)
-        elif mat_index == 1:
-            reflected, out_origin, out_direction, attenuation = Metal.scatter(
-                ray_direction, p, n, color, roughness)
-        else:
-            reflected, out_origin, out_direction, attenuation = Dielectric.scatter(
-                ray_direction, p, n, color, ior, front_facing)
+        for m in ti.static(range(NUM_MATERIALS)):
+            if mat_index == m:
+                reflected, out_origin, out_direction, attenuation = \
+                    self.scatter_as(m, i, ray_direction, p, n, front_facing,
+                                    rnd)
         return reflected, out_origin, out_direction, attenuation
+
+    @ti.func
+    def emitted(self, i):
+        ''' The light material i emits '''
+        mat_index = self.mat_index[i]
+        emission = Color(0.0, 0.0, 0.0)
+        for m in ti.static(range(NUM_MATERIALS)):
+            if mat_index == m:
+                emission = MATERIAL_CLASSES[m].emitted(
+                    self.tables[m], self.slot[i])
+        return emission
+
+    @ti.func
+    def eval(self, i, in_direction, n, out_direction):
+        ''' The bsdf times the cosine and the scatter pdf of material i for
+            the unit out_direction, see _material.eval '''
+        mat_index = self.mat_index[i]
+        value = Color(0.0, 0.0, 0.0)
+        pdf = 0.0
+        for m in ti.static(range(NUM_MATERIALS)):
+            if mat_index == m:
+                value, pdf = MATERIAL_CLASSES[m].eval(
+                    self.tables[m], self.slot[i], in_direction, n,
+                    out_direction)
+        return value, pdf
+
+    @ti.func
+    def is_specular(self, i):
+        ''' If material i is glass or a mirror '''
+        mat_index = self.mat_index[i]
+        specular = False
+        for m in ti.static(range(NUM_MATERIALS)):
+            if mat_index == m:
+                specular = MATERIAL_CLASSES[m].is_specular(
+                    self.tables[m], self.slot[i])
+        return specular
+
+
+def material_arrays(materials):
+    ''' The type index and the COLUMNS of a list of materials as arrays
+        for Materials '''
+    arrays = {
+        'mat_index': np.array([m.index for m in materials], dtype=np.uint32)
+    }
+    for name, (size, attribute) in COLUMNS.items():
+        values = [getattr(m, attribute) for m in materials]
+        if size > 1:
+            values = [[v[i] for i in range(size)] for v in values]
+        arrays[name] = np.array(values, dtype=np.float32).reshape(
+            (-1, size) if size > 1 else -1)
+    return arrays
+
+
+def dedupe_materials(arrays):
+    ''' The table of the distinct materials in arrays from material_arrays
+        and the index of each material in it '''
+    n = len(arrays['mat_index'])
+    rows = np.concatenate([arrays['mat_index'][:, None]] + [
+        np.asarray(arrays[name], dtype=np.float32).reshape(n, -1)
+        for name in COLUMNS
+    ], axis=1).astype(np.float32)
+    rows, inverse = np.unique(rows, axis=0, return_inverse=True)
+    table = {'mat_index': rows[:, 0].astype(np.uint32)}
+    column = 1
+    for name, (size, attribute) in COLUMNS.items():
+        values = rows[:, column:column + size]
+        table[name] = values if size > 1 else values[:, 0]
+        column += size
+    return table, inverse.reshape(-1).astype(np.int32)
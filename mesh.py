@@ -0,0 +1,271 @@
+import re
+import numpy as np
+from itertools import islice
+
+# bytes of lines read at a time from obj files
+CHUNK_SIZE = 1 << 24
+# obj lines starting with these are split without looking for whitespace
+PLAIN_KEYWORDS = (b'v ', b'f ')
+
+PLY_TYPES = {
+    'char': 'i1', 'uchar': 'u1', 'short': 'i2', 'ushort': 'u2',
+    'int': 'i4', 'uint': 'u4', 'float': 'f4', 'double': 'f8',
+    'int8': 'i1', 'uint8': 'u1', 'int16': 'i2', 'uint16': 'u2',
+    'int32': 'i4', 'uint32': 'u4', 'float32': 'f4', 'float64': 'f8',
+}
+
+
+def fan_triangles(indices, counts):
+    ''' Split polygons, given as their concatenated vertex indices and the
+        number of vertices of each, into fans of triangles '''
+    if np.all(counts == 3):
+        return indices.reshape(-1, 3)
+    first = np.cumsum(counts) - counts
+    num_triangles = counts - 2
+    # the i-th triangle of a polygon is (first, first + i + 1, first + i + 2)
+    i = np.arange(num_triangles.sum()) - np.repeat(
+        np.cumsum(num_triangles) - num_triangles, num_triangles)
+    first = np.repeat(first, num_triangles)
+    return np.stack((indices[first], indices[first + i + 1],
+                     indices[first + i + 2]), axis=1)
+
+
+def parse_numbers(lines, dtype, per_line):
+    ''' The first per_line numbers of each line as an array, lines are the
+        bytes after the keyword of the line '''
+    values = np.fromstring(b' '.join(lines), dtype=dtype, sep=' ')
+    if values.size != per_line * len(lines):
+        # some lines have more numbers, like the w of obj vertices
+        values = np.array([line.split()[:per_line] for line in lines],
+                          dtype=dtype)
+    return values.reshape(-1, per_line)
+
+
+def count_words(text, num_lines):
+    ''' The number of words on each line of text, every line ends in a
+        newline '''
+    chars = np.frombuffer(text, dtype=np.uint8)
+    newline = chars == ord('\n')
+    blank = newline | (chars == ord(' ')) | (chars == ord('\t')) | (
+        chars == ord('\r'))
+    first = ~blank & np.concatenate(([True], blank[:-1]))
+    return np.bincount(np.cumsum(newline)[first], minlength=num_lines)
+
+
+def split_keyword(line):
+    ''' The first word of an obj line and the rest of it '''
+    words = line.split(None, 1)
+    if len(words) < 2:
+        return (words[0] if words else b''), b'\n'
+    return words[0], words[1]
+
+
+def read_obj(path):
+    ''' The vertices and triangles of an obj file.  The file is read a chunk
+        of lines at a time and each chunk parsed by numpy, polygons become
+        fans of triangles.  Texture coordinates and normals are skipped. '''
+    vertices = []
+    faces = []
+    num_vertices = 0
+    with open(path, 'rb') as f:
+        while True:
+            lines = f.readlines(CHUNK_SIZE)
+            if not lines:
+                break
+            if not lines[-1].endswith(b'\n'):
+                lines[-1] += b'\n'
+            # the keyword and the rest of every line, only lines that are
+            # indented or have a tab after the keyword need the split
+            words = [(line[:1], line[2:]) if line[:2] in PLAIN_KEYWORDS
+                     else split_keyword(line) for line in lines]
+            heads = [w[0] for w in words]
+            rests = [w[1] for w in words]
+            is_vertex = np.array([head == b'v' for head in heads],
+                                 dtype=bool)
+            is_face = np.array([head == b'f' for head in heads], dtype=bool)
+
+            vertex_lines = [rests[i] for i in np.flatnonzero(is_vertex)]
+            if vertex_lines:
+                vertices.append(parse_numbers(vertex_lines, np.float32, 3))
+
+            face_rows = np.flatnonzero(is_face)
+            if len(face_rows):
+                # drop the texture and normal indices of v/vt/vn
+                text = re.sub(rb'/\S*', b'',
+                              b''.join(rests[i] for i in face_rows))
+                counts = count_words(text, len(face_rows))
+                indices = np.fromstring(text, dtype=np.int64, sep=' ')
+                # negative indices count back from the last vertex so far
+                seen = num_vertices + np.cumsum(is_vertex)[face_rows]
+                indices = np.where(indices < 0,
+                                   np.repeat(seen, counts) + indices,
+                                   indices - 1)
+                faces.append(fan_triangles(indices, counts))
+            num_vertices += len(vertex_lines)
+
+    vertices = np.concatenate(vertices or [np.zeros((0, 3))])
+    faces = np.concatenate(faces or [np.zeros((0, 3))])
+    if len(faces) and (faces.min() < 0 or faces.max() >= len(vertices)):
+        raise ValueError('{} has a face index out of range'.format(path))
+    return vertices.astype(np.float32), faces.astype(np.int32)
+
+
+def read_ply_header(f):
+    ''' The format and the elements of a ply file, each element is its
+        name, count and properties.  A property is a (name, dtype) or for
+        lists a (name, count dtype, item dtype). '''
+    if f.readline().strip() != b'ply':
+        raise ValueError('{} is not a ply file'.format(f.name))
+    file_format = None
+    elements = []
+    for line in f:
+        words = line.decode('ascii').split()
+        if not words or words[0] in ('comment', 'obj_info'):
+            continue
+        if words[0] == 'end_header':
+            return file_format, elements
+        if words[0] == 'format':
+            file_format = words[1]
+        elif words[0] == 'element':
+            elements.append((words[1], int(words[2]), []))
+        elif words[0] == 'property' and words[1] == 'list':
+            elements[-1][2].append(
+                (words[4], PLY_TYPES[words[2]], PLY_TYPES[words[3]]))
+        elif words[0] == 'property':
+            elements[-1][2].append((words[2], PLY_TYPES[words[1]]))
+    raise ValueError('{} has no end_header'.format(f.name))
+
+
+def read_binary_element(f, count, properties, order):
+    ''' The records of a binary ply element as a structured array.  Lists
+        are read as fixed size arrays when the first record has a
+        list of the same length as every other record, otherwise record by
+        record. '''
+    if all(len(p) == 2 for p in properties):
+        dtype = np.dtype([(p[0], order + p[1]) for p in properties])
+        return np.fromfile(f, dtype=dtype, count=count)
+
+    start = f.tell()
+    fields = []
+    for p in properties:
+        if len(p) == 2:
+            fields.append((p[0], order + p[1]))
+        else:
+            # the length of the list of the first record
+            f.seek(start + (np.dtype(fields).itemsize if fields else 0))
+            size = int(np.fromfile(f, dtype=order + p[1], count=1)[0])
+            fields.extend([(p[0] + '_count', order + p[1]),
+                           (p[0], order + p[2], (size, ))])
+    f.seek(start)
+    dtype = np.dtype(fields)
+    records = np.fromfile(f, dtype=dtype, count=count)
+    if len(records) == count and all(
+            np.all(records[p[0] + '_count'] == records.dtype[p[0]].shape[0])
+            for p in properties if len(p) == 3):
+        return records
+
+    # lists of different lengths, read one record at a time
+    f.seek(start)
+    records = []
+    for _ in range(count):
+        record = {}
+        for p in properties:
+            if len(p) == 2:
+                record[p[0]] = np.fromfile(f, order + p[1], 1)[0]
+            else:
+                size = int(np.fromfile(f, order + p[1], 1)[0])
+                record[p[0]] = np.fromfile(f, order + p[2], size)
+        records.append(record)
+    return records
+
+
+def read_ascii_element(f, count, properties):
+    ''' The records of an ascii ply element as a dict of columns, lists of
+        different lengths become lists of arrays '''
+    lines = list(islice(f, count))
+    if all(len(p) == 2 for p in properties):
+        values = parse_numbers(lines, np.float64, len(properties))
+        return {p[0]: values[:, i] for i, p in enumerate(properties)}
+    rows = [np.array(line.split(), dtype=np.float64) for line in lines]
+    columns = {}
+    for i, p in enumerate(properties):
+        if len(p) == 3:
+            # a list ends the record in every file seen in practice
+            columns[p[0]] = [row[i + 1:] for row in rows]
+            break
+        columns[p[0]] = np.array([row[i] for row in rows])
+    return columns
+
+
+def read_ply(path):
+    ''' The vertices and triangles of an ascii or binary ply file.  Binary
+        elements are read straight into arrays, polygons become fans of
+        triangles. '''
+    vertices = np.zeros((0, 3), dtype=np.float32)
+    faces = np.zeros((0, 3), dtype=np.int32)
+    with open(path, 'rb') as f:
+        file_format, elements = read_ply_header(f)
+        order = {'binary_little_endian': '<', 'binary_big_endian': '>'}.get(
+            file_format)
+        for name, count, properties in elements:
+            if order:
+                records = read_binary_element(f, count, properties, order)
+            else:
+                records = read_ascii_element(f, count, properties)
+
+            if name == 'vertex':
+                vertices = np.stack([
+                    np.asarray(records['x']),
+                    np.asarray(records['y']),
+                    np.asarray(records['z'])
+                ], axis=1).astype(np.float32)
+            elif name == 'face':
+                lists = [p[0] for p in properties if len(p) == 3]
+                key = lists[0]
+                if 'vertex_indices' in lists:
+                    key = 'vertex_indices'
+                if isinstance(records, list):
+                    polygons = [np.asarray(r[key]) for r in records]
+                else:
+                    polygons = records[key]
+                if isinstance(polygons, np.ndarray):
+                    polygons = polygons.astype(np.int64)
+                    counts = np.full(len(polygons), polygons.shape[1])
+                    indices = polygons.reshape(-1)
+                else:
+                    counts = np.array([len(p) for p in polygons])
+                    indices = np.concatenate(polygons).astype(np.int64)
+                faces = fan_triangles(indices, counts).astype(np.int32)
+    return vertices, faces
+
+
+def load_mesh(path):
+    ''' The vertices and triangles of an obj or ply file, as float32 and
+        int32 arrays for World.add_mesh '''
+    if path.lower().endswith('.ply'):
+        return read_ply(path)
+    return read_obj(path)
+
+
+def write_obj(path, vertices, faces):
+    with open(path, 'w') as f:
+        np.savetxt(f, vertices, fmt='v %.9g %.9g %.9g')
+        np.savetxt(f, faces + 1, fmt='f %d %d %d')
+
+
+def write_ply(path, vertices, faces):
+    ''' Write a binary little endian ply file '''
+    header = ('ply\nformat binary_little_endian 1.0\n'
+              'element vertex {}\n'
+              'property float x\nproperty float y\nproperty float z\n'
+              'element face {}\n'
+              'property list uchar int vertex_indices\n'
+              'end_header\n').format(len(vertices), len(faces))
+    records = np.empty(len(faces), dtype=[('count', 'u1'),
+                                          ('indices', '<i4', (3, ))])
+    records['count'] = 3
+    records['indices'] = faces
+    with open(path, 'wb') as f:
+        f.write(header.encode('ascii'))
+        f.write(np.asarray(vertices, dtype='<f4').tobytes())
+        f.write(records.tobytes())
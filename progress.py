@@ -0,0 +1,95 @@
+import taichi as ti
+import numpy as np
+import os
+import queue
+import threading
+from time import time
+
+
+def write_checkpoint(path, state):
+    ''' Write a Renderer.checkpoint to an npz file.  It goes to a temporary
+        file first so a crash while writing leaves the last checkpoint. '''
+    temporary = path + '.tmp'
+    with open(temporary, 'wb') as f:
+        np.savez(f, **state)
+    os.replace(temporary, path)
+
+
+def write_image(path, image):
+    ti.imwrite(image, path)
+
+
+def read_checkpoint(path):
+    with np.load(path) as data:
+        return dict(data)
+
+
+@ti.data_oriented
+class Progress:
+    ''' Passed as on_batch to Renderer.trace, writes a preview image of the
+        samples so far every preview_interval seconds and a checkpoint
+        every checkpoint_interval seconds, and both once the render is done.
+
+        The preview is developed on the device into its own buffer, so the
+        trace loop only waits for that kernel and the copy of the buffer
+        (or of the checkpoint).  Writing the files happens on a background
+        thread, a preview is skipped if the last one is still being
+        written. '''
+    def __init__(self, renderer, preview_path=None, preview_interval=10.0,
+                 checkpoint_path=None, checkpoint_interval=60.0):
+        self.preview_path = preview_path
+        self.preview_interval = preview_interval
+        self.checkpoint_path = checkpoint_path
+        self.checkpoint_interval = checkpoint_interval
+        self.last_preview = self.last_checkpoint = time()
+        self.stats = {'previews': 0, 'checkpoints': 0, 'wait_time': 0.0}
+
+        self.preview = ti.Vector.field(3, dtype=ti.f32)
+        ti.root.dense(ti.ij, (renderer.image_width,
+                              renderer.image_height)).place(self.preview)
+        # compile develop now rather than in the middle of the render
+        self.develop(renderer.pixels, renderer.sample_count)
+        self.jobs = queue.Queue(maxsize=1)
+        self.writer = threading.Thread(target=self.write_jobs, daemon=True)
+        self.writer.start()
+
+    @ti.kernel
+    def develop(self, pixels: ti.template(), sample_count: ti.template()):
+        ''' The image so far, like Renderer.finish without touching the
+            sums '''
+        for x, y in pixels:
+            self.preview[x, y] = ti.sqrt(pixels[x, y] /
+                                         ti.max(sample_count[x, y], 1))
+
+    def write_jobs(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                break
+            write, path, data = job
+            write(path, data)
+
+    def __call__(self, renderer, done):
+        t = time()
+        if self.preview_path and (
+                done or t - self.last_preview > self.preview_interval):
+            if done or not self.jobs.full():
+                self.develop(renderer.pixels, renderer.sample_count)
+                tile = renderer.tile[None]
+                image = self.preview.to_numpy()[:tile[2], :tile[3]]
+                self.jobs.put((write_image, self.preview_path, image))
+                self.stats['previews'] += 1
+            self.last_preview = time()
+        if self.checkpoint_path and (
+                done or t - self.last_checkpoint > self.checkpoint_interval):
+            # checkpoints are not skipped, wait for the writer
+            self.jobs.put((write_checkpoint, self.checkpoint_path,
+                           renderer.checkpoint()))
+            self.last_checkpoint = time()
+            self.stats['checkpoints'] += 1
+        self.stats['wait_time'] += time() - t
+
+    def close(self):
+        ''' Wait for the files being written '''
+        self.jobs.put(None)
+        self.writer.join()
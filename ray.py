@@ -8,14 +8,17 @@ def at(origin, direction, t):
 
 @ti.data_oriented
 class Rays:
-    ''' An array of "in flight" rays'''
+    ''' An array of "in flight" rays, time is the time of the path in
+        the shutter interval '''
     def __init__(self, x, y):
         self.origin = ti.Vector.field(3, dtype=ti.f32)
         self.direction = ti.Vector.field(3, dtype=ti.f32)
         self.depth = ti.field(ti.i32)
         self.attenuation = ti.Vector.field(3, dtype=ti.f32)
+        self.time = ti.field(ti.f32)
         ti.root.dense(ti.ij, (x, y)).place(self.origin, self.direction,
-                                           self.depth, self.attenuation)
+                                           self.depth, self.attenuation,
+                                           self.time)
 
     @ti.func
     def set(self, x, y, ray_org, ray_dir, depth, attenuation):
@@ -41,6 +44,14 @@ class Rays:
     def set_depth(self, x, y, d):
         self.depth[x, y] = d
 
+    @ti.func
+    def get_time(self, x, y):
+        return self.time[x, y]
+
+    @ti.func
+    def set_time(self, x, y, t):
+        self.time[x, y] = t
+
 
 @ti.data_oriented
 class HitRecord:
@@ -73,3 +84,27 @@ class HitRecord:
     @ti.func
     def set_hit(self, x, y, hit):
         self.hit[x, y] = hit
+
+
+@ti.data_oriented
+class Queue:
+    ''' A compacted list of pixels, filled in parallel by atomic appends.
+        Kernels loop over range(count) so the work is the live pixels. '''
+    def __init__(self, n):
+        self.pixel = ti.Vector.field(2, dtype=ti.i32)
+        self.count = ti.field(ti.i32)
+        ti.root.dense(ti.i, n).place(self.pixel)
+        ti.root.place(self.count)
+
+    @ti.func
+    def push(self, x, y):
+        self.pixel[ti.atomic_add(self.count[None], 1)] = ti.Vector([x, y])
+
+    @ti.func
+    def get(self, i):
+        pixel = self.pixel[i]
+        return pixel[0], pixel[1]
+
+    @ti.func
+    def clear(self):
+        self.count[None] = 0
@@ -0,0 +1,695 @@
+import taichi as ti
+import numpy as np
+from vector import *
+import ray
+from sampler import (Sampler, CAMERA_DIMS, BOUNCE_DIMS, ROULETTE_DIM,
+                     LIGHT_DIM)
+from instrument import RayCounters, add_rates
+from time import time
+
+
+# the distance of the guide hit of a miss for the denoiser
+MISS_DISTANCE = 1e4
+# states of a path looking for the hit the denoiser guides are taken at
+GUIDE_DONE = 0
+GUIDE_SEARCHING = 1
+GUIDE_NEEDS_ALBEDO = 2
+# how far off the surface scattered and shadow rays start.  In float32 a
+# ray leaving a hit on the radius 1000 ground often hits the ground again
+# right away, t_min alone does not stop it
+RAY_OFFSET = 1e-3
+
+
+@ti.func
+def offset_origin(p, n, direction):
+    ''' p moved off the surface with normal n to the side direction leaves
+        it on '''
+    return p + RAY_OFFSET * (n if direction.dot(n) > 0.0 else -n)
+
+
+@ti.func
+def get_background(dir):
+    ''' Returns the background color for a given direction vector '''
+    unit_direction = dir.normalized()
+    t = 0.5 * (unit_direction[1] + 1.0)
+    return (1.0 - t) * WHITE + t * BLUE
+
+
+@ti.func
+def power_heuristic(pdf, other_pdf):
+    ''' The multiple importance sampling weight of a sample from a strategy
+        with pdf against one with other_pdf '''
+    return pdf * pdf / (pdf * pdf + other_pdf * other_pdf)
+
+
+def split_views(image, views):
+    ''' A (width, views * height, 3) image of stacked views as a
+        (views, width, height, 3) array '''
+    width, rows = image.shape[:2]
+    return image.reshape(width, views, rows // views,
+                         3).transpose(1, 0, 2, 3)
+
+
+def buffer_size(width, height, smallest=64):
+    ''' Buffer dimensions for a width x height frame rounded up to powers of
+        two.  Field shapes are compiled into the kernels, so renderers with
+        buffers of the same rounded size share their compiled kernels, at
+        the cost of looping over up to four times the pixels. '''
+    def round_up(n):
+        return max(smallest, 1 << (n - 1).bit_length())
+
+    return round_up(width), round_up(height)
+
+
+@ti.data_oriented
+class Renderer:
+    ''' The megakernel renderer.  Every pass runs one kernel over all pixels
+        that does one bounce of each unfinished pixel.  A launch runs
+        pass_batch passes, each pixel loops over its bounces, and the host
+        only checks the device side count of completed pixels between
+        launches.
+
+        With adaptive_threshold > 0 a pixel stops once it has min_samples
+        and the relative standard error of its mean is under the threshold.
+        With max_samples above samples_per_pixel the samples saved this way
+        go to the noisy pixels, up to max_samples each, until the total of
+        samples_per_pixel times the number of pixels is used.  finish divides
+        each pixel by its own sample count.
+
+        The buffers can be a tile of a larger frame_width x frame_height
+        image, set_tile picks the part of the frame rendered next.  With a
+        camera of several views the frame stacks them, frame_height rows
+        each, so buffers views * frame_height tall trace all views in the
+        same launches and layers splits them again.
+
+        The random numbers come from a sampler.Sampler of the given kind
+        and seed, keyed on the pixel of the frame and the sample index, so
+        renders are reproducible.  Only redistributing samples with
+        max_samples depends on the order pixels finish in.
+
+        With instrument the rays, the bvh nodes and objects their
+        traversals visit and the path lengths are counted into stats.
+        The counting is only compiled in with instrument, and it also counts
+        any other use of world.
+
+        With roulette_depth > 0 paths that bounced roulette_depth times go
+        on with a probability of their largest throughput, capped at 0.95,
+        and are weighted by one over it, so dark paths end early without
+        biasing the mean.
+
+        With auxiliary the albedo, normal, position and distance along the
+        path of the first hit of each sample that is not a mirror or glass
+        are averaged into albedo, normal, position and distance, for
+        guiding a denoise.Denoiser.  The albedo is multiplied by the
+        attenuation of the mirrors and glass on the way.  A miss has the
+        background as albedo, a zero normal and a position MISS_DISTANCE
+        along the ray.  They are averaged over the samples since the render
+        started or resumed.
+
+        Emissive objects add their light when a path hits them.  With
+        light_sampling and spheres among them every bounce off a material
+        with a bsdf pdf also sends a shadow ray to a point picked on one of
+        the spheres, and both are weighted by the power heuristic, so small
+        lights converge in a few samples.  sky scales the background, 0 for
+        scenes only lit by their objects.
+
+        checkpoint and restore save and load the sums of the samples so
+        far, a restored render goes on with trace(resume=True) and can be
+        given more samples per pixel than it was started with.
+
+        The kernels read the samples, depth, adaptive threshold and frame
+        size from the settings field, so different values reuse the kernels
+        compiled for others, from the offline cache in a new process too.
+        Only turning adaptive sampling on or off and the buffer size change
+        the kernels, see buffer_size. '''
+    def __init__(self, world, cam, image_width, image_height,
+                 samples_per_pixel, max_depth, pass_batch=16,
+                 adaptive_threshold=0.0, min_samples=16, max_samples=None,
+                 frame_width=None, frame_height=None, sampler='independent',
+                 seed=0, instrument=False, roulette_depth=0,
+                 auxiliary=False, sky=1.0, light_sampling=True):
+        self.world = world
+        self.cam = cam
+        self.image_width = image_width
+        self.image_height = image_height
+        self.frame_width = frame_width or image_width
+        self.frame_height = frame_height or image_height // cam.views
+        self.samples_per_pixel = samples_per_pixel
+        self.max_depth = max_depth
+        self.pass_batch = pass_batch
+        self.adaptive_threshold = adaptive_threshold
+        self.min_samples = min(min_samples, samples_per_pixel)
+        self.max_samples = max(max_samples or samples_per_pixel,
+                               samples_per_pixel)
+        self.roulette_depth = roulette_depth
+        self.use_roulette = roulette_depth > 0
+        self.auxiliary = auxiliary
+        self.sky = sky
+        self.emissive = world.has_emission
+        self.next_event = light_sampling and world.num_lights > 0
+        self.stats = {}
+        self.counters = None
+        self.counting = instrument
+        if instrument:
+            self.counters = RayCounters(max_depth)
+            world.set_counters(self.counters)
+
+        self.sampler = Sampler(sampler, seed)
+        self.rays = ray.Rays(image_width, image_height)
+        self.pixels = ti.Vector.field(3, dtype=float)
+        self.sample_count = ti.field(dtype=ti.i32)
+        self.needs_sample = ti.field(dtype=ti.i32)
+        self.sum_sq = ti.field(dtype=ti.f32)
+        self.done = ti.field(dtype=ti.i32)
+        ti.root.dense(ti.ij, (image_width, image_height)).place(
+            self.pixels, self.sample_count, self.needs_sample, self.sum_sq,
+            self.done)
+        if auxiliary:
+            self.albedo = ti.Vector.field(3, dtype=ti.f32)
+            self.normal = ti.Vector.field(3, dtype=ti.f32)
+            self.position = ti.Vector.field(3, dtype=ti.f32)
+            self.distance = ti.field(dtype=ti.f32)
+            self.first_hits = ti.field(dtype=ti.i32)
+            # the path of the sample in flight
+            self.guide_state = ti.field(dtype=ti.i32)
+            self.guide_weight = ti.Vector.field(3, dtype=ti.f32)
+            self.guide_distance = ti.field(dtype=ti.f32)
+            ti.root.dense(ti.ij, (image_width, image_height)).place(
+                self.albedo, self.normal, self.position, self.distance,
+                self.first_hits, self.guide_state, self.guide_weight,
+                self.guide_distance)
+        if self.emissive:
+            # the light gathered by the path in flight and the pdf of its
+            # last scatter
+            self.radiance = ti.Vector.field(3, dtype=ti.f32)
+            self.scatter_pdf = ti.field(dtype=ti.f32)
+            ti.root.dense(ti.ij, (image_width, image_height)).place(
+                self.radiance, self.scatter_pdf)
+        self.num_completed = ti.field(dtype=ti.i32)
+        self.total_samples = ti.field(dtype=ti.i32)
+        self.sample_budget = ti.field(dtype=ti.i32)
+        self.tile = ti.Vector.field(4, dtype=ti.i32)
+        self.first_sample = ti.field(dtype=ti.i32)
+        ti.root.place(self.num_completed, self.total_samples,
+                      self.sample_budget, self.tile, self.first_sample)
+        self.settings = ti.Struct.field({
+            'samples_per_pixel': ti.i32,
+            'max_depth': ti.i32,
+            'min_samples': ti.i32,
+            'max_samples': ti.i32,
+            'adaptive_threshold': ti.f32,
+            'frame_width': ti.i32,
+            'frame_height': ti.i32,
+            'roulette_depth': ti.i32,
+            'sky': ti.f32,
+        })
+        ti.root.place(self.settings)
+        self.upload_settings()
+        self.set_tile(0, 0, image_width, image_height)
+
+    def upload_settings(self):
+        ''' Copy the settings attributes to the settings field, call it
+            after changing them between renders.  max_depth can not grow
+            past the one the renderer was made with when instrumented. '''
+        for name in self.settings.keys:
+            getattr(self.settings, name)[None] = getattr(self, name)
+
+    def set_tile(self, x, y, width, height, first_sample=0):
+        ''' Render the width x height pixels at x, y of the frame next.
+            The tile has to fit in the buffers.  Samples are numbered from
+            first_sample, so renders of the same tile with different
+            first_sample can be added together. '''
+        self.tile[None] = [x, y, width, height]
+        self.first_sample[None] = first_sample
+
+    def compile(self):
+        ''' Compile the kernels by running them on an empty tile, returns
+            the time it took '''
+        t = time()
+        tile = self.tile.to_numpy()
+        self.set_tile(0, 0, 0, 0)
+        self.wavefront_initial()
+        self.run_batch()
+        self.is_done()
+        self.finish()
+        self.tile.from_numpy(tile)
+        return time() - t
+
+    @ti.kernel
+    def finish(self):
+        for x, y in self.pixels:
+            self.pixels[x, y] = ti.sqrt(self.pixels[x, y] /
+                                        ti.max(self.sample_count[x, y], 1))
+            if ti.static(self.auxiliary):
+                first_hits = ti.max(self.first_hits[x, y], 1)
+                self.albedo[x, y] /= first_hits
+                self.normal[x, y] /= first_hits
+                self.position[x, y] /= first_hits
+                self.distance[x, y] /= first_hits
+
+    @ti.func
+    def clear_auxiliary(self, x, y):
+        if ti.static(self.auxiliary):
+            self.albedo[x, y] = Color(0.0, 0.0, 0.0)
+            self.normal[x, y] = Vector(0.0, 0.0, 0.0)
+            self.position[x, y] = Point(0.0, 0.0, 0.0)
+            self.distance[x, y] = 0.0
+            self.first_hits[x, y] = 0
+
+    @ti.func
+    def add_guide(self, x, y, depth, hit, ray_org, ray_dir, p, n, index):
+        ''' Follow a path for the auxiliary buffers, called with each ray
+            and its depth bounces left.  From the camera ray on mirrors and
+            glass are passed through, the first other hit or miss, or the
+            last bounce, is added.  The albedo of a hit is added by
+            add_guide_albedo after the scatter. '''
+        if ti.static(self.auxiliary):
+            if depth == self.settings.max_depth[None]:
+                self.guide_state[x, y] = GUIDE_SEARCHING
+                self.guide_weight[x, y] = Color(1.0, 1.0, 1.0)
+                self.guide_distance[x, y] = 0.0
+            if self.guide_state[x, y] == GUIDE_SEARCHING:
+                if hit:
+                    distance = self.guide_distance[x, y] + (p -
+                                                            ray_org).norm()
+                    self.guide_distance[x, y] = distance
+                    if depth == 1 or not self.world.is_specular(index):
+                        self.guide_state[x, y] = GUIDE_NEEDS_ALBEDO
+                        self.normal[x, y] += n
+                        self.position[x, y] += p
+                        self.distance[x, y] += distance
+                        self.first_hits[x, y] += 1
+                else:
+                    self.guide_state[x, y] = GUIDE_DONE
+                    self.albedo[x, y] += self.guide_weight[
+                        x, y] * get_background(ray_dir)
+                    self.position[x, y] += ray_org + ray_dir.normalized(
+                    ) * MISS_DISTANCE
+                    self.distance[x, y] += self.guide_distance[
+                        x, y] + MISS_DISTANCE
+                    self.first_hits[x, y] += 1
+
+    @ti.func
+    def add_guide_albedo(self, x, y, attenuation):
+        ''' Add the attenuation of the scatter after add_guide '''
+        if ti.static(self.auxiliary):
+            state = self.guide_state[x, y]
+            if state == GUIDE_NEEDS_ALBEDO:
+                self.albedo[x, y] += self.guide_weight[x, y] * attenuation
+                self.guide_state[x, y] = GUIDE_DONE
+            elif state == GUIDE_SEARCHING:
+                self.guide_weight[x, y] *= attenuation
+
+    @ti.func
+    def reset_pixels(self):
+        ''' Clear the buffers, pixels outside the tile start done '''
+        tile = self.tile[None]
+        self.num_completed[None] = 0
+        self.total_samples[None] = 0
+        self.sample_budget[None] = self.settings.samples_per_pixel[
+            None] * tile[2] * tile[3]
+        for x, y in self.pixels:
+            self.pixels[x, y] = Color(0.0, 0.0, 0.0)
+            self.sample_count[x, y] = 0
+            self.needs_sample[x, y] = 1
+            self.sum_sq[x, y] = 0.0
+            self.done[x, y] = 0
+            self.clear_auxiliary(x, y)
+            if x >= tile[2] or y >= tile[3]:
+                self.done[x, y] = 1
+                self.num_completed[None] += 1
+
+    @ti.func
+    def sample(self, x, y, dim):
+        ''' Uniform number dim of the current sample of pixel x, y '''
+        tile = self.tile[None]
+        pixel = (tile[1] + y) * self.settings.frame_width[None] + tile[0] + x
+        return self.sampler.get(
+            pixel, self.first_sample[None] + self.sample_count[x, y], dim)
+
+    @ti.func
+    def bounce_sample(self, x, y, depth):
+        ''' The uniform numbers for scattering a ray with depth bounces
+            left '''
+        dim = CAMERA_DIMS + BOUNCE_DIMS * (self.settings.max_depth[None] -
+                                           depth)
+        return Vector(self.sample(x, y, dim), self.sample(x, y, dim + 1),
+                      self.sample(x, y, dim + 2))
+
+    @ti.func
+    def camera_ray(self, x, y):
+        ''' The origin, direction and time of a camera ray through pixel
+            x, y of the tile '''
+        tile = self.tile[None]
+        height = self.settings.frame_height[None]
+        row = tile[1] + y
+        view = 0
+        if ti.static(self.cam.views > 1):
+            view = row // height
+            row = row % height
+        u = (tile[0] + x + self.sample(x, y, 0)) / (
+            self.settings.frame_width[None] - 1)
+        v = (row + self.sample(x, y, 1)) / (height - 1)
+        return self.cam.sample_ray(u, v, self.sample(x, y, 2),
+                                   self.sample(x, y, 3), self.sample(x, y, 4),
+                                   view)
+
+    @ti.kernel
+    def wavefront_initial(self):
+        self.reset_pixels()
+
+    @ti.func
+    def reopen_pixels(self):
+        ''' Continue from restored buffers: every pixel starts a new path
+            and pixels of the tile with fewer than samples_per_pixel
+            samples are no longer done '''
+        tile = self.tile[None]
+        spp = self.settings.samples_per_pixel[None]
+        self.num_completed[None] = 0
+        self.sample_budget[None] = spp * tile[2] * tile[3]
+        for x, y in self.pixels:
+            self.needs_sample[x, y] = 1
+            self.clear_auxiliary(x, y)
+            if x < tile[2] and y < tile[3] and self.sample_count[x, y] < spp:
+                self.done[x, y] = 0
+            if self.done[x, y]:
+                self.num_completed[None] += 1
+
+    @ti.kernel
+    def wavefront_resume(self):
+        self.reopen_pixels()
+
+    def checkpoint(self):
+        ''' The state needed to go on with the render as a dict of numpy
+            arrays: the sums and counts of the samples and the tile.  The
+            random numbers only depend on the seed and the sample index, so
+            the seed and sample counts are all of the sampler state.  Paths
+            in flight are dropped and traced again after restore, with the
+            same random numbers. '''
+        tile = self.tile.to_numpy()
+        return {
+            'pixels': self.pixels.to_numpy(),
+            'sample_count': self.sample_count.to_numpy(),
+            'sum_sq': self.sum_sq.to_numpy(),
+            'done': self.done.to_numpy(),
+            'total_samples': np.int64(self.total_samples[None]),
+            'tile': tile,
+            'first_sample': np.int64(self.first_sample[None]),
+            'frame': np.array([
+                self.frame_width, self.frame_height, self.max_depth,
+                self.cam.views
+            ]),
+            'sampler': np.array(
+                [self.sampler.kind,
+                 str(self.sampler.seed[None])]),
+        }
+
+    def restore(self, state):
+        ''' Load a checkpoint of a render of the same frame, buffer size,
+            max depth and sampler.  Follow with trace(resume=True). '''
+        expected = {
+            'buffers': (self.image_width, self.image_height),
+            'frame': (self.frame_width, self.frame_height, self.max_depth,
+                      self.cam.views),
+            'sampler': (self.sampler.kind, str(self.sampler.seed[None])),
+        }
+        found = {
+            'buffers': state['sample_count'].shape,
+            'frame': tuple(state['frame'].tolist()),
+            'sampler': tuple(state['sampler'].tolist()),
+        }
+        for name in expected:
+            if expected[name] != found[name]:
+                raise ValueError('the checkpoint has {} {}, not {}'.format(
+                    name, found[name], expected[name]))
+        self.pixels.from_numpy(state['pixels'])
+        self.sample_count.from_numpy(state['sample_count'])
+        self.sum_sq.from_numpy(state['sum_sq'])
+        self.done.from_numpy(state['done'])
+        self.total_samples[None] = int(state['total_samples'])
+        self.tile.from_numpy(state['tile'])
+        self.first_sample[None] = int(state['first_sample'])
+
+    @ti.func
+    def is_converged(self, x, y):
+        ''' If the relative standard error of the pixel mean is under the
+            adaptive threshold, uses the luminance of the samples '''
+        n = self.sample_count[x, y]
+        mean = self.pixels[x, y].sum() / (3.0 * n)
+        variance = ti.max(self.sum_sq[x, y] / n - mean * mean, 0.0) * n / (
+            n - 1)
+        return ti.sqrt(variance / n) < self.settings.adaptive_threshold[
+            None] * ti.max(mean, 1e-4)
+
+    @ti.func
+    def add_sample(self, x, y, color):
+        ''' Add a finished path to a pixel.  Returns if the pixel is done,
+            in which case it is counted as completed. '''
+        self.pixels[x, y] += color
+        luminance = color.sum() / 3.0
+        self.sum_sq[x, y] += luminance * luminance
+        self.sample_count[x, y] += 1
+        total = ti.atomic_add(self.total_samples[None], 1) + 1
+        n = self.sample_count[x, y]
+
+        settings = self.settings[None]
+        done = n >= settings.max_samples
+        if n >= settings.samples_per_pixel and total >= self.sample_budget[
+                None]:
+            # past samples_per_pixel only while saved samples are left
+            done = True
+        if ti.static(self.adaptive_threshold > 0.0):
+            if n >= settings.min_samples and n > 1:
+                if self.is_converged(x, y):
+                    done = True
+
+        if done:
+            self.done[x, y] = 1
+            self.num_completed[None] += 1
+        return done
+
+    @ti.func
+    def roulette(self, x, y, depth, throughput):
+        ''' Russian roulette for a path with depth bounces left and the
+            throughput it has after scattering.  Returns if it goes on and
+            its throughput, scaled up by the odds of having survived. '''
+        alive = True
+        if ti.static(self.use_roulette):
+            settings = self.settings[None]
+            if settings.max_depth - depth >= settings.roulette_depth:
+                survive = ti.min(throughput.max(), 0.95)
+                if self.sample(x, y, ROULETTE_DIM + depth) >= survive:
+                    alive = False
+                else:
+                    throughput /= survive
+        return alive, throughput
+
+    @ti.func
+    def background(self, direction):
+        return get_background(direction) * self.settings.sky[None]
+
+    @ti.func
+    def start_path(self, x, y):
+        ''' Clear the light gathered by the path of pixel x, y '''
+        if ti.static(self.emissive):
+            self.radiance[x, y] = Color(0.0, 0.0, 0.0)
+            self.scatter_pdf[x, y] = 0.0
+
+    @ti.func
+    def path_color(self, x, y, color):
+        ''' The color of a path ending with color '''
+        if ti.static(self.emissive):
+            color += self.radiance[x, y]
+        return color
+
+    @ti.func
+    def add_emission(self, x, y, ray_org, time, front_facing, index,
+                     throughput):
+        ''' Add the light of an object hit by the path.  A light that
+            sample_lights could have picked at the last hit is weighted
+            against it. '''
+        if ti.static(self.emissive):
+            emission = self.world.emitted(index)
+            if front_facing and emission.max() > 0.0:
+                weight = 1.0
+                if ti.static(self.next_event):
+                    scatter_pdf = self.scatter_pdf[x, y]
+                    if scatter_pdf > 0.0 and self.world.is_light(index):
+                        weight = power_heuristic(
+                            scatter_pdf,
+                            self.world.light_pdf(ray_org, index, time))
+                self.radiance[x, y] += throughput * emission * weight
+
+    @ti.func
+    def sample_lights(self, x, y, depth, ray_dir, p, n, index, time,
+                      throughput, out_direction):
+        ''' Next event estimation at a hit with depth bounces left after
+            it: add the light along a shadow ray to a light, weighted
+            against hitting it with the scattered ray, and keep the pdf of
+            out_direction for add_emission.  The last hit samples no light
+            as its scattered ray is not traced. '''
+        if ti.static(self.next_event):
+            scatter_pdf = 0.0
+            if depth > 0:
+                rnd = Vector(self.sample(x, y, LIGHT_DIM + 3 * depth),
+                             self.sample(x, y, LIGHT_DIM + 3 * depth + 1),
+                             self.sample(x, y, LIGHT_DIM + 3 * depth + 2))
+                # sampled from off the side the path came from, so distance
+                # is to the light from where the shadow ray starts
+                origin = offset_origin(p, n, -ray_dir)
+                direction, distance, emission, light_pdf = \
+                    self.world.sample_light(origin, time, rnd)
+                value, pdf = self.world.eval(index, ray_dir, n, direction)
+                if light_pdf > 0.0 and pdf > 0.0:
+                    self.count_ray()
+                    if not self.world.occluded(origin, direction,
+                                               distance * 0.9999, time):
+                        self.radiance[x, y] += throughput * value * \
+                            emission * power_heuristic(
+                                light_pdf, pdf) / light_pdf
+                _, scatter_pdf = self.world.eval(index, ray_dir, n,
+                                                 out_direction.normalized())
+            self.scatter_pdf[x, y] = scatter_pdf
+
+    @ti.func
+    def count_ray(self):
+        if ti.static(self.counting):
+            self.counters.count_ray()
+
+    @ti.func
+    def count_path(self, length):
+        ''' Count a finished path of length rays '''
+        if ti.static(self.counting):
+            self.counters.count_path(length)
+
+    @ti.func
+    def bounce(self, x, y):
+        ''' One pass for a pixel:
+                generate ray if needed
+                intersect scene with ray
+                if miss or last bounce sample backgound
+                count pixels that hit max samples
+        '''
+        # gen sample
+        ray_org = Point(0.0, 0.0, 0.0)
+        ray_dir = Vector(0.0, 0.0, 0.0)
+        depth = self.settings.max_depth[None]
+        pdf = Vector(1.0, 1.0, 1.0)
+        time = 0.0
+
+        if self.needs_sample[x, y] == 1:
+            self.needs_sample[x, y] = 0
+            ray_org, ray_dir, time = self.camera_ray(x, y)
+            self.rays.set(x, y, ray_org, ray_dir, depth, pdf)
+            self.rays.set_time(x, y, time)
+            self.start_path(x, y)
+        else:
+            ray_org, ray_dir, depth, pdf = self.rays.get(x, y)
+            time = self.rays.get_time(x, y)
+
+        # intersect
+        hit, p, n, front_facing, index = self.world.hit_all(
+            ray_org, ray_dir, time)
+        self.count_ray()
+        self.add_guide(x, y, depth, hit, ray_org, ray_dir, p, n, index)
+        rnd = self.bounce_sample(x, y, depth)
+        depth -= 1
+        self.rays.depth[x, y] = depth
+        ended = not hit or depth == 0
+        if hit:
+            self.add_emission(x, y, ray_org, time, front_facing, index, pdf)
+            reflected, out_origin, out_direction, attenuation = self.world.scatter(
+                ray_dir, p, n, front_facing, index, rnd)
+            out_origin = offset_origin(out_origin, n, out_direction)
+            self.add_guide_albedo(x, y, attenuation)
+            self.sample_lights(x, y, depth, ray_dir, p, n, index, time, pdf,
+                               out_direction)
+            throughput = pdf * attenuation
+            if not ended:
+                alive, throughput = self.roulette(x, y, depth, throughput)
+                if not alive or throughput.max() <= 0.0:
+                    # the path ends dark
+                    ended = True
+                    pdf = Color(0.0, 0.0, 0.0)
+            self.rays.set(x, y, out_origin, out_direction, depth, throughput)
+            ray_dir = out_direction
+
+        if ended:
+            self.count_path(self.settings.max_depth[None] - depth)
+            self.add_sample(x, y,
+                            self.path_color(x, y,
+                                            pdf * self.background(ray_dir)))
+            self.needs_sample[x, y] = 1
+
+    @ti.kernel
+    def wavefront_big(self, passes: ti.i32):
+        ''' Loops over pixels, each does up to passes bounces '''
+        for x, y in self.pixels:
+            for _ in range(passes):
+                if self.done[x, y]:
+                    break
+                self.bounce(x, y)
+
+    def run_batch(self):
+        ''' Runs pass_batch passes, returns the number of kernel launches '''
+        self.wavefront_big(self.pass_batch)
+        return 1
+
+    def is_done(self):
+        return self.num_completed[None] == self.image_width * self.image_height
+
+    def trace(self, resume=False, on_batch=None):
+        ''' Run batches of passes until every pixel has all samples, leaves
+            the sum of the samples in pixels.  With resume the samples in
+            the buffers are kept, see restore.  on_batch(self, done) is
+            called after every batch.
+            stats has the number of launches and host syncs and the time of
+            a batch with no work left, which estimates the launch and sync
+            overhead of each batch. '''
+        if self.counters is not None:
+            self.counters.clear()
+        t = time()
+        if resume:
+            self.wavefront_resume()
+        else:
+            self.wavefront_initial()
+        num_batches = 0
+        num_launches = 0
+        while True:
+            num_launches += self.run_batch()
+            num_batches += 1
+            done = self.is_done()
+            if on_batch is not None:
+                on_batch(self, done)
+            if done:
+                break
+        render_time = time() - t
+
+        t = time()
+        self.run_batch()
+        self.is_done()
+        idle_time = time() - t
+
+        self.stats = {
+            'render_time': render_time,
+            'passes': num_batches * self.pass_batch,
+            'launches': num_launches,
+            'host_syncs': num_batches,
+            'idle_batch_time': idle_time,
+            'overhead_time': idle_time * num_batches,
+        }
+        if self.counters is not None:
+            self.stats.update(self.counters.to_dict())
+            add_rates(self.stats)
+
+    def layers(self):
+        ''' The views of a finished render of the whole frame as a
+            (views, width, height, 3) array '''
+        image = self.pixels.to_numpy()[:self.frame_width, :self.frame_height *
+                                       self.cam.views]
+        return split_views(image, self.cam.views)
+
+    def render(self, resume=False, on_batch=None):
+        ''' Trace all samples and normalize pixels to the final image '''
+        self.trace(resume, on_batch)
+        self.finish()
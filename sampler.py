@@ -0,0 +1,85 @@
+import taichi as ti
+import numpy as np
+
+# the uniform numbers a path uses: pixel jitter, lens position and time for
+# the camera ray, then a few for the scatter of each bounce
+CAMERA_DIMS = 5
+BOUNCE_DIMS = 3
+# bounces that get low discrepancy numbers, past a few dimensions the
+# R_d sequence correlates neighbouring dimensions and gets worse than random
+LOW_DISCREPANCY_BOUNCES = 2
+# russian roulette takes one number per bounce from dimensions this far up,
+# so turning it on leaves the numbers of the camera and scatters as they were
+ROULETTE_DIM = 1 << 16
+# and sampling the lights three per bounce from here
+LIGHT_DIM = 1 << 17
+
+SAMPLERS = ['independent', 'rd']
+
+
+def num_dims(max_depth):
+    return CAMERA_DIMS + BOUNCE_DIMS * max_depth
+
+
+@ti.func
+def pcg_hash(v):
+    ''' The pcg output permutation of a u32 '''
+    state = v * ti.u32(747796405) + ti.u32(2891336453)
+    word = ((state >> ((state >> 28) + ti.u32(4))) ^ state) * ti.u32(277803737)
+    return (word >> 22) ^ word
+
+
+@ti.func
+def to_unit(v):
+    ''' A u32 as a float in [0, 1) '''
+    return ti.cast(v >> 8, ti.f32) * (1.0 / 16777216.0)
+
+
+def rd_steps(dims):
+    ''' The steps of the R_d sequence in dims dimensions as 32 bit fixed
+        point, powers of 1 / phi where phi is the root of x^(d+1) = x + 1 '''
+    phi = 2.0
+    for _ in range(64):
+        phi = (1.0 + phi)**(1.0 / (dims + 1))
+    steps = np.array([(1.0 / phi)**(j + 1) % 1.0 for j in range(dims)])
+    return (steps * 2.0**32).astype(np.uint64).astype(np.uint32)
+
+
+@ti.data_oriented
+class Sampler:
+    ''' Uniform numbers made from a hash of the seed, pixel, sample index
+        and dimension rather than a global random state, so a render does
+        not depend on thread scheduling and any sample of any pixel can be
+        made on any worker.
+            independent: a new random number for every sample
+            rd: the R_d low discrepancy sequence over the sample index,
+                shifted by a random offset per pixel and dimension
+        Dimensions past dims fall back to random numbers.  The seed is a
+        field so a new seed does not compile the kernels again. '''
+    def __init__(self, kind='independent', seed=0,
+                 dims=num_dims(LOW_DISCREPANCY_BOUNCES)):
+        if kind not in SAMPLERS:
+            raise ValueError('unknown sampler {}'.format(kind))
+        self.dims = dims
+        self.kind = kind
+        self.seed = ti.field(dtype=ti.u32)
+        ti.root.place(self.seed)
+        self.seed[None] = seed % (1 << 32)
+        self.steps = ti.field(dtype=ti.u32)
+        ti.root.dense(ti.i, dims).place(self.steps)
+        self.steps.from_numpy(rd_steps(dims))
+
+    @ti.func
+    def get(self, pixel, sample, dim):
+        ''' Uniform number dim of a sample of a pixel '''
+        # the seed is hashed on its own, added to the pixel seed s + 1
+        # would be seed s shifted by one pixel
+        h = pcg_hash(
+            pcg_hash(ti.cast(pixel, ti.u32) + pcg_hash(self.seed[None])) +
+            ti.cast(dim, ti.u32))
+        value = pcg_hash(h + pcg_hash(ti.cast(sample, ti.u32)))
+        if ti.static(self.kind == 'rd'):
+            if dim < self.dims:
+                # fixed point so the sum wraps around exactly
+                value = h + ti.cast(sample, ti.u32) * self.steps[dim]
+        return to_unit(value)
@@ -0,0 +1,280 @@
+import argparse
+import hashlib
+import json
+import os
+import numpy as np
+from time import time
+from bvh import FlatTree, build_bvh
+from hittable import World
+from material import (Lambert, Metal, Dielectric, Emissive, COLUMNS,
+                      material_arrays, dedupe_materials)
+
+# bump when the compiled layout changes so old compiled files are not read
+FORMAT_VERSION = 3
+MAGIC = b'RTSCENE\0'
+ALIGN = 64
+
+MATERIAL_TYPES = {
+    'lambert': lambda m: Lambert(m['color']),
+    'metal': lambda m: Metal(m['color'], m.get('roughness', 0.0)),
+    'dielectric': lambda m: Dielectric(m['ior']),
+    'emissive': lambda m: Emissive(m['emission']),
+}
+MATERIAL_NAMES = {
+    Lambert: 'lambert',
+    Metal: 'metal',
+    Dielectric: 'dielectric',
+    Emissive: 'emissive',
+}
+
+
+def parse_source(path, source):
+    ''' The scene description in the source of a .json or .toml file '''
+    if path.endswith('.toml'):
+        import tomllib
+        return tomllib.loads(source.decode())
+    return json.loads(source)
+
+
+def compile_scene(desc, compact, leaf_size):
+    ''' The arrays of a scene description with its bvh built, and the
+        header that goes with them '''
+    t = time()
+    materials = [MATERIAL_TYPES[m['type']](m) for m in desc['materials']]
+    names = {
+        m['name']: i
+        for i, m in enumerate(desc['materials']) if 'name' in m
+    }
+    spheres = desc['spheres']
+    center = np.array([s['center'] for s in spheres],
+                      dtype=np.float32).reshape(-1, 3)
+    radius = np.array([s['radius'] for s in spheres], dtype=np.float32)
+    center1 = np.array([s.get('center1', s['center']) for s in spheres],
+                       dtype=np.float32).reshape(-1, 3)
+    material = np.array([names.get(s['material'], s['material'])
+                         for s in spheres], dtype=np.int32)
+    table, table_ids = dedupe_materials(material_arrays(materials))
+
+    tree = build_bvh(np.minimum(center, center1) - radius[:, None],
+                     np.maximum(center, center1) + radius[:, None],
+                     max_leaf_size=leaf_size if compact else 1)
+    arrays = {
+        'center': center,
+        'radius': radius,
+        'material': table_ids[material],
+        'center1': center1,
+    }
+    for name, values in table.items():
+        arrays['material_' + name] = values
+    for name, values in tree.arrays().items():
+        arrays['bvh_' + name] = values
+    header = {
+        'camera': desc.get('camera'),
+        'bvh_stats': tree.stats,
+        'compile_time': time() - t,
+    }
+    return arrays, header
+
+
+def aligned(offset):
+    return (offset + ALIGN - 1) // ALIGN * ALIGN
+
+
+def write_compiled(path, arrays, header):
+    ''' Write the arrays after a json header listing their dtype, shape and
+        offset.  Written to a temporary file first so a reader never sees
+        half a file. '''
+    entries = {}
+    offset = 0
+    for name, values in arrays.items():
+        values = np.ascontiguousarray(values)
+        arrays[name] = values
+        offset = aligned(offset)
+        entries[name] = {
+            'dtype': values.dtype.str,
+            'shape': list(values.shape),
+            'offset': offset,
+        }
+        offset += values.nbytes
+    header = dict(header, version=FORMAT_VERSION, arrays=entries)
+    header_bytes = json.dumps(header, default=lambda o: o.item()).encode()
+    data_start = aligned(len(MAGIC) + 8 + len(header_bytes))
+
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(np.uint64(len(header_bytes)).tobytes())
+        f.write(header_bytes)
+        for name, values in arrays.items():
+            f.seek(data_start + entries[name]['offset'])
+            f.write(values.tobytes())
+    os.replace(tmp_path, path)
+
+
+def read_compiled(path):
+    ''' The header and read only memmaps of the arrays of a compiled scene '''
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError('{} is not a compiled scene'.format(path))
+        header_size = int(np.frombuffer(f.read(8), dtype=np.uint64)[0])
+        header = json.loads(f.read(header_size))
+    if header['version'] != FORMAT_VERSION:
+        raise ValueError('{} is compiled scene version {}'.format(
+            path, header['version']))
+    data_start = aligned(len(MAGIC) + 8 + header_size)
+    arrays = {
+        name: np.memmap(path,
+                        dtype=np.dtype(entry['dtype']),
+                        mode='r',
+                        offset=data_start + entry['offset'],
+                        shape=tuple(entry['shape']))
+        for name, entry in header['arrays'].items()
+    }
+    return header, arrays
+
+
+def cache_key(source, compact, leaf_size):
+    ''' A hash of the source and everything else the compiled file
+        depends on '''
+    options = json.dumps({
+        'version': FORMAT_VERSION,
+        'compact': compact,
+        'leaf_size': leaf_size if compact else 1,
+    })
+    return hashlib.sha256(source + options.encode()).hexdigest()
+
+
+class Scene:
+    ''' A scene file of spheres, a material table and optionally a camera
+        in json or toml:
+            {
+                "camera": {"from": [13, 2, 3], "at": [0, 0, 0],
+                           "up": [0, 1, 0], "fov": 20, "aperture": 0.1,
+                           "focus_dist": 10},
+                "materials": [
+                    {"name": "ground", "type": "lambert",
+                     "color": [0.5, 0.5, 0.5]},
+                    {"type": "metal", "color": [0.7, 0.6, 0.5],
+                     "roughness": 0.0},
+                    {"type": "dielectric", "ior": 1.5},
+                    {"name": "lamp", "type": "emissive",
+                     "emission": [20, 18, 15]}
+                ],
+                "spheres": [
+                    {"center": [0, -1000, 0], "radius": 1000,
+                     "material": "ground"},
+                    {"center": [0, 1, 0], "radius": 1, "material": 2}
+                ]
+            }
+        Spheres refer to materials by name or index, emissive spheres are
+        lights.  A sphere with a
+        "center1" moves from center at time 0 to center1 at time 1, the
+        camera can have a "shutter": [time0, time1] for motion blur.
+
+        The first load compiles the spheres, materials and bvh to a binary
+        file in cache_dir named after a hash of the source and the build
+        options.  Later loads memory map it and upload the arrays with
+        from_numpy, nothing is built.  Any edit of the source changes the
+        hash, so an old compiled file is never used. '''
+    def __init__(self, path, compact=False, leaf_size=4,
+                 traversal='threaded', cache_dir=None):
+        t = time()
+        cache_dir = cache_dir or os.path.join(
+            os.path.dirname(os.path.abspath(path)), '.scene_cache')
+        with open(path, 'rb') as f:
+            source = f.read()
+        self.compiled_path = os.path.join(
+            cache_dir, '{}-{}.rtscene'.format(
+                os.path.splitext(os.path.basename(path))[0],
+                cache_key(source, compact, leaf_size)[:16]))
+
+        cache_hit = os.path.exists(self.compiled_path)
+        if not cache_hit:
+            os.makedirs(cache_dir, exist_ok=True)
+            desc = parse_source(path, source)
+            write_compiled(self.compiled_path,
+                           *compile_scene(desc, compact, leaf_size))
+        header, arrays = read_compiled(self.compiled_path)
+        self.camera = header['camera']
+
+        materials = {
+            name: arrays['material_' + name]
+            for name in ('mat_index', *COLUMNS)
+        }
+        tree = FlatTree.from_arrays(
+            {name: arrays['bvh_' + name]
+             for name in FlatTree.ARRAYS}, header['bvh_stats'])
+        self.world = World()
+        self.world.commit_arrays(arrays['center'], arrays['radius'],
+                                 arrays['material'], materials, compact,
+                                 leaf_size, traversal, tree=tree,
+                                 center1=arrays['center1'])
+        self.stats = {
+            'cache_hit': cache_hit,
+            'compile_time': 0.0 if cache_hit else header['compile_time'],
+            'load_time': time() - t,
+        }
+
+
+def save_scene(path, world, camera=None):
+    ''' Write the spheres and material table of a world that is not
+        committed yet as a json scene file '''
+    center, radius, material_ids, center1 = world.sphere_arrays()
+    materials = []
+    for m in world.material_table:
+        desc = {'type': MATERIAL_NAMES[type(m)]}
+        if isinstance(m, Dielectric):
+            desc['ior'] = m.ior
+        elif isinstance(m, Emissive):
+            desc['emission'] = [float(m.emission[i]) for i in range(3)]
+        else:
+            desc['color'] = [float(m.color[i]) for i in range(3)]
+        if isinstance(m, Metal):
+            desc['roughness'] = m.roughness
+        materials.append(desc)
+    spheres = []
+    for c, r, m, c1 in zip(center, radius, material_ids, center1):
+        sphere = {
+            'center': c.tolist(),
+            'radius': r.item(),
+            'material': m.item()
+        }
+        if np.any(c1 != c):
+            sphere['center1'] = c1.tolist()
+        spheres.append(sphere)
+
+    # one material or sphere per line
+    sections = []
+    if camera is not None:
+        sections.append(' "camera": {}'.format(json.dumps(camera)))
+    for name, items in (('materials', materials), ('spheres', spheres)):
+        sections.append(' "{}": [\n  {}\n ]'.format(
+            name, ',\n  '.join(json.dumps(item) for item in items)))
+    with open(path, 'w') as f:
+        f.write('{{\n{}\n}}\n'.format(',\n'.join(sections)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='scene files')
+    sub = parser.add_subparsers(dest='command', required=True)
+    export = sub.add_parser('export',
+                            help='write the main.py scene as a scene file')
+    export.add_argument('path')
+    export.add_argument('--seed', type=int, default=0)
+    compile = sub.add_parser('compile', help='compile a scene file')
+    compile.add_argument('path')
+    compile.add_argument('--compact', action='store_true')
+    compile.add_argument('--leaf-size', type=int, default=4)
+    args = parser.parse_args()
+
+    import taichi as ti
+    import random
+    ti.init(arch=ti.cpu)
+    if args.command == 'export':
+        from main import make_world, BOOK_CAMERA
+        random.seed(args.seed)
+        save_scene(args.path, make_world(), BOOK_CAMERA)
+    else:
+        scene = Scene(args.path, compact=args.compact,
+                      leaf_size=args.leaf_size)
+        print(scene.compiled_path, scene.stats)
@@ -0,0 +1,28 @@
+import threading
+from multiprocessing.connection import Client
+from distributed import Coordinator
+
+
+def drop_out(coordinator):
+    ''' A worker that takes a job and dies without sending it back '''
+    conn = Client(coordinator.address, authkey=coordinator.authkey)
+    conn.recv()
+    conn.recv()
+    conn.close()
+
+
+def test_worker_dropping_out():
+    coordinator = Coordinator(16, 8, 2, 4, tile_size=8, sample_slices=2)
+    # connects before the local worker is up, so it gets the first job
+    threading.Thread(target=drop_out, args=(coordinator, )).start()
+
+    result = []
+    render = threading.Thread(
+        target=lambda: result.append(coordinator.render(num_local_workers=1)),
+        daemon=True)
+    render.start()
+    render.join(timeout=300)
+    assert result, 'the render did not finish'
+    # every job was merged once, the dropped one by the other worker
+    assert (coordinator.counts == 2).all()
+    assert coordinator.stats['jobs_per_worker'] == [len(coordinator.jobs)]
@@ -0,0 +1,102 @@
+import numpy as np
+from time import time
+from instrument import add_rates
+from render import split_views
+
+
+def scanline_order(tiles, width, height):
+    return tiles
+
+
+def center_order(tiles, width, height):
+    ''' Tiles closest to the middle of the image first '''
+    def distance(tile):
+        x, y, w, h = tile
+        return (x + w / 2 - width / 2)**2 + (y + h / 2 - height / 2)**2
+
+    return sorted(tiles, key=distance)
+
+
+TILE_ORDERS = {
+    'scanline': scanline_order,
+    'center': center_order,
+}
+
+
+class TileRenderer:
+    ''' Renders a large image a tile at a time.  A single renderer with
+        tile_size x tile_size buffers is reused for every tile so device
+        memory depends on the tile size, not the image size.  Finished tiles
+        are copied into image, which can be an np.memmap for frames too big
+        for host memory, and passed to on_tile as they complete.  The views
+        of a camera with several are stacked in image, image_height rows
+        each, see layers. '''
+    def __init__(self, renderer_class, world, cam, image_width, image_height,
+                 samples_per_pixel, max_depth, tile_size=256,
+                 tile_order='center', image=None, **kwargs):
+        self.image_width = image_width
+        self.image_height = image_height
+        self.views = cam.views
+        # rows of the stacked views
+        self.frame_rows = image_height * cam.views
+        self.tile_size = tile_size
+        self.tile_order = tile_order
+        self.renderer = renderer_class(world,
+                                       cam,
+                                       min(tile_size, image_width),
+                                       min(tile_size, self.frame_rows),
+                                       samples_per_pixel,
+                                       max_depth,
+                                       frame_width=image_width,
+                                       frame_height=image_height,
+                                       **kwargs)
+        if image is None:
+            image = np.zeros((image_width, self.frame_rows, 3),
+                             dtype=np.float32)
+        self.image = image
+        self.stats = {}
+
+    def compile(self):
+        return self.renderer.compile()
+
+    def tiles(self):
+        ''' The (x, y, width, height) of every tile in render order '''
+        tiles = []
+        for y in range(0, self.frame_rows, self.renderer.image_height):
+            for x in range(0, self.image_width, self.renderer.image_width):
+                tiles.append((x, y,
+                              min(self.renderer.image_width,
+                                  self.image_width - x),
+                              min(self.renderer.image_height,
+                                  self.frame_rows - y)))
+        return TILE_ORDERS[self.tile_order](tiles, self.image_width,
+                                            self.frame_rows)
+
+    def layers(self):
+        ''' The views of the image as a (views, width, height, 3) array '''
+        return split_views(self.image, self.views)
+
+    def render(self, on_tile=None):
+        ''' Render every tile, on_tile(x, y, pixels) is called for each
+            finished tile.  stats sums the stats of the tiles. '''
+        t = time()
+        self.stats = {'tiles': 0}
+        for x, y, w, h in self.tiles():
+            self.renderer.set_tile(x, y, w, h)
+            self.renderer.render()
+            pixels = self.renderer.pixels.to_numpy()[:w, :h]
+            self.image[x:x + w, y:y + h] = pixels
+
+            self.stats['tiles'] += 1
+            for key, value in self.renderer.stats.items():
+                if isinstance(value, list):
+                    # histograms add up bin by bin
+                    value = np.add(self.stats.get(key, 0), value).tolist()
+                else:
+                    value = self.stats.get(key, 0) + value
+                self.stats[key] = value
+            if on_tile is not None:
+                on_tile(x, y, pixels)
+        if 'rays' in self.stats:
+            add_rates(self.stats)
+        self.stats['total_time'] = time() - t
@@ -11,27 +11,68 @@ BLUE = Color(0.5, 0.7, 1.0)
 RED = Color(1.0, 0.0, 0.0)
 
 
+# the sample_ functions map uniform numbers in [0, 1) to points, the
+# random_ ones use ti.random()
 @ti.func
-def random_in_unit_disk():
-    theta = ti.random() * math.pi * 2.0
-    r = ti.random()**0.5
+def sample_unit_disk(u1, u2):
+    theta = u1 * math.pi * 2.0
+    r = u2**0.5
 
     return Vector(r * ti.cos(theta), r * ti.sin(theta), 0.0)
 
 
 @ti.func
-def random_in_hemisphere(normal):
-    vec = random_in_unit_sphere()
+def sample_hemisphere(normal, u):
+    vec = sample_unit_sphere(u)
     if vec.dot(normal) < 0:
         vec = -vec
     return vec
 
 
 @ti.func
-def random_in_unit_sphere():
-    theta = ti.random() * math.pi * 2.0
-    v = ti.random()
-    phi = ti.acos(2.0 * v - 1.0)
-    r = ti.random()**(1 / 3)
+def sample_unit_sphere(u):
+    theta = u[0] * math.pi * 2.0
+    phi = ti.acos(2.0 * u[1] - 1.0)
+    r = u[2]**(1 / 3)
     return Vector(r * ti.sin(phi) * ti.cos(theta),
                   r * ti.sin(phi) * ti.sin(theta), r * ti.cos(phi))
+
+
+@ti.func
+def sample_unit_vector(u):
+    ''' A uniform direction from two numbers '''
+    theta = u[0] * math.pi * 2.0
+    z = 2.0 * u[1] - 1.0
+    r = ti.sqrt(ti.max(1.0 - z * z, 0.0))
+    return Vector(r * ti.cos(theta), r * ti.sin(theta), z)
+
+
+@ti.func
+def orthonormal_basis(w):
+    ''' Two unit vectors perpendicular to the unit vector w and each other,
+        Duff et al. "Building an Orthonormal Basis, Revisited" '''
+    sign = 1.0 if w[2] >= 0.0 else -1.0
+    a = -1.0 / (sign + w[2])
+    b = w[0] * w[1] * a
+    return (Vector(1.0 + sign * w[0] * w[0] * a, sign * b, -sign * w[0]),
+            Vector(b, sign + w[1] * w[1] * a, -w[1]))
+
+
+@ti.func
+def random_uniform3():
+    return Vector(ti.random(), ti.random(), ti.random())
+
+
+@ti.func
+def random_in_unit_disk():
+    return sample_unit_disk(ti.random(), ti.random())
+
+
+@ti.func
+def random_in_hemisphere(normal):
+    return sample_hemisphere(normal, random_uniform3())
+
+
+@ti.func
+def random_in_unit_sphere():
+    return sample_unit_sphere(random_uniform3())
@@ -0,0 +1,129 @@
+import taichi as ti
+from vector import *
+import ray
+from material import NUM_MATERIALS
+from render import Renderer, offset_origin
+
+
+@ti.data_oriented
+class QueueRenderer(Renderer):
+    ''' A wavefront renderer with a kernel per stage.  Each stage loops over
+        a compacted queue of the pixels it has work for:
+            generate: camera rays for pixels needing a new sample
+            intersect: closest hit of the rays to extend
+            shade: one kernel per material type for the rays that hit
+        so a pass costs time for the live rays, not the image size.
+        The host only checks the queues every pass_batch passes. '''
+    def __init__(self, world, cam, image_width, image_height,
+                 samples_per_pixel, max_depth, **kwargs):
+        super().__init__(world, cam, image_width, image_height,
+                         samples_per_pixel, max_depth, **kwargs)
+        num_pixels = image_width * image_height
+        self.hits = ray.HitRecord(image_width, image_height)
+        self.regen = ray.Queue(num_pixels)
+        self.extend = ray.Queue(num_pixels)
+        self.shade = [ray.Queue(num_pixels) for _ in range(NUM_MATERIALS)]
+
+    @ti.func
+    def queue_pixels(self):
+        ''' Empty the queues and queue a new path for pixels not done '''
+        self.regen.clear()
+        self.extend.clear()
+        for m in ti.static(range(NUM_MATERIALS)):
+            self.shade[m].clear()
+        for x, y in self.pixels:
+            if not self.done[x, y]:
+                self.regen.push(x, y)
+
+    @ti.kernel
+    def wavefront_initial(self):
+        self.reset_pixels()
+        self.queue_pixels()
+
+    @ti.kernel
+    def wavefront_resume(self):
+        self.reopen_pixels()
+        self.queue_pixels()
+
+    @ti.func
+    def end_sample(self, x, y, color):
+        ''' Add a finished path and queue the pixel if it needs more '''
+        if not self.add_sample(x, y, self.path_color(x, y, color)):
+            self.regen.push(x, y)
+
+    @ti.kernel
+    def generate(self):
+        for i in range(self.regen.count[None]):
+            x, y = self.regen.get(i)
+            ray_org, ray_dir, time = self.camera_ray(x, y)
+            self.rays.set(x, y, ray_org, ray_dir,
+                          self.settings.max_depth[None], Vector(1.0, 1.0, 1.0))
+            self.rays.set_time(x, y, time)
+            self.start_path(x, y)
+            self.extend.push(x, y)
+        self.regen.clear()
+
+    @ti.kernel
+    def intersect(self):
+        for i in range(self.extend.count[None]):
+            x, y = self.extend.get(i)
+            ray_org, ray_dir, depth, pdf = self.rays.get(x, y)
+            hit, p, n, front_facing, index = self.world.hit_all(
+                ray_org, ray_dir, self.rays.get_time(x, y))
+            self.count_ray()
+            self.add_guide(x, y, depth, hit, ray_org, ray_dir, p, n, index)
+            if hit:
+                self.add_emission(x, y, ray_org, self.rays.get_time(x, y),
+                                  front_facing, index, pdf)
+                self.hits.set(x, y, 1, p, n, front_facing, index)
+                mat_index = self.world.material_type(index)
+                for m in ti.static(range(NUM_MATERIALS)):
+                    if mat_index == m:
+                        self.shade[m].push(x, y)
+            else:
+                self.count_path(self.settings.max_depth[None] - depth + 1)
+                self.end_sample(x, y, pdf * self.background(ray_dir))
+        self.extend.clear()
+
+    @ti.kernel
+    def shade_material(self, m: ti.template(), queue: ti.template()):
+        ''' Scatter the rays in queue off objects of material type m '''
+        for i in range(queue.count[None]):
+            x, y = queue.get(i)
+            ray_org, ray_dir, depth, pdf = self.rays.get(x, y)
+            hit, p, n, front_facing, index = self.hits.get(x, y)
+            reflected, out_origin, out_direction, attenuation = self.world.scatter_as(
+                m, ray_dir, p, n, front_facing, index,
+                self.bounce_sample(x, y, depth))
+            out_origin = offset_origin(out_origin, n, out_direction)
+            self.add_guide_albedo(x, y, attenuation)
+            depth -= 1
+            self.sample_lights(x, y, depth, ray_dir, p, n, index,
+                               self.rays.get_time(x, y), pdf, out_direction)
+            if depth == 0:
+                self.count_path(self.settings.max_depth[None])
+                self.end_sample(x, y, pdf * self.background(out_direction))
+            else:
+                alive, throughput = self.roulette(x, y, depth,
+                                                  pdf * attenuation)
+                if alive and throughput.max() > 0.0:
+                    self.rays.set(x, y, out_origin, out_direction, depth,
+                                  throughput)
+                    self.extend.push(x, y)
+                else:
+                    self.count_path(self.settings.max_depth[None] - depth)
+                    self.end_sample(x, y, Color(0.0, 0.0, 0.0))
+        queue.clear()
+
+    def run_batch(self):
+        ''' Launches the stages of pass_batch passes without reading
+            anything back, returns the number of kernel launches '''
+        for _ in range(self.pass_batch):
+            self.generate()
+            self.intersect()
+            for m in range(NUM_MATERIALS):
+                self.shade_material(m, self.shade[m])
+        return self.pass_batch * (2 + NUM_MATERIALS)
+
+    def is_done(self):
+        return self.extend.count[None] + self.regen.count[None] == 0